@@ -1,11 +1,39 @@
 import os
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy.engine import Engine
 from sqlalchemy import event
 from flask import redirect
 db = SQLAlchemy()
 
+#Config keys of SQLite connection settings and the PRAGMA each of them sets
+SQLITE_PRAGMAS = (
+    ("SQLITE_JOURNAL_MODE", "journal_mode"),
+    ("SQLITE_SYNCHRONOUS", "synchronous"),
+    ("SQLITE_CACHE_SIZE", "cache_size"),
+    ("SQLITE_MMAP_SIZE", "mmap_size"),
+    ("SQLITE_TEMP_STORE", "temp_store"),
+    ("SQLITE_BUSY_TIMEOUT", "busy_timeout"),
+)
+
+def _sqlite_connect_hook(config):
+    """
+    Returns a listener for the connect event of the app's engine that enforces foreign keys and applies
+    the SQLite connection settings from config. Registered on the engine of each app instead of the global
+    Engine class, so creating more apps doesn't stack listeners. Foreign key enforcement is adapted from
+    the example in the exercise.
+    """
+    pragmas = ["PRAGMA foreign_keys=ON"]
+    for key, pragma in SQLITE_PRAGMAS:
+        if config.get(key) is not None:
+            pragmas.append("PRAGMA {}={}".format(pragma, config[key]))
+
+    def set_sqlite_pragma(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in pragmas:
+            cursor.execute(statement)
+        cursor.close()
+    return set_sqlite_pragma
+
 # Based on http://flask.pocoo.org/docs/1.0/tutorial/factory/#the-application-factory
 # Modified to use Flask SQLAlchemy
 #This function is adapted from Exercise work.
@@ -15,7 +43,33 @@ def create_app(test_config=None):
         SECRET_KEY="dev",
         SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "development.db"),
         #SQLALCHEMY_DATABASE_URI = "sqlite:///test.db",
-        SQLALCHEMY_TRACK_MODIFICATIONS=False
+        SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        #SQLite connection settings, applied with PRAGMA to every new connection (None leaves the SQLite default).
+        #WAL lets readers run concurrently with a writer instead of blocking behind every commit.
+        SQLITE_JOURNAL_MODE="WAL",
+        SQLITE_SYNCHRONOUS="NORMAL", #safe with WAL, only the last commits may be lost on power failure
+        SQLITE_CACHE_SIZE=-65536, #negative is in KiB, 64 MiB of page cache per connection
+        SQLITE_MMAP_SIZE=268435456, #read the first 256 MiB of the database file through memory mapping
+        SQLITE_TEMP_STORE="MEMORY",
+        SQLITE_BUSY_TIMEOUT=5000, #milliseconds to wait for a lock before failing with "database is locked"
+        #token that admin clients send as "Authorization: Bearer <token>", admin resources are disabled if None
+        ADMIN_TOKEN=None,
+        #seconds a process may keep using its cache of category and ethnicity ids before checking for
+        #changes made by other processes, see cache.py
+        LOOKUP_CACHE_MAX_AGE=1.0,
+        #where cache entries are stored, see cache_backends.py: "memory" in each process, "sqlite" in the
+        #file CACHE_PATH shared by the processes of a host (instance/cache.sqlite if None), or a callable
+        #that takes the app and returns a backend
+        CACHE_BACKEND="memory",
+        CACHE_PATH=None,
+        CACHE_MAX_ENTRIES=10000,
+        #seconds GET responses are served from the cache, 0 disables the response cache, see cache.py
+        RESPONSE_CACHE_TTL=60,
+        #seconds encoded items of lists are kept, 0 disables the fragment cache, see cache.py
+        FRAGMENT_CACHE_TTL=3600,
+        #encoder of JSON responses: "auto" (orjson if installed, else the standard library), "orjson",
+        #"json" or a function that returns bytes, see utils.get_json_encoder
+        JSON_ENCODER="auto"
     )
 
     if test_config is None:
@@ -30,19 +84,34 @@ def create_app(test_config=None):
 
     db.init_app(app)
 
-    #This function is brought from example in the exercise
-    @event.listens_for(Engine, "connect")
-    def set_sqlite_pragma(dbapi_connection, connection_record):
-        cursor = dbapi_connection.cursor()
-        cursor.execute("PRAGMA foreign_keys=ON")
-        cursor.close()
+    with app.app_context():
+        engine = db.engine
+    if engine.dialect.name == "sqlite":
+        event.listen(engine, "connect", _sqlite_connect_hook(app.config))
+
+    from .utils import get_json_encoder
+    app.extensions["json_encoder"] = get_json_encoder(app.config["JSON_ENCODER"])
+
+    from . import cache
+    cache.init_app(app)
 
     from . import database
     app.cli.add_command(database.init_db_command)
+    app.cli.add_command(database.upgrade_db_command)
+    app.cli.add_command(database.recount_command)
 
     from . import populate_db
     app.cli.add_command(populate_db.populate_database_example)
 
+    from . import import_data
+    app.cli.add_command(import_data.import_data_command)
+
+    from . import export_data
+    app.cli.add_command(export_data.export_data_command)
+
+    from . import ingredients
+    app.cli.add_command(ingredients.index_ingredients_command)
+
     from . import api
     app.register_blueprint(api.api_bp)
 
@@ -61,4 +130,7 @@ def create_app(test_config=None):
     def client():
         return app.send_static_file("html/recipebook.html")
 
+    from . import urls
+    urls.init_app(app)
+
     return app
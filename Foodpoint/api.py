@@ -1,11 +1,30 @@
-from flask import Blueprint, Response
+from flask import Blueprint, Response, current_app, request
 from flask_restful import Resource, Api
+
+
+class FoodpointApi(Api):
+    """
+    Api that builds the URLs of resources with the URLBuilder of the app (see urls.py) instead of the URL
+    map, with the same results.
+    """
+
+    def url_for(self, resource, **values):
+        endpoint = resource.endpoint
+        if self.blueprint:
+            endpoint = "{}.{}".format(self.blueprint.name, endpoint)
+        path = current_app.extensions["url_builder"].build(endpoint, values)
+        if path is None:
+            return super().url_for(resource, **values)
+        return request.script_root + path
+
+
 api_bp = Blueprint("api", __name__, url_prefix="/api")
-api = Api(api_bp)
+api = FoodpointApi(api_bp)
 
 # this import must be placed after we create api to avoid issues with
 # circular imports
-from Foodpoint.resources import AllUsers, EachUser, CollectionsByUser, EachCollection, EachRecipe, AllCategories, EachCategory, AllEthnicities, EachEthnicity, Entry
+from Foodpoint.resources import AllUsers, EachUser, CollectionsByUser, EachCollection, EachRecipe, AllCategories, EachCategory, AllEthnicities, EachEthnicity, Entry, Export, RecipeBatch, RecipeLinks, RecipeSearch, RecipesByIngredients
+from Foodpoint.resources import AllRecipes, CategoryRecipes, EthnicityRecipes, CacheStats
 
 #add route to each resources
 api.add_resource(Entry, "/")
@@ -14,7 +33,16 @@ api.add_resource(EachUser, "/users/<user>/")
 api.add_resource(CollectionsByUser, "/users/<user>/collections/")
 api.add_resource(EachCollection, "/users/<user>/collections/<col_name>/")
 api.add_resource(EachRecipe, "/users/<user>/collections/<col_name>/<recipe_id>/")
+api.add_resource(RecipeBatch, "/users/<user>/collections/<col_name>/batch/")
+api.add_resource(RecipeLinks, "/users/<user>/collections/<col_name>/links/")
 api.add_resource(AllCategories, "/categories/")
 api.add_resource(EachCategory, "/categories/<cat_name>/")
+api.add_resource(CategoryRecipes, "/categories/<cat_name>/recipes/")
 api.add_resource(AllEthnicities, "/ethnicities/")
 api.add_resource(EachEthnicity, "/ethnicities/<eth_name>/")
+api.add_resource(EthnicityRecipes, "/ethnicities/<eth_name>/recipes/")
+api.add_resource(AllRecipes, "/recipes/")
+api.add_resource(RecipeSearch, "/recipes/search/")
+api.add_resource(RecipesByIngredients, "/recipes/ingredients/")
+api.add_resource(Export, "/export/")
+api.add_resource(CacheStats, "/admin/cache/")
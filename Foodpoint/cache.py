@@ -0,0 +1,350 @@
+"""
+Caches of data that is read on most requests but rarely written, stored in the cache backend of the app
+(see cache_backends.py), which is either in the memory of each process or shared by the processes of a
+host.
+
+LookupCache keeps the ids of categories and ethnicities by name, which recipes refer to, so resolving
+the names of a recipe document doesn't need a query per name. Changes are announced to all processes
+through the CacheGeneration table: every write of a cached table increments its generation in the same
+transaction. Entries are stored in the backend under the generation they were read at, and each process
+also keeps the entries it used, which it drops when it sees a generation different from theirs. The
+generations are read at most once per LOOKUP_CACHE_MAX_AGE seconds, which bounds how long a process may
+use a stale entry. Names that don't exist are not cached, so only renames can be seen late, never new rows.
+
+ResponseCache keeps the encoded bodies of GET responses by request path and query, so a hit is served
+without querying the database or encoding JSON. Entries are tagged with the data they show, and the
+write paths invalidate the tags of the data they change in the backend. With a shared backend this
+evicts the responses of every process at once, with a backend of the process the other processes serve
+theirs until they expire after RESPONSE_CACHE_TTL seconds.
+
+FragmentCache keeps the encoded JSON of each item of list responses, such as a user in the list of
+users, so that lists are assembled from encoded items instead of building and encoding a document and
+its links for every row. An entry keeps the data its item was built from and is only used while the
+list reads the same data, so changes are seen at once by every process without evicting anything.
+"""
+
+import functools
+import threading
+import time
+from flask import Response, current_app, request
+from Foodpoint import db
+from Foodpoint.database import Category, Ethnicity, CacheGeneration
+from Foodpoint.cache_backends import create_backend
+from Foodpoint.utils import encode_json
+
+
+class LookupCache(object):
+    """
+    Read-through cache of name -> id of lookup tables, with hit and miss statistics per table. Hits count
+    the names found in this process or in the backend, misses the names read from the database.
+    Parameters:
+    - models: dict, kind of lookup (used as the name of its generation) -> model with columns name and id
+    - max_age: Float, seconds between reads of the generations
+    - backend: CacheBackend, where entries are shared with other processes
+    """
+    #seconds entries are kept in the backend, entries of old generations are never read again
+    ENTRY_TTL = 24 * 3600
+
+    def __init__(self, models, max_age, backend):
+        self.models = models
+        self.max_age = max_age
+        self.backend = backend
+        self.ids = dict((kind, {}) for kind in models)
+        self.generations = {}
+        self.checked = None
+        self.hits = dict((kind, 0) for kind in models)
+        self.misses = dict((kind, 0) for kind in models)
+        self.invalidations = dict((kind, 0) for kind in models)
+        self.lock = threading.Lock()
+
+    def _check_generations(self):
+        """
+        Drops the entries of the kinds whose generation changed since they were read, if the generations
+        haven't been read within max_age seconds.
+        """
+        now = time.monotonic()
+        if self.checked is not None and now - self.checked < self.max_age:
+            return
+        generations = dict(db.session.query(CacheGeneration.name, CacheGeneration.generation).filter(
+            CacheGeneration.name.in_(list(self.models))
+        ))
+        with self.lock:
+            for kind in self.models:
+                if generations.get(kind, 0) != self.generations.get(kind, 0):
+                    self.ids[kind] = {}
+                    self.invalidations[kind] += 1
+            self.generations = generations
+            self.checked = now
+
+    def get_ids(self, kind, names):
+        """
+        Returns a dict of name -> id of the rows of a kind with the given names, names that don't exist
+        are left out. Names that are not cached are read with one query.
+        Parameters:
+        - kind: String, kind of lookup, for example "category"
+        - names: iterable of names
+        """
+        self._check_generations()
+        cached = self.ids[kind]
+        found = {}
+        missing = []
+        for name in set(names):
+            if name in cached:
+                found[name] = cached[name]
+            else:
+                missing.append(name)
+        prefix = "lookup:{}:{}:".format(kind, self.generations.get(kind, 0))
+        shared = {}
+        for name in missing:
+            value = self.backend.get(prefix + name)
+            if value is not None:
+                shared[name] = int(value)
+        missing = [name for name in missing if name not in shared]
+        self.hits[kind] += len(found) + len(shared)
+        self.misses[kind] += len(missing)
+        if missing:
+            model = self.models[kind]
+            rows = dict(db.session.query(model.name, model.id).filter(model.name.in_(missing)))
+            for name, row_id in rows.items():
+                self.backend.set(prefix + name, str(row_id).encode("ascii"), self.ENTRY_TTL, {})
+            shared.update(rows)
+        with self.lock:
+            cached.update(shared)
+        found.update(shared)
+        return found
+
+    def get_id(self, kind, name):
+        """
+        Returns the id of the row of a kind with a name, or None if there is no such row.
+        Parameters:
+        - kind: String, kind of lookup, for example "category"
+        - name: String, name of the row
+        """
+        return self.get_ids(kind, [name]).get(name)
+
+    def invalidate(self, kind):
+        """
+        Increments the generation of a kind in the current transaction of the session, so that every
+        process stops using its entries once it is committed, and drops the entries of this process. Call it
+        before committing a write of the table of the kind.
+        Parameters:
+        - kind: String, kind of lookup, for example "category"
+        """
+        table = CacheGeneration.__table__
+        db.session.execute(table.insert().prefix_with("OR IGNORE"), {"name": kind, "generation": 0})
+        db.session.execute(table.update().where(table.c.name == kind).values(generation=table.c.generation + 1))
+        with self.lock:
+            self.ids[kind] = {}
+            self.invalidations[kind] += 1
+            self.checked = None
+
+    def stats(self):
+        """
+        Returns a dict of the statistics of each kind: hits, misses, invalidations and number of entries
+        in this process.
+        """
+        return dict((kind, {
+            "hits": self.hits[kind],
+            "misses": self.misses[kind],
+            "invalidations": self.invalidations[kind],
+            "entries": len(self.ids[kind])
+        }) for kind in self.models)
+
+
+class ResponseCache(object):
+    """
+    Cache of response bodies as bytes with a time to live and tags for eviction, stored in a backend as
+    the ETag and mimetype on a line each followed by the body. Hit and miss counts are of this process.
+    Parameters:
+    - backend: CacheBackend, where responses are stored
+    - ttl: Float, seconds a response is served from the cache, 0 disables the cache
+    """
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def get(self, key):
+        """
+        Returns the entry of a key, a dict with body, etag and mimetype, or None if it is not cached, has
+        expired or was invalidated.
+        Parameters:
+        - key: String, path and query of the request
+        """
+        value = self.backend.get("response:" + key) if self.ttl > 0 else None
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        etag, mimetype, body = value.split(b"\n", 2)
+        return {"body": body, "etag": etag.decode("utf-8") or None, "mimetype": mimetype.decode("utf-8")}
+
+    def versions(self, tags):
+        """
+        Returns the versions of tags to give to set, read before building the response, so that the
+        response is not served if any of the tags is invalidated while it is being built.
+        Parameters:
+        - tags: list of tags of the data the response shows
+        """
+        if self.ttl <= 0:
+            return {}
+        return self.backend.tag_versions(tags)
+
+    def set(self, key, body, etag, mimetype, versions):
+        """
+        Stores a response body.
+        Parameters:
+        - key: String, path and query of the request
+        - body: bytes, encoded body of the response
+        - etag: String, ETag of the response, None if it has none
+        - mimetype: String, mimetype of the response
+        - versions: dict, versions of the tags of the response from the versions method
+        """
+        if self.ttl <= 0:
+            return
+        header = "{}\n{}\n".format(etag or "", mimetype).encode("utf-8")
+        self.backend.set("response:" + key, header + body, self.ttl, versions)
+
+    def invalidate(self, *tags):
+        """
+        Evicts the responses with any of the tags.
+        Parameters:
+        - tags: tags of the data that changed
+        """
+        self.backend.invalidate(tags)
+        self.invalidations += len(tags)
+
+    def stats(self):
+        """
+        Returns a dict of the statistics of the cache: hits, misses and invalidated tags of this process,
+        and the statistics of the backend.
+        """
+        return {
+            "hits": self.hits, "misses": self.misses, "invalidations": self.invalidations,
+            "backend": self.backend.stats()
+        }
+
+
+class FragmentCache(object):
+    """
+    Cache of encoded list items by entity, with hit and miss statistics of this process.
+    Parameters:
+    - backend: CacheBackend, where items are stored
+    - ttl: Float, seconds an item is kept, 0 disables the cache
+    """
+
+    def __init__(self, backend, ttl):
+        self.backend = backend
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def render(self, kind, items, build):
+        """
+        Returns the items of a list encoded as JSON, as a list of bytes in the same order. Items are read
+        from the cache with one call of the backend, and the ones that are not cached or were built from
+        other data are built, encoded and stored.
+        Parameters:
+        - kind: String, kind of item, items of a kind must be built the same way from the same source
+        - items: list of (key, source) where key identifies the entity of the item and source is a JSON
+          serializable tuple of all the data the item shows
+        - build: function of key and source that returns the item as a dict
+        """
+        if self.ttl <= 0:
+            return [encode_json(build(key, source)) for key, source in items]
+        #links are relative to the root of the app, which may be mounted at different paths
+        prefix = "fragment:{}:{}:".format(kind, request.script_root)
+        keys = [prefix + str(key) for key, source in items]
+        encoded = []
+        stored = {}
+        for cache_key, (key, source), value in zip(keys, items, self.backend.get_many(keys)):
+            source_json = encode_json(source)
+            if value is not None:
+                cached_source, fragment = value.split(b"\n", 1)
+                if cached_source == source_json:
+                    encoded.append(fragment)
+                    continue
+            fragment = encode_json(build(key, source))
+            stored[cache_key] = source_json + b"\n" + fragment
+            encoded.append(fragment)
+        self.hits += len(encoded) - len(stored)
+        self.misses += len(stored)
+        if stored:
+            self.backend.set_many(stored, self.ttl)
+        return encoded
+
+    def stats(self):
+        """
+        Returns a dict of the statistics of the cache: hits and misses of this process.
+        """
+        return {"hits": self.hits, "misses": self.misses}
+
+
+def cached_response(tags):
+    """
+    Decorator of the get method of a resource that serves the response from the ResponseCache of the app
+    when it is there, answering conditional requests with 304 from the cached ETag, and caches responses
+    with status 200 otherwise.
+    Parameters:
+    - tags: function of the arguments of the method that returns the tags of the response
+    """
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            cache = response_cache()
+            #bodies link relative to the root of the app, which may be mounted at different paths
+            key = request.script_root + request.full_path
+            entry = cache.get(key)
+            if entry is not None:
+                if entry["etag"] is not None and request.if_none_match.contains_weak(entry["etag"]):
+                    response = Response(status=304)
+                else:
+                    response = Response(entry["body"], 200, mimetype=entry["mimetype"])
+                if entry["etag"] is not None:
+                    response.set_etag(entry["etag"])
+                return response
+            versions = cache.versions(tags(*args, **kwargs))
+            response = method(self, *args, **kwargs)
+            if response.status_code == 200 and not response.is_streamed:
+                cache.set(key, response.get_data(), response.get_etag()[0], response.mimetype, versions)
+            return response
+        return wrapper
+    return decorator
+
+
+def init_app(app):
+    """
+    Creates the cache backend and the caches of an app. Each app has its own, apps on different databases
+    must not share a CACHE_PATH.
+    """
+    backend = create_backend(app)
+    app.extensions["cache_backend"] = backend
+    app.extensions["lookup_cache"] = LookupCache(
+        {"category": Category, "ethnicity": Ethnicity}, app.config["LOOKUP_CACHE_MAX_AGE"], backend
+    )
+    app.extensions["response_cache"] = ResponseCache(backend, app.config["RESPONSE_CACHE_TTL"])
+    app.extensions["fragment_cache"] = FragmentCache(backend, app.config["FRAGMENT_CACHE_TTL"])
+
+
+def lookup_cache():
+    """
+    Returns the LookupCache of the current app.
+    """
+    return current_app.extensions["lookup_cache"]
+
+
+def response_cache():
+    """
+    Returns the ResponseCache of the current app.
+    """
+    return current_app.extensions["response_cache"]
+
+
+def fragment_cache():
+    """
+    Returns the FragmentCache of the current app.
+    """
+    return current_app.extensions["fragment_cache"]
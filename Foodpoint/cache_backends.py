@@ -0,0 +1,300 @@
+"""
+Storage backends of the caches of cache.py. A backend stores bytes by key with a time to live and tags,
+and evicts entries by tag. Invalidation works with tag generations: invalidating a tag increments its
+generation in one atomic step, entries remember the generations of their tags from before their value
+was computed, and an entry is only served while they are all current. So a value computed from data
+that was changed meanwhile is never served, even if it is stored after the invalidation.
+
+Backends are selected with config CACHE_BACKEND, either the name of one of BACKENDS or a callable that
+takes the app and returns a backend:
+- memory: cache of the process, every worker has its own
+- sqlite: SQLite file at CACHE_PATH shared by all the processes on a host that use the same file
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from Foodpoint.utils import chunks
+
+
+class CacheBackend(ABC):
+    """
+    Interface of cache backends. Values are bytes, tags are strings. Backends implement the abstract
+    methods, get_many and set_many can be overridden to read or write several values at once.
+    """
+
+    @abstractmethod
+    def get(self, key):
+        """
+        Returns the value of a key, or None if it is not stored, has expired or one of its tags was
+        invalidated after the value was computed.
+        Parameters:
+        - key: String, key of the value
+        """
+
+    def get_many(self, keys):
+        """
+        Returns a list of the values of keys as returned by get, in the same order.
+        Parameters:
+        - keys: list of keys
+        """
+        return [self.get(key) for key in keys]
+
+    @abstractmethod
+    def tag_versions(self, tags):
+        """
+        Returns the current generations of tags, to be read before computing a value and given to set.
+        Parameters:
+        - tags: list of tags
+        """
+
+    @abstractmethod
+    def set(self, key, value, ttl, versions):
+        """
+        Stores a value.
+        Parameters:
+        - key: String, key of the value
+        - value: bytes, value to store
+        - ttl: Float, seconds the value is kept
+        - versions: dict of tag -> generation from tag_versions, read before computing the value
+        """
+
+    def set_many(self, values, ttl):
+        """
+        Stores values without tags.
+        Parameters:
+        - values: dict of key -> value
+        - ttl: Float, seconds the values are kept
+        """
+        for key, value in values.items():
+            self.set(key, value, ttl, {})
+
+    @abstractmethod
+    def invalidate(self, tags):
+        """
+        Makes the values with any of the tags unreachable, atomically for all the tags.
+        Parameters:
+        - tags: list of tags
+        """
+
+    @abstractmethod
+    def stats(self):
+        """
+        Returns a dict of statistics of the backend, at least the number of entries.
+        """
+
+
+class MemoryBackend(CacheBackend):
+    """
+    Backend in the memory of the process, a LRU dict bounded to max_entries.
+    Parameters:
+    - max_entries: Integer, number of values kept, the least recently used ones are evicted first
+    """
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.generations = {}
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires, versions = entry
+            current = all(self.generations.get(tag, 0) == generation for tag, generation in versions.items())
+            if expires <= time.monotonic() or not current:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def tag_versions(self, tags):
+        with self.lock:
+            return dict((tag, self.generations.get(tag, 0)) for tag in tags)
+
+    def set(self, key, value, ttl, versions):
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (value, time.monotonic() + ttl, versions)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, tags):
+        with self.lock:
+            for tag in tags:
+                self.generations[tag] = self.generations.get(tag, 0) + 1
+
+    def stats(self):
+        return {"backend": "memory", "entries": len(self.entries), "evictions": self.evictions}
+
+
+class SQLiteBackend(CacheBackend):
+    """
+    Backend in a SQLite file that every process opening the same file shares. Each thread of each
+    process has its own connection, opened on first use, so the backend can be created before a
+    preforking server forks its workers. The number of entries is brought back to max_entries,
+    dropping the ones closest to expiring, every PRUNE_INTERVAL stores of a process, so it can exceed
+    it by that much in between.
+    Parameters:
+    - path: String, path of the file, created if it doesn't exist
+    - max_entries: Integer, number of values kept
+    """
+    PRUNE_INTERVAL = 100
+
+    SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS cache_entry (key TEXT PRIMARY KEY, value BLOB NOT NULL, "
+        "expires REAL NOT NULL, versions TEXT NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS ix_cache_entry_expires ON cache_entry (expires)",
+        "CREATE TABLE IF NOT EXISTS cache_tag (tag TEXT PRIMARY KEY, generation INTEGER NOT NULL)",
+    )
+
+    def __init__(self, path, max_entries):
+        self.path = path
+        self.max_entries = max_entries
+        self.local = threading.local()
+        self.inherited = []
+        self.sets = 0
+        #the schema is created with a connection of its own, so that no connection is open when a
+        #preforking server forks its workers from the process that created the app
+        connection = self._connect()
+        try:
+            with connection:
+                for statement in self.SCHEMA:
+                    connection.execute(statement)
+        finally:
+            connection.close()
+
+    def _connect(self):
+        connection = sqlite3.connect(self.path, timeout=5)
+        #the cache can be rebuilt, losing the last writes on power failure is fine
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute("PRAGMA synchronous=OFF")
+        return connection
+
+    def _connection(self):
+        connection = getattr(self.local, "connection", None)
+        if connection is not None and self.local.pid != os.getpid():
+            #connections must not be carried across fork, the one of the parent is neither used nor
+            #closed, closing it would checkpoint and delete the WAL file that the parent still uses
+            self.inherited.append(connection)
+            connection = None
+        if connection is None:
+            connection = self._connect()
+            self.local.connection = connection
+            self.local.pid = os.getpid()
+        return connection
+
+    def _generations(self, connection, tags):
+        tags = list(tags)
+        generations = dict((tag, 0) for tag in tags)
+        if tags:
+            generations.update(connection.execute(
+                "SELECT tag, generation FROM cache_tag WHERE tag IN ({})".format(", ".join("?" * len(tags))), tags
+            ).fetchall())
+        return generations
+
+    def get(self, key):
+        connection = self._connection()
+        row = connection.execute("SELECT value, expires, versions FROM cache_entry WHERE key = ?", (key, )).fetchone()
+        if row is None:
+            return None
+        value, expires, versions = row
+        if expires <= time.time():
+            return None
+        versions = json.loads(versions)
+        if self._generations(connection, versions) != versions:
+            return None
+        return value
+
+    def get_many(self, keys):
+        #one query per chunk instead of per key, entries with tags are rare and checked with get
+        values = {}
+        connection = self._connection()
+        now = time.time()
+        for chunk in chunks(keys):
+            rows = connection.execute(
+                "SELECT key, value, versions FROM cache_entry WHERE expires > ? AND key IN ({})".format(
+                    ", ".join("?" * len(chunk))
+                ), [now] + chunk
+            )
+            for key, value, versions in rows:
+                values[key] = value if versions == "{}" else self.get(key)
+        return [values.get(key) for key in keys]
+
+    def tag_versions(self, tags):
+        return self._generations(self._connection(), tags)
+
+    def set(self, key, value, ttl, versions):
+        with self._connection() as connection:
+            connection.execute(
+                "INSERT OR REPLACE INTO cache_entry (key, value, expires, versions) VALUES (?, ?, ?, ?)",
+                (key, value, time.time() + ttl, json.dumps(versions))
+            )
+        self._count_sets(1)
+
+    def set_many(self, values, ttl):
+        expires = time.time() + ttl
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO cache_entry (key, value, expires, versions) VALUES (?, ?, ?, '{}')",
+                [(key, value, expires) for key, value in values.items()]
+            )
+        self._count_sets(len(values))
+
+    def _count_sets(self, count):
+        previous = self.sets
+        self.sets += count
+        if previous // self.PRUNE_INTERVAL != self.sets // self.PRUNE_INTERVAL:
+            self.prune()
+
+    def prune(self):
+        """
+        Deletes the expired entries, and the entries closest to expiring beyond max_entries.
+        """
+        with self._connection() as connection:
+            connection.execute("DELETE FROM cache_entry WHERE expires <= ?", (time.time(), ))
+            connection.execute(
+                "DELETE FROM cache_entry WHERE key IN (SELECT key FROM cache_entry ORDER BY expires DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries, )
+            )
+
+    def invalidate(self, tags):
+        #one transaction, the tags are invalidated together
+        with self._connection() as connection:
+            connection.executemany(
+                "INSERT INTO cache_tag (tag, generation) VALUES (?, 1) "
+                "ON CONFLICT (tag) DO UPDATE SET generation = generation + 1",
+                [(tag, ) for tag in tags]
+            )
+
+    def stats(self):
+        count = self._connection().execute("SELECT count(*) FROM cache_entry").fetchone()[0]
+        return {"backend": "sqlite", "path": self.path, "entries": count}
+
+
+BACKENDS = {
+    "memory": lambda app: MemoryBackend(app.config["CACHE_MAX_ENTRIES"]),
+    "sqlite": lambda app: SQLiteBackend(
+        app.config["CACHE_PATH"] or os.path.join(app.instance_path, "cache.sqlite"), app.config["CACHE_MAX_ENTRIES"]
+    ),
+}
+
+
+def create_backend(app):
+    """
+    Returns the cache backend configured with CACHE_BACKEND for an app.
+    """
+    backend = app.config["CACHE_BACKEND"]
+    if callable(backend):
+        return backend(app)
+    if backend not in BACKENDS:
+        raise ValueError("Unknown CACHE_BACKEND {}, must be one of {} or a callable".format(backend, ", ".join(sorted(BACKENDS))))
+    return BACKENDS[backend](app)
@@ -1,5 +1,6 @@
 import click
 from Foodpoint import db
+from sqlalchemy import and_, column, event, exists, func, inspect, select, table, text
 from flask.cli import with_appcontext
 
 """
@@ -9,10 +10,14 @@ This table contains mapping of recipe and collection that it belongs in.
 Columns:
 - collectionId, INTEGER, PRIMARY KEY, contains id of collection with Foriegn key relation to Collection table
 - recipeId, INTEGER, PRIMARY KEY, contains id of recipe with Foriegn key relation to Recipe table
+Indexes:
+- ix_RecipeCollection_recipeId on (recipeId, collectionId), the primary key only serves lookups by collection,
+  this one serves joins from a recipe to its collections.
 """
 RecipeCollection = db.Table("RecipeCollection",
     db.Column("collectionId", db.Integer, db.ForeignKey("collection.id", ondelete="CASCADE"), primary_key=True),
-    db.Column("recipeId", db.Integer, db.ForeignKey("recipe.id"), primary_key=True)
+    db.Column("recipeId", db.Integer, db.ForeignKey("recipe.id"), primary_key=True),
+    db.Index("ix_RecipeCollection_recipeId", "recipeId", "collectionId")
 )
 
 """
@@ -43,8 +48,20 @@ Columns:
 - rating, FLOAT, Range 0-5, contains rating of the recipe.
 - ethnicityId, INTEGER, NOT NULL, id of ethnicity of this recipe with Foriegn key relation to Ethnicity table.
 - categoryId, INTEGER, NOT NULL, id of category of this recipe with Foriegn key relation to Category table.
+Indexes:
+- ix_recipe_categoryId_rating on (categoryId, rating) and ix_recipe_ethnicityId_rating on (ethnicityId, rating),
+  recipes of a category or ethnicity are read from them already ordered by rating (and id, which SQLite
+  keeps in every index), they also serve the foreign keys.
+- ix_recipe_rating_id on (rating, id), recipes of all categories and ethnicities are read from it in the same
+  order, also when they are narrowed by rating only.
 """
 class Recipe(db.Model):
+    __table_args__ = (
+        db.Index("ix_recipe_categoryId_rating", "categoryId", "rating"),
+        db.Index("ix_recipe_ethnicityId_rating", "ethnicityId", "rating"),
+        db.Index("ix_recipe_rating_id", "rating", "id"),
+    )
+
     id = db.Column(db.Integer, primary_key=True)
     title = db.Column(db.String(30), nullable=False)
     description = db.Column(db.String(200), nullable=False)
@@ -64,7 +81,10 @@ This table contains data about each collection.
 Columns:
 - id, INTEGER, PRIMARY KEY, contains id of each collection.
 - name, STRING, Max Length 40, NOT NULL, contains title or name of the collection.
-- userId, INTEGER, NOT NULL, id of user that create this collection.
+- userId, INTEGER, NOT NULL, INDEXED, id of user that create this collection.
+- recipeCount, INTEGER, NOT NULL, number of recipes in this collection, kept up to date by triggers (see COUNTER_DDL).
+Accessing relationship recipes loads every recipe of the collection, use recipe_query or has_recipe
+when only some of them, a count or a membership check is needed.
 """
 class Collection(db.Model):
     __table_args__ = (db.UniqueConstraint("name", "userId", name="_user_title_uc"), )
@@ -72,11 +92,34 @@ class Collection(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(40), nullable=False)
     description = db.Column(db.String(100))
-    userId = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False)
+    userId = db.Column(db.Integer, db.ForeignKey("user.id", ondelete="CASCADE"), nullable=False, index=True)
+    recipeCount = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     recipes = db.relationship("Recipe", secondary=RecipeCollection, back_populates="collections")
     user = db.relationship("User", back_populates="collections")
 
+    @property
+    def recipe_query(self):
+        """
+        Query of the recipes in this collection that is run in the database instead of loading the
+        relationship, for example collection.recipe_query.count() or collection.recipe_query.filter(...)
+        """
+        return Recipe.query.join(RecipeCollection, RecipeCollection.c.recipeId == Recipe.id).filter(
+            RecipeCollection.c.collectionId == self.id
+        )
+
+    def has_recipe(self, recipe_id):
+        """
+        Check if a recipe is in this collection with an existence query on the primary key of
+        RecipeCollection table, without loading the recipes of the collection.
+        Parameters:
+        - recipe_id: Integer, id of recipe
+        """
+        return db.session.query(exists().where(and_(
+            RecipeCollection.c.collectionId == self.id,
+            RecipeCollection.c.recipeId == recipe_id
+        ))).scalar()
+
 """
 Table Category
 ----------------------
@@ -85,11 +128,13 @@ Columns:
 - id, INTEGER, PRIMARY KEY, contains id of each category.
 - name, STRING, Max Length 40, NOT NULL, contains title or name of the category.
 - description, STRING, Max Length 100, contains description of category
+- recipeCount, INTEGER, NOT NULL, number of recipes of this category, kept up to date by triggers (see COUNTER_DDL).
 """
 class Category(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(40), nullable=False, unique=True)
     description = db.Column(db.String(100))
+    recipeCount = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     recipes = db.relationship("Recipe", back_populates="category")
 
@@ -101,16 +146,248 @@ Columns:
 - id, INTEGER, PRIMARY KEY, contains id of each ethnicity.
 - name, STRING, Max Length 40, NOT NULL, contains title or name of the ethnicity.
 - description, STRING, Max Length 100, contains description of ethnicity
+- recipeCount, INTEGER, NOT NULL, number of recipes of this ethnicity, kept up to date by triggers (see COUNTER_DDL).
 """
 class Ethnicity(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(40), nullable=False, unique=True)
     description = db.Column(db.String(100))
+    recipeCount = db.Column(db.Integer, nullable=False, default=0, server_default="0")
 
     recipes = db.relationship("Recipe", back_populates="ethnicity")
 
+"""
+Table CacheGeneration
+----------------------
+This table contains the generation of the data that processes cache in memory, see cache.py.
+Columns:
+- name, STRING, Max Length 40, PRIMARY KEY, name of the cached data, for example category.
+- generation, INTEGER, NOT NULL, incremented in every transaction that changes the cached data.
+"""
+class CacheGeneration(db.Model):
+    name = db.Column(db.String(40), primary_key=True)
+    generation = db.Column(db.Integer, nullable=False, default=0)
+
+"""
+Table Ingredient
+----------------------
+This table contains the normalized ingredient words found in the ingredients of recipes, see ingredients.py.
+Columns:
+- id, INTEGER, PRIMARY KEY, contains id of each ingredient.
+- name, STRING, Max Length 40, NOT NULL, UNIQUE, contains the normalized (lower case, singular) word.
+"""
+class Ingredient(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(40), nullable=False, unique=True)
+
+"""
+Table RecipeIngredient
+----------------------
+This table is the inverted index of ingredients, the posting list of an ingredient is its rows ordered by
+recipeId, which the primary key keeps sorted. It is written by ingredients.py, not through relationships.
+Columns:
+- ingredientId, INTEGER, PRIMARY KEY, id of ingredient with Foriegn key relation to Ingredient table
+- recipeId, INTEGER, PRIMARY KEY, id of recipe with Foriegn key relation to Recipe table, the rows of a
+  recipe are deleted with it
+Indexes:
+- ix_RecipeIngredient_recipeId on (recipeId), for replacing and deleting the rows of a recipe
+"""
+RecipeIngredient = db.Table("RecipeIngredient",
+    db.Column("ingredientId", db.Integer, db.ForeignKey("ingredient.id", ondelete="CASCADE"), primary_key=True),
+    db.Column("recipeId", db.Integer, db.ForeignKey("recipe.id", ondelete="CASCADE"), primary_key=True),
+    db.Index("ix_RecipeIngredient_recipeId", "recipeId")
+)
+
+"""
+Table recipe_fts
+----------------------
+FTS5 full-text index of the title, description and ingredients of recipes, used by recipe search. It is
+an external content table, the text is not stored twice, only the index, and its rowid is the id of the
+recipe. Triggers on the recipe table keep it in sync on insert, update and delete, also for rows
+written without the ORM such as by import-data. It only exists in SQLite databases.
+"""
+SEARCH_INDEX_DDL = (
+    "CREATE VIRTUAL TABLE IF NOT EXISTS recipe_fts USING fts5("
+    "title, description, ingredients, content='recipe', content_rowid='id')",
+    "CREATE TRIGGER IF NOT EXISTS recipe_fts_insert AFTER INSERT ON recipe BEGIN "
+    "INSERT INTO recipe_fts(rowid, title, description, ingredients) "
+    "VALUES (new.id, new.title, new.description, new.ingredients); END",
+    "CREATE TRIGGER IF NOT EXISTS recipe_fts_delete AFTER DELETE ON recipe BEGIN "
+    "INSERT INTO recipe_fts(recipe_fts, rowid, title, description, ingredients) "
+    "VALUES ('delete', old.id, old.title, old.description, old.ingredients); END",
+    "CREATE TRIGGER IF NOT EXISTS recipe_fts_update AFTER UPDATE OF title, description, ingredients ON recipe BEGIN "
+    "INSERT INTO recipe_fts(recipe_fts, rowid, title, description, ingredients) "
+    "VALUES ('delete', old.id, old.title, old.description, old.ingredients); "
+    "INSERT INTO recipe_fts(rowid, title, description, ingredients) "
+    "VALUES (new.id, new.title, new.description, new.ingredients); END",
+)
+#the index as a lightweight table for joining it in queries, it is not part of the metadata so that
+#create_all and drop_all leave it to the DDL above
+RecipeSearchIndex = table("recipe_fts", column("rowid"), column("title"), column("description"), column("ingredients"))
+
+
+def create_search_index(connection, rebuild=False):
+    """
+    Creates the full-text index of recipes and its triggers if they don't exist yet. Does nothing on
+    databases other than SQLite.
+    Parameters:
+    - connection: Connection, connection to the database
+    - rebuild: Boolean, whether to also index again every recipe already in the database, needed when
+      the index is added to a database that already has recipes
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    for statement in SEARCH_INDEX_DDL:
+        connection.execute(text(statement))
+    if rebuild:
+        connection.execute(text("INSERT INTO recipe_fts(recipe_fts) VALUES ('rebuild')"))
+
+
+@event.listens_for(Recipe.__table__, "after_create")
+def _create_search_index(target, connection, **kw):
+    create_search_index(connection)
+
 
 @click.command("init-db")
 @with_appcontext
 def init_db_command():
     db.create_all()
+
+
+"""
+Counter caches
+----------------------
+Triggers that keep recipeCount of Category, Ethnicity and Collection up to date in the transaction that
+adds, moves or removes recipes, whether it is done through the ORM or with plain SQL such as by
+import-data and the set based inserts of resources.py. Like the full-text index they only exist in
+SQLite databases. flask recount computes the counts again from scratch.
+"""
+COUNTER_DDL = (
+    "CREATE TRIGGER IF NOT EXISTS recipe_count_insert AFTER INSERT ON recipe BEGIN "
+    "UPDATE category SET \"recipeCount\" = \"recipeCount\" + 1 WHERE id = new.\"categoryId\"; "
+    "UPDATE ethnicity SET \"recipeCount\" = \"recipeCount\" + 1 WHERE id = new.\"ethnicityId\"; END",
+    "CREATE TRIGGER IF NOT EXISTS recipe_count_delete AFTER DELETE ON recipe BEGIN "
+    "UPDATE category SET \"recipeCount\" = \"recipeCount\" - 1 WHERE id = old.\"categoryId\"; "
+    "UPDATE ethnicity SET \"recipeCount\" = \"recipeCount\" - 1 WHERE id = old.\"ethnicityId\"; END",
+    "CREATE TRIGGER IF NOT EXISTS recipe_count_category AFTER UPDATE OF \"categoryId\" ON recipe "
+    "WHEN old.\"categoryId\" IS NOT new.\"categoryId\" BEGIN "
+    "UPDATE category SET \"recipeCount\" = \"recipeCount\" - 1 WHERE id = old.\"categoryId\"; "
+    "UPDATE category SET \"recipeCount\" = \"recipeCount\" + 1 WHERE id = new.\"categoryId\"; END",
+    "CREATE TRIGGER IF NOT EXISTS recipe_count_ethnicity AFTER UPDATE OF \"ethnicityId\" ON recipe "
+    "WHEN old.\"ethnicityId\" IS NOT new.\"ethnicityId\" BEGIN "
+    "UPDATE ethnicity SET \"recipeCount\" = \"recipeCount\" - 1 WHERE id = old.\"ethnicityId\"; "
+    "UPDATE ethnicity SET \"recipeCount\" = \"recipeCount\" + 1 WHERE id = new.\"ethnicityId\"; END",
+    "CREATE TRIGGER IF NOT EXISTS collection_count_insert AFTER INSERT ON \"RecipeCollection\" BEGIN "
+    "UPDATE collection SET \"recipeCount\" = \"recipeCount\" + 1 WHERE id = new.\"collectionId\"; END",
+    "CREATE TRIGGER IF NOT EXISTS collection_count_delete AFTER DELETE ON \"RecipeCollection\" BEGIN "
+    "UPDATE collection SET \"recipeCount\" = \"recipeCount\" - 1 WHERE id = old.\"collectionId\"; END",
+)
+
+
+def create_counter_triggers(connection):
+    """
+    Creates the triggers that maintain the recipe counts if they don't exist yet. Does nothing on databases
+    other than SQLite.
+    Parameters:
+    - connection: Connection, connection to the database
+    """
+    if connection.dialect.name != "sqlite":
+        return
+    for statement in COUNTER_DDL:
+        connection.execute(text(statement))
+
+
+#RecipeCollection is created after every table the triggers refer to
+@event.listens_for(RecipeCollection, "after_create")
+def _create_counter_triggers(target, connection, **kw):
+    create_counter_triggers(connection)
+
+
+def recount(connection):
+    """
+    Sets the recipe counts of all categories, ethnicities and collections from the rows they count.
+    Parameters:
+    - connection: Connection, connection to the database
+    """
+    for table, column, counted in (
+        (Category.__table__, Recipe.categoryId, Recipe.__table__),
+        (Ethnicity.__table__, Recipe.ethnicityId, Recipe.__table__),
+        (Collection.__table__, RecipeCollection.c.collectionId, RecipeCollection),
+    ):
+        count = select(func.count()).select_from(counted).where(column == table.c.id).scalar_subquery()
+        connection.execute(table.update().values(recipeCount=count))
+
+
+#indexes of earlier versions that are covered by newer ones, dropped by upgrade-db
+OBSOLETE_INDEXES = {
+    "recipe": ("ix_recipe_categoryId", "ix_recipe_ethnicityId"),
+}
+
+
+@click.command("upgrade-db")
+@with_appcontext
+def upgrade_db_command():
+    """
+    Brings an existing database up to date with the models in place without losing data. Creates the
+    tables that are missing, and the indexes that are missing from existing tables (create_all skips
+    existing tables as a whole, including their indexes and columns), the full-text index of recipes
+    and the triggers of the recipe counts, which are computed when their columns are added. Drops the
+    indexes replaced by newer ones.
+    """
+    db.create_all()
+    inspector = inspect(db.engine)
+    added = False
+    for table in db.metadata.sorted_tables:
+        existing = set(column["name"] for column in inspector.get_columns(table.name))
+        for column in table.columns:
+            if column.name not in existing:
+                _add_column(table, column)
+                added = True
+                click.echo("Added column {} to {}".format(column.name, table.name))
+    with db.engine.begin() as connection:
+        create_counter_triggers(connection)
+        if added:
+            recount(connection)
+    if db.engine.dialect.name == "sqlite" and not inspector.has_table("recipe_fts"):
+        with db.engine.begin() as connection:
+            create_search_index(connection, rebuild=True)
+        click.echo("Created full-text index recipe_fts")
+    for table in db.metadata.sorted_tables:
+        existing = set(index["name"] for index in inspector.get_indexes(table.name))
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(bind=db.engine)
+                click.echo("Created index {} on {}".format(index.name, table.name))
+        for name in OBSOLETE_INDEXES.get(table.name, ()):
+            if name in existing:
+                with db.engine.begin() as connection:
+                    connection.execute(text('DROP INDEX "{}"'.format(name)))
+                click.echo("Dropped index {} on {}".format(name, table.name))
+
+
+def _add_column(table, column):
+    """
+    Adds a column of the model to an existing table with ALTER TABLE. The column must have a server
+    default if it is NOT NULL, so that existing rows get a value.
+    """
+    ddl = 'ALTER TABLE "{}" ADD COLUMN "{}" {}'.format(table.name, column.name, column.type.compile(db.engine.dialect))
+    if column.server_default is not None:
+        ddl += " DEFAULT {}".format(column.server_default.arg)
+    if not column.nullable:
+        ddl += " NOT NULL"
+    with db.engine.begin() as connection:
+        connection.execute(text(ddl))
+
+
+@click.command("recount")
+@with_appcontext
+def recount_command():
+    """
+    Computes the recipe counts of categories, ethnicities and collections again, for example after the
+    database was changed without the triggers that keep them up to date.
+    """
+    with db.engine.begin() as connection:
+        recount(connection)
+    click.echo("Recounted recipes of {} categories, {} ethnicities and {} collections".format(
+        Category.query.count(), Ethnicity.query.count(), Collection.query.count()
+    ))
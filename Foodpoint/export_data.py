@@ -0,0 +1,66 @@
+"""
+Export of the whole database as JSON lines, in the format read by import_data.py so that an export can
+be imported into another database. Rows are read with server side cursors (yield_per) and written one
+line at a time, so memory use doesn't depend on the size of the database.
+"""
+
+import click
+from Foodpoint import db
+from Foodpoint.database import User, Recipe, Collection, Category, Ethnicity, RecipeCollection
+from Foodpoint.utils import encode_json
+from flask.cli import with_appcontext
+
+#number of rows fetched from the database at a time
+EXPORT_CHUNK_SIZE = 1000
+
+
+def export_records():
+    """
+    Generator of all the records in the database as dicts, parents before the records that refer to them:
+    users, categories, ethnicities, collections, recipes and the mapping of recipes to collections.
+    """
+    for name, userName in db.session.query(User.name, User.userName).order_by(User.id).yield_per(EXPORT_CHUNK_SIZE):
+        yield {"type": "user", "name": name, "userName": userName}
+    for kind, model in (("category", Category), ("ethnicity", Ethnicity)):
+        query = db.session.query(model.name, model.description).order_by(model.id)
+        for name, description in query.yield_per(EXPORT_CHUNK_SIZE):
+            yield {"type": kind, "name": name, "description": description}
+    query = db.session.query(Collection.id, Collection.name, Collection.description, User.userName).join(
+        User, User.id == Collection.userId
+    ).order_by(Collection.id)
+    for collection_id, name, description, userName in query.yield_per(EXPORT_CHUNK_SIZE):
+        yield {"type": "collection", "id": collection_id, "name": name, "description": description, "user": userName}
+    query = db.session.query(
+        Recipe.id, Recipe.title, Recipe.description, Recipe.ingredients, Recipe.rating, Category.name, Ethnicity.name
+    ).join(Category, Category.id == Recipe.categoryId).join(Ethnicity, Ethnicity.id == Recipe.ethnicityId).order_by(Recipe.id)
+    for recipe_id, title, description, ingredients, rating, category, ethnicity in query.yield_per(EXPORT_CHUNK_SIZE):
+        yield {
+            "type": "recipe", "id": recipe_id, "title": title, "description": description,
+            "ingredients": ingredients, "rating": rating, "category": category, "ethnicity": ethnicity
+        }
+    query = db.session.query(RecipeCollection.c.recipeId, RecipeCollection.c.collectionId)
+    for recipe_id, collection_id in query.yield_per(EXPORT_CHUNK_SIZE):
+        yield {"type": "recipe-collection", "recipe": recipe_id, "collection": collection_id}
+
+
+def export_lines():
+    """
+    Generator of the records of export_records encoded as lines of JSON, as bytes.
+    """
+    for record in export_records():
+        yield encode_json(record) + b"\n"
+
+
+@click.command("export-data")
+@click.argument("output", type=click.File("wb"), default="-")
+@with_appcontext
+def export_data_command(output):
+    """
+    Exports the database configured in the app as JSON lines to the file OUTPUT, or to standard output
+    if OUTPUT is not given. The result can be loaded into another database with flask import-data.
+    """
+    count = 0
+    for line in export_lines():
+        output.write(line)
+        count += 1
+    click.echo("Exported {} records".format(count), err=True)
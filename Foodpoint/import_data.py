@@ -0,0 +1,333 @@
+"""
+Bulk import of data from JSON lines or CSV files. Unlike the functions of populate_db.py that insert
+and commit one row at a time, rows are collected into batches that are inserted with executemany and
+committed together, and foreign keys are resolved from in-memory maps instead of a query per row.
+
+Each record is one of the following kinds, with these fields (fields in brackets are optional):
+- user: name, userName
+- category: name, [description]
+- ethnicity: name, [description]
+- collection: name, user (userName of owner), [description], [id]
+- recipe: title, description, ingredients, category (name), ethnicity (name), [rating], [id],
+  [user and collection, name of a collection of that user to add the recipe into]
+- recipe-collection: recipe (id), collection (id)
+The optional id of collections and recipes is the id they had in the source of the data, for example
+an export of another database. It is only used to resolve recipe-collection records of the same file, the
+imported rows get new ids from the database.
+"""
+
+import csv
+import json
+import time
+import click
+from Foodpoint import db
+from Foodpoint.database import User, Recipe, Collection, Category, Ethnicity, RecipeCollection
+from Foodpoint.ingredients import index_ingredients
+from flask.cli import with_appcontext
+from sqlalchemy.exc import IntegrityError
+
+KINDS = ("user", "category", "ethnicity", "collection", "recipe", "recipe-collection")
+REQUIRED_FIELDS = {
+    "user": ("name", "userName"),
+    "category": ("name",),
+    "ethnicity": ("name",),
+    "collection": ("name", "user"),
+    "recipe": ("title", "description", "ingredients", "category", "ethnicity"),
+    "recipe-collection": ("recipe", "collection"),
+}
+
+
+class NewId(object):
+    """
+    Id of an imported row that is not known until the row is inserted and the database assigns it.
+    Records referring to the row are resolved to this object, which holds None until then and also if
+    inserting the row failed.
+    """
+
+    __slots__ = ("value", )
+
+    def __init__(self):
+        self.value = None
+
+
+class Importer(object):
+    """
+    Collects imported records into batches and inserts them. The ids of new rows are assigned by the
+    database and read back with RETURNING, so imports can run while the API is writing to the same
+    tables. References to rows that are not inserted yet are kept as NewId until the batch is flushed.
+    """
+
+    def __init__(self, batch_size):
+        self.batch_size = batch_size
+        self.users = dict(db.session.query(User.userName, User.id))
+        self.categories = dict(db.session.query(Category.name, Category.id))
+        self.ethnicities = dict(db.session.query(Ethnicity.name, Ethnicity.id))
+        self.collections = dict(
+            ((user_id, name), collection_id)
+            for collection_id, user_id, name in db.session.query(Collection.id, Collection.userId, Collection.name)
+        )
+        #ids in the source data mapped to ids of imported rows
+        self.source_collections = {}
+        self.source_recipes = {}
+        self.batches = dict((kind, []) for kind in KINDS)
+        self.pending = 0
+        self.imported = 0
+        self.failed = 0
+
+    def _add_row(self, kind, line, row, new_id=None):
+        self.batches[kind].append((line, row, new_id))
+        self.pending += 1
+
+    def add(self, record, line):
+        """
+        Validates a record, resolves its references and adds the rows it creates to the batch. Returns
+        True when the batch is full and should be flushed. Raises ValueError if the record is invalid.
+        Parameters:
+        - record: dict, the record with its kind in field "type"
+        - line: Integer, line number of the record for reporting errors
+        """
+        kind = record.get("type")
+        if kind not in KINDS:
+            raise ValueError("Unknown type {}".format(kind))
+        missing = [field for field in REQUIRED_FIELDS[kind] if record.get(field) in (None, "")]
+        if missing:
+            raise ValueError("Missing {}".format(", ".join(missing)))
+        getattr(self, "_add_" + kind.replace("-", "_"))(record, line)
+        return self.pending >= self.batch_size
+
+    def _add_user(self, record, line):
+        if record["userName"] in self.users:
+            raise ValueError("User {} already exists".format(record["userName"]))
+        user_id = self.users[record["userName"]] = NewId()
+        self._add_row("user", line, {"name": record["name"], "userName": record["userName"]}, user_id)
+
+    def _add_lookup(self, kind, names, record, line):
+        if record["name"] in names:
+            raise ValueError("{} {} already exists".format(kind.capitalize(), record["name"]))
+        row_id = names[record["name"]] = NewId()
+        self._add_row(kind, line, {"name": record["name"], "description": record.get("description")}, row_id)
+
+    def _add_category(self, record, line):
+        self._add_lookup("category", self.categories, record, line)
+
+    def _add_ethnicity(self, record, line):
+        self._add_lookup("ethnicity", self.ethnicities, record, line)
+
+    def _add_collection(self, record, line):
+        user_id = self.users.get(record["user"])
+        if user_id is None:
+            raise ValueError("User {} does not exist".format(record["user"]))
+        if (user_id, record["name"]) in self.collections:
+            raise ValueError("Collection {} of user {} already exists".format(record["name"], record["user"]))
+        collection_id = self.collections[(user_id, record["name"])] = NewId()
+        if record.get("id") is not None:
+            self.source_collections[record["id"]] = collection_id
+        self._add_row("collection", line, {
+            "name": record["name"], "description": record.get("description"), "userId": user_id
+        }, collection_id)
+
+    def _add_recipe(self, record, line):
+        category_id = self.categories.get(record["category"])
+        if category_id is None:
+            raise ValueError("Category {} does not exist".format(record["category"]))
+        ethnicity_id = self.ethnicities.get(record["ethnicity"])
+        if ethnicity_id is None:
+            raise ValueError("Ethnicity {} does not exist".format(record["ethnicity"]))
+        rating = record.get("rating")
+        if rating in (None, ""):
+            rating = None
+        else:
+            try:
+                rating = float(rating)
+            except ValueError:
+                raise ValueError("Rating {} is not a number".format(rating))
+        collection_id = None
+        if record.get("collection"):
+            collection_id = self.collections.get((self.users.get(record.get("user")), record["collection"]))
+            if collection_id is None:
+                raise ValueError("Collection {} of user {} does not exist".format(record["collection"], record.get("user")))
+        recipe_id = NewId()
+        if record.get("id") is not None:
+            self.source_recipes[record["id"]] = recipe_id
+        self._add_row("recipe", line, {
+            "title": record["title"], "description": record["description"],
+            "ingredients": record["ingredients"], "rating": rating,
+            "categoryId": category_id, "ethnicityId": ethnicity_id
+        }, recipe_id)
+        if collection_id is not None:
+            self._add_row("recipe-collection", line, {"collectionId": collection_id, "recipeId": recipe_id})
+
+    def _add_recipe_collection(self, record, line):
+        recipe_id = self.source_recipes.get(record["recipe"])
+        collection_id = self.source_collections.get(record["collection"])
+        if recipe_id is None or collection_id is None:
+            raise ValueError("Recipe {} or collection {} was not imported".format(record["recipe"], record["collection"]))
+        self._add_row("recipe-collection", line, {"collectionId": collection_id, "recipeId": recipe_id})
+
+    def _resolved(self, kind, failures):
+        """
+        Returns the (line, row, new id) of a kind in the batch with the NewId references of the rows
+        replaced by their values. Rows referring to a row that failed to insert are added to failures
+        instead.
+        """
+        resolved = []
+        for line, row, new_id in self.batches[kind]:
+            if any(isinstance(value, NewId) and value.value is None for value in row.values()):
+                failures.append((line, "Refers to a row that was not imported"))
+                continue
+            row = dict(
+                (field, value.value if isinstance(value, NewId) else value) for field, value in row.items()
+            )
+            resolved.append((line, row, new_id))
+        return resolved
+
+    def _insert(self, kind, rows):
+        """
+        Inserts resolved rows of a kind with one statement and sets their NewId to the ids assigned by
+        the database. The ingredients of recipes are indexed in the same transaction.
+        """
+        values = [row for line, row, new_id in rows]
+        if kind == "recipe-collection":
+            db.session.execute(RecipeCollection.insert(), values)
+            return
+        table = _table(kind)
+        #SQLite gives the rows of an insert increasing ids in the order of the values but returns them in
+        #no guaranteed order, so they are sorted to pair them with the rows. Asking SQLAlchemy to keep the
+        #order would make it insert one row per statement.
+        row_ids = sorted(db.session.execute(table.insert().returning(table.c.id), values).scalars())
+        for (line, row, new_id), row_id in zip(rows, row_ids):
+            new_id.value = row_id
+        if kind == "recipe":
+            index_ingredients(db.session.connection(), [
+                (new_id.value, row["ingredients"]) for line, row, new_id in rows
+            ])
+
+    def flush(self):
+        """
+        Inserts the rows of the batch in one transaction, parents before children so that the ids of
+        parents are known when their children are inserted. If the batch fails as a whole, it is inserted
+        again one row at a time, each in its own savepoint, so that only the failing rows and the rows
+        referring to them are lost. Returns a list of (line, error) of the rows that failed.
+        """
+        failures = []
+        try:
+            for kind in KINDS:
+                rows = self._resolved(kind, failures)
+                if rows:
+                    self._insert(kind, rows)
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+            failures = []
+            #ids read back before the rollback don't exist anymore
+            for kind in KINDS:
+                for line, row, new_id in self.batches[kind]:
+                    if new_id is not None:
+                        new_id.value = None
+            for kind in KINDS:
+                for line, row, new_id in self._resolved(kind, failures):
+                    savepoint = db.session.begin_nested()
+                    try:
+                        self._insert(kind, [(line, row, new_id)])
+                        savepoint.commit()
+                    except IntegrityError as e:
+                        savepoint.rollback()
+                        if new_id is not None:
+                            new_id.value = None
+                        failures.append((line, str(e.orig)))
+            db.session.commit()
+        self.imported += self.pending - len(failures)
+        self.failed += len(failures)
+        self.batches = dict((kind, []) for kind in KINDS)
+        self.pending = 0
+        return failures
+
+
+def _table(kind):
+    """
+    Returns the table rows of a kind of record are inserted into.
+    """
+    if kind == "recipe-collection":
+        return RecipeCollection
+    return {
+        "user": User, "category": Category, "ethnicity": Ethnicity, "collection": Collection, "recipe": Recipe
+    }[kind].__table__
+
+
+def read_records(stream, data_format, kind=None):
+    """
+    Generator of (line number, record) read one at a time from a JSON lines or CSV stream. Records of CSV
+    files and records without field "type" get the given kind. A record that can't be parsed is given
+    as (line number, ValueError).
+    Parameters:
+    - stream: file object opened in text mode
+    - data_format: String, "jsonl" or "csv"
+    - kind: String, kind of records that don't say their own type
+    """
+    if data_format == "csv":
+        reader = csv.DictReader(stream)
+        for record in reader:
+            record.setdefault("type", kind)
+            yield reader.line_num, record
+        return
+    for line, text in enumerate(stream, 1):
+        if not text.strip():
+            continue
+        try:
+            record = json.loads(text)
+            if not isinstance(record, dict):
+                raise ValueError("Record must be a JSON object")
+        except ValueError as e:
+            yield line, ValueError("Invalid JSON: {}".format(e))
+            continue
+        if record.get("type") is None:
+            record["type"] = kind
+        yield line, record
+
+
+@click.command("import-data")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "data_format", type=click.Choice(["jsonl", "csv"]),
+              help="Format of the file, by default csv for .csv files and jsonl otherwise.")
+@click.option("--kind", type=click.Choice(KINDS), help="Kind of records that don't have field type, required for csv.")
+@click.option("--batch-size", default=5000, show_default=True, help="Number of rows inserted per transaction.")
+@with_appcontext
+def import_data_command(path, data_format, kind, batch_size):
+    """
+    Imports users, categories, ethnicities, collections and recipes from a JSON lines or CSV file at
+    PATH into the database configured in the app. The file is streamed so it can be of any size. Records
+    that fail are reported with their line number and skipped, the rest of the file is still imported.
+    """
+    if data_format is None:
+        data_format = "csv" if path.lower().endswith(".csv") else "jsonl"
+    if data_format == "csv" and kind is None:
+        raise click.UsageError("--kind is required for csv files")
+
+    importer = Importer(batch_size)
+    start = time.time()
+
+    def report(failures):
+        for line, error in failures:
+            click.echo("line {}: {}".format(line, error), err=True)
+
+    with open(path, newline="", encoding="utf-8") as stream:
+        for line, record in read_records(stream, data_format, kind):
+            if isinstance(record, ValueError):
+                importer.failed += 1
+                report([(line, record)])
+                continue
+            try:
+                full = importer.add(record, line)
+            except ValueError as e:
+                importer.failed += 1
+                report([(line, e)])
+                continue
+            if full:
+                report(importer.flush())
+                elapsed = time.time() - start
+                click.echo("{} rows imported ({:.0f} rows/sec)".format(importer.imported, importer.imported / elapsed))
+    report(importer.flush())
+    elapsed = time.time() - start
+    click.echo("Imported {} rows in {:.1f} s ({:.0f} rows/sec), {} failed".format(
+        importer.imported, elapsed, importer.imported / elapsed if elapsed else 0, importer.failed
+    ))
@@ -0,0 +1,195 @@
+"""
+Inverted index of the ingredients of recipes. The free text of Recipe.ingredients is split into
+normalized ingredient words that are stored in the Ingredient table, and the recipes of each word in the
+RecipeIngredient table, the posting list of the word. The index is updated whenever recipes are written
+through the ORM (see _index_flushed_recipes) and by import-data, and can be filled for existing recipes
+with flask index-ingredients.
+
+Queries for recipes with some ingredients read the posting lists of the ingredients in order of recipe
+id and merge them, so only the rows of the wanted ingredients are read instead of every recipe.
+"""
+
+import heapq
+import re
+import click
+from Foodpoint import db
+from Foodpoint.database import Recipe, Ingredient, RecipeIngredient
+from Foodpoint.utils import chunks
+from flask.cli import with_appcontext
+from sqlalchemy import event, exists, inspect, select
+
+#words that are not ingredients: fillers, preparation and units of measure
+STOPWORDS = frozenset("""
+a an and or of the to with without for in on into at some any more less other optional taste
+fresh chopped sliced diced minced grated ground crushed peeled cooked raw whole half large small medium
+cup tbsp tsp tablespoon teaspoon g kg mg ml dl l oz lb pound gram pinch piece slice clove handful
+""".split())
+
+#words are runs of letters, numbers are quantities and don't count
+WORD = re.compile(r"[^\W\d_]+")
+
+
+def singular(word):
+    """
+    Returns a naive singular form of an English plural, so that "tomatoes" finds "tomato". Words that only
+    look plural (ending in ss, us or is) are kept as they are.
+    Parameters:
+    - word: String, lower case word
+    """
+    if len(word) > 4 and word.endswith("ies"):
+        return word[:-3] + "y"
+    if len(word) > 4 and word.endswith(("ches", "shes", "sses", "xes", "oes")):
+        return word[:-2]
+    if len(word) > 3 and word.endswith("s") and not word.endswith(("ss", "us", "is")):
+        return word[:-1]
+    return word
+
+
+def tokenize_ingredients(text):
+    """
+    Returns the set of normalized ingredient words of a text: lower case, singular, without stopwords
+    and without words too long to be stored.
+    Parameters:
+    - text: String, ingredients of a recipe or of a query, None gives no words
+    """
+    words = set()
+    for word in WORD.findall((text or "").lower()):
+        word = singular(word)
+        if len(word) > 1 and len(word) <= 40 and word not in STOPWORDS:
+            words.add(word)
+    return words
+
+
+def index_ingredients(connection, recipes):
+    """
+    Replaces the index entries of recipes with the words of their ingredients, creating the ingredients
+    that don't exist yet. Runs a fixed number of statements for any number of recipes.
+    Parameters:
+    - connection: Connection, connection of the transaction that writes the recipes
+    - recipes: list of (recipe id, ingredients text)
+    """
+    words = dict((recipe_id, tokenize_ingredients(text)) for recipe_id, text in recipes)
+    if not words:
+        return
+    names = sorted(set().union(*words.values()))
+    ids = {}
+    if names:
+        connection.execute(Ingredient.__table__.insert().prefix_with("OR IGNORE"), [{"name": name} for name in names])
+        for chunk in chunks(names):
+            ids.update(connection.execute(select(Ingredient.name, Ingredient.id).where(Ingredient.name.in_(chunk))).all())
+    for chunk in chunks(list(words)):
+        connection.execute(RecipeIngredient.delete().where(RecipeIngredient.c.recipeId.in_(chunk)))
+    rows = [
+        {"ingredientId": ids[name], "recipeId": recipe_id}
+        for recipe_id, recipe_words in words.items() for name in recipe_words
+    ]
+    if rows:
+        connection.execute(RecipeIngredient.insert(), rows)
+
+
+@event.listens_for(db.session, "after_flush")
+def _index_flushed_recipes(session, flush_context):
+    """
+    Indexes the recipes added in a flush, and the ones whose ingredients were changed, in the same
+    transaction. Rows of deleted recipes are removed by the database (ON DELETE CASCADE).
+    """
+    recipes = [obj for obj in session.new if isinstance(obj, Recipe)]
+    recipes.extend(
+        obj for obj in session.dirty
+        if isinstance(obj, Recipe) and inspect(obj).attrs.ingredients.history.has_changes()
+    )
+    if recipes:
+        index_ingredients(session.connection(), [(recipe.id, recipe.ingredients) for recipe in recipes])
+
+
+def posting_list(ingredient_id, after=None, before=None, chunk_size=1000):
+    """
+    Generator of the ids of the recipes with an ingredient in ascending order, or in descending order
+    as negative numbers when before is given, so that posting lists can always be merged in ascending
+    order. The rows are read from the primary key index a chunk at a time.
+    Parameters:
+    - ingredient_id: Integer, id of ingredient
+    - after: Integer, only ids greater than this
+    - before: Integer, only ids smaller than this, in descending order
+    - chunk_size: Integer, number of ids read at a time
+    """
+    query = db.session.query(RecipeIngredient.c.recipeId).filter(RecipeIngredient.c.ingredientId == ingredient_id)
+    if before is not None:
+        query = query.filter(RecipeIngredient.c.recipeId < before).order_by(RecipeIngredient.c.recipeId.desc())
+        sign = -1
+    else:
+        if after is not None:
+            query = query.filter(RecipeIngredient.c.recipeId > after)
+        query = query.order_by(RecipeIngredient.c.recipeId)
+        sign = 1
+    for (recipe_id, ) in query.yield_per(chunk_size):
+        yield sign * recipe_id
+
+
+def intersect(postings):
+    """
+    Generator of the values found in all of the ascending iterators, in ascending order. Each step
+    advances the iterators that are behind the largest current value, so it stops as soon as any of
+    them ends.
+    Parameters:
+    - postings: list of iterators of ascending unique values
+    """
+    if not postings:
+        return
+    postings = [iter(posting) for posting in postings]
+    try:
+        current = [next(posting) for posting in postings]
+        while True:
+            largest = max(current)
+            if all(value == largest for value in current):
+                yield largest
+                current = [next(posting) for posting in postings]
+                continue
+            for i, posting in enumerate(postings):
+                while current[i] < largest:
+                    current[i] = next(posting)
+    except StopIteration:
+        return
+
+
+def union(postings):
+    """
+    Generator of the values found in any of the ascending iterators, in ascending order and without
+    repeats.
+    Parameters:
+    - postings: list of iterators of ascending unique values
+    """
+    previous = None
+    for value in heapq.merge(*postings):
+        if value != previous:
+            yield value
+            previous = value
+
+
+@click.command("index-ingredients")
+@click.option("--batch-size", default=1000, show_default=True, help="Number of recipes indexed per transaction.")
+@with_appcontext
+def index_ingredients_command(batch_size):
+    """
+    Indexes the ingredients of every recipe in the database configured in the app, for example recipes
+    created before the index existed, and removes ingredients that no recipe has anymore.
+    """
+    count = 0
+    last_id = 0
+    while True:
+        recipes = db.session.query(Recipe.id, Recipe.ingredients).filter(
+            Recipe.id > last_id
+        ).order_by(Recipe.id).limit(batch_size).all()
+        if not recipes:
+            break
+        index_ingredients(db.session.connection(), recipes)
+        db.session.commit()
+        count += len(recipes)
+        last_id = recipes[-1][0]
+    db.session.execute(Ingredient.__table__.delete().where(
+        ~exists().where(RecipeIngredient.c.ingredientId == Ingredient.id)
+    ))
+    db.session.commit()
+    click.echo("Indexed ingredients of {} recipes, {} ingredients in total".format(
+        count, db.session.query(Ingredient).count()
+    ))
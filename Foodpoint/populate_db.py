@@ -2,16 +2,7 @@ from Foodpoint import db
 from Foodpoint.database import User, Recipe, Collection, Category, Ethnicity
 import click
 from flask.cli import with_appcontext
-from sqlalchemy.engine import Engine
 from sqlalchemy.exc import IntegrityError, StatementError
-from sqlalchemy import event
-
-#Enforce Foreign key, This function is adapted from Exercise 1
-@event.listens_for(Engine, "connect")
-def set_sqlite_pragma(dbapi_connection, connection_record):
-    cursor = dbapi_connection.cursor()
-    cursor.execute("PRAGMA foreign_keys=ON")
-    cursor.close()
 
 def add_user(name, username):
     """
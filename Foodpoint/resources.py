@@ -1,21 +1,28 @@
 from flask_restful import Resource
-from flask import Response, request
-from jsonschema import validate, ValidationError
+from flask import Response, request, stream_with_context
+from jsonschema import ValidationError
+from sqlalchemy import and_, func, literal, literal_column
 from sqlalchemy.exc import IntegrityError
-from Foodpoint.database import User,Collection,Recipe,Category,Ethnicity
-from Foodpoint.utils import MasonBuilder, create_error_response
+from Foodpoint.database import User,Collection,Recipe,Category,Ethnicity,RecipeCollection,RecipeSearchIndex,Ingredient
+from Foodpoint.ingredients import tokenize_ingredients, posting_list, intersect, union
+from Foodpoint.utils import MasonBuilder, create_error_response, get_page_args, keyset_paginate
+from Foodpoint.utils import compute_etag, not_modified_response, validate_json, check_admin, render_json
+from Foodpoint.utils import is_admin, vary_on_authorization, render_json_stream, PageStream, MAX_PAGE_SIZE, MAX_STREAM_PAGE_SIZE
+from Foodpoint.utils import Page, encode_cursor, decode_cursor
+from Foodpoint.export_data import export_lines
+from Foodpoint.cache import lookup_cache, response_cache, fragment_cache, cached_response
 from Foodpoint.utils import MASON, ERROR_PROFILE, USER_PROFILE, LINK_RELATIONS_URL, COLLECTION_PROFILE
-from Foodpoint.utils import CATEGORY_PROFILE, ETHNICITY_PROFILE, RECIPE_PROFILE
+from Foodpoint.utils import CATEGORY_PROFILE, ETHNICITY_PROFILE, RECIPE_PROFILE, MAX_BATCH_SIZE
 from Foodpoint.api import api
 from Foodpoint import db
-import json
+import itertools
+import re
 
 
 class FoodpointBuilder(MasonBuilder):
-    
-"""
-Class for constructing Mason document for Foodpoint related resource
-"""
+    """
+    Class for constructing Mason document for Foodpoint related resource
+    """
 
     @staticmethod
     def user_schema():
@@ -138,15 +145,43 @@ Class for constructing Mason document for Foodpoint related resource
         }
         return schema
 
+    @staticmethod
+    def recipe_batch_schema():
+        '''
+        For validating the request to add many recipes at once,
+        an array of documents that each follow recipe_schema.
+        '''
+        return {
+            "type": "array",
+            "items": FoodpointBuilder.recipe_schema(),
+            "minItems": 1,
+            "maxItems": MAX_BATCH_SIZE
+        }
+
+    @staticmethod
+    def recipe_links_schema():
+        '''
+        For validating the request to add existing recipes to a collection.
+        '''
+        schema = {
+            "type": "object",
+            "required": ["recipes"]
+        }
+        props = schema["properties"] = {}
+        props["recipes"] = {
+            "description": "ids of existing recipes",
+            "type": "array",
+            "items": {"type": "integer"},
+            "minItems": 1,
+            "maxItems": MAX_BATCH_SIZE
+        }
+        return schema
+
     def add_control_all_users(self):
         '''
         Leads to a resource that has a list of all users known to the API.
         '''
-        self.add_control(
-            "fpoint:all-users",
-            href=api.url_for(AllUsers),
-            title="All users"
-        )
+        self.add_control_template("fpoint:all-users", CONTROL_TEMPLATES["all_users"], api.url_for(AllUsers))
 
     def add_control_collections_by(self, user):
         '''
@@ -154,65 +189,38 @@ Class for constructing Mason document for Foodpoint related resource
         Parameters:
          - user: String, string to identify user
         '''
-        self.add_control(
-            "fpoint:collections-by",
-            href=api.url_for(CollectionsByUser, user=user),
-            title="Collections by this user"
-        )
+        self.add_control_template("fpoint:collections-by", CONTROL_TEMPLATES["collections_by"], api.url_for(CollectionsByUser, user=user))
 
     def add_control_add_user(self):
         '''
         To add a user to the AllUsers resource.
         Accessed with POST and includes JSON schema
         '''
-        self.add_control(
-            "fpoint:add-user",
-            href=api.url_for(AllUsers),
-            title="Add a new user",
-            method="POST",
-            encoding="json",
-            schema=self.user_schema()
-        )
+        self.add_control_template("fpoint:add-user", CONTROL_TEMPLATES["add_user"], api.url_for(AllUsers))
 
     def add_control_all_categories(self):
         '''
         Leads to a resource that has a list of all categories of recipe known to the API.
         '''
-        self.add_control(
-            "fpoint:all-categories",
-            href=api.url_for(AllCategories),
-            title="All categories"
-        )
+        self.add_control_template("fpoint:all-categories", CONTROL_TEMPLATES["all_categories"], api.url_for(AllCategories))
 
     def add_control_all_ethnicities(self):
         '''
         Leads to a resource that has a list of all ethnicities of recipe known to the API.
         '''
-        self.add_control(
-            "fpoint:all-ethnicities",
-            href=api.url_for(AllEthnicities),
-            title="All Ethnicities"
-        )
+        self.add_control_template("fpoint:all-ethnicities", CONTROL_TEMPLATES["all_ethnicities"], api.url_for(AllEthnicities))
 
     def add_control_category(self,cat_name):
         '''
         Leads to a resource that represent and contain information of a category of recipe.
         '''
-        self.add_control(
-            "fpoint:category",
-            href=api.url_for(EachCategory, cat_name=cat_name),
-            title="Category of this recipe"
-        )
+        self.add_control_template("fpoint:category", CONTROL_TEMPLATES["category"], api.url_for(EachCategory, cat_name=cat_name))
 
     def add_control_ethnicity(self,eth_name):
         '''
         Leads to a resource that represent and contain information of an ethnicity of recipe.
         '''
-        self.add_control(
-            "fpoint:ethnicity",
-            href=api.url_for(EachEthnicity, eth_name=eth_name),
-            title="Ethnicity of this recipe"
-        )
+        self.add_control_template("fpoint:ethnicity", CONTROL_TEMPLATES["ethnicity"], api.url_for(EachEthnicity, eth_name=eth_name))
 
     def add_control_edit_user(self, user):
         '''
@@ -220,14 +228,7 @@ Class for constructing Mason document for Foodpoint related resource
         Parameters:
          - user: String, string to identify user
         '''
-        self.add_control(
-            "edit",
-            href=api.url_for(EachUser, user=user),
-            title="Edit this user's information",
-            method="PUT",
-            encoding="json",
-            schema=self.user_schema()
-        )
+        self.add_control_template("edit", CONTROL_TEMPLATES["edit_user"], api.url_for(EachUser, user=user))
 
     def add_control_delete_user(self, user):
         '''
@@ -235,12 +236,7 @@ Class for constructing Mason document for Foodpoint related resource
         Parameters:
          - user: String, string to identify user
         '''
-        self.add_control(
-            "fpoint:delete",
-            href=api.url_for(EachUser, user=user),
-            title="Delete this user",
-            method="DELETE"
-        )
+        self.add_control_template("fpoint:delete", CONTROL_TEMPLATES["delete_user"], api.url_for(EachUser, user=user))
 
     def add_control_add_collection(self, user):
         '''
@@ -249,14 +245,7 @@ Class for constructing Mason document for Foodpoint related resource
         Parameters:
          - user: String, string to identify user
         '''
-        self.add_control(
-            "fpoint:add-collection",
-            href=api.url_for(CollectionsByUser, user=user),
-            title="Add new collection for user",
-            method="POST",
-            encoding="json",
-            schema=self.collection_schema()
-        )
+        self.add_control_template("fpoint:add-collection", CONTROL_TEMPLATES["add_collection"], api.url_for(CollectionsByUser, user=user))
 
     def add_control_edit_collection(self, user, col_name):
         '''
@@ -265,14 +254,7 @@ Class for constructing Mason document for Foodpoint related resource
          - user: String, string to identify user
          - col_name: String, string to identify collection
         '''
-        self.add_control(
-            "edit",
-            href=api.url_for(EachCollection, user=user, col_name=col_name),
-            title="Edit this collection information",
-            method="PUT",
-            encoding="json",
-            schema=self.collection_schema()
-        )
+        self.add_control_template("edit", CONTROL_TEMPLATES["edit_collection"], api.url_for(EachCollection, user=user, col_name=col_name))
 
     def add_control_edit_recipe(self, user, col_name, recipe_id):
         '''
@@ -282,14 +264,7 @@ Class for constructing Mason document for Foodpoint related resource
          - col_name: String, string to identify collection
          - recipe_id: Integer, integer to identify recipe
         '''
-        self.add_control(
-            "edit",
-            href=api.url_for(EachRecipe, user=user, col_name=col_name, recipe_id=recipe_id),
-            title="Edit this recipe information",
-            method="PUT",
-            encoding="json",
-            schema=self.recipe_schema()
-        )
+        self.add_control_template("edit", CONTROL_TEMPLATES["edit_recipe"], api.url_for(EachRecipe, user=user, col_name=col_name, recipe_id=recipe_id))
 
     def add_control_delete_collection(self, user, col_name):
         '''
@@ -298,12 +273,7 @@ Class for constructing Mason document for Foodpoint related resource
          - user: String, string to identify user
          - col_name: String, string to identify collection
         '''
-        self.add_control(
-            "fpoint:delete",
-            href=api.url_for(EachCollection, user=user, col_name=col_name),
-            title="Delete this collection",
-            method="DELETE"
-        )
+        self.add_control_template("fpoint:delete", CONTROL_TEMPLATES["delete_collection"], api.url_for(EachCollection, user=user, col_name=col_name))
 
     def add_control_delete_recipe(self, user, col_name, recipe_id):
         '''
@@ -313,12 +283,7 @@ Class for constructing Mason document for Foodpoint related resource
          - col_name: String, string to identify collection
          - recipe_id: Integer, integer to identify recipe
         '''
-        self.add_control(
-            "fpoint:delete",
-            href=api.url_for(EachRecipe, user=user, col_name=col_name, recipe_id=recipe_id),
-            title="Delete this recipe",
-            method="DELETE"
-        )
+        self.add_control_template("fpoint:delete", CONTROL_TEMPLATES["delete_recipe"], api.url_for(EachRecipe, user=user, col_name=col_name, recipe_id=recipe_id))
 
     def add_control_add_recipe(self, user, col_name):
         '''
@@ -328,40 +293,39 @@ Class for constructing Mason document for Foodpoint related resource
          - user: String, string to identify user
          - col_name: String, string to identify collection
         '''
-        self.add_control(
-            "fpoint:add-recipe",
-            href=api.url_for(EachCollection, user=user, col_name=col_name),
-            title="Add new recipe to collection of user",
-            method="POST",
-            encoding="json",
-            schema=self.recipe_schema()
-        )
+        self.add_control_template("fpoint:add-recipe", CONTROL_TEMPLATES["add_recipe"], api.url_for(EachCollection, user=user, col_name=col_name))
+
+    def add_control_add_recipes(self, user, col_name):
+        '''
+        To add many recipes to the collection resource in one request.
+        Accessed with POST and includes JSON schema
+        Parameters:
+         - user: String, string to identify user
+         - col_name: String, string to identify collection
+        '''
+        self.add_control_template("fpoint:add-recipes", CONTROL_TEMPLATES["add_recipes"], api.url_for(RecipeBatch, user=user, col_name=col_name))
+
+    def add_control_link_recipes(self, user, col_name):
+        '''
+        To add existing recipes to the collection resource without copying them.
+        Accessed with POST and includes JSON schema
+        Parameters:
+         - user: String, string to identify user
+         - col_name: String, string to identify collection
+        '''
+        self.add_control_template("fpoint:link-recipes", CONTROL_TEMPLATES["link_recipes"], api.url_for(RecipeLinks, user=user, col_name=col_name))
 
     def add_control_add_category(self):
         '''
         Control For adding category
         '''
-        self.add_control(
-            "fpoint:add-category",
-            href=api.url_for(AllCategories),
-            title="Add a new Category",
-            method="POST",
-            encoding="json",
-            schema=self.category_schema()
-        )
+        self.add_control_template("fpoint:add-category", CONTROL_TEMPLATES["add_category"], api.url_for(AllCategories))
 
     def add_control_add_ethnicity(self):
         '''
         Control For adding ethnicity
         '''
-        self.add_control(
-            "fpoint:add-ethnicity",
-            href=api.url_for(AllEthnicities),
-            title="Add a new Ethnicity",
-            method="POST",
-            encoding="json",
-            schema=self.ethnicity_schema()
-        )
+        self.add_control_template("fpoint:add-ethnicity", CONTROL_TEMPLATES["add_ethnicity"], api.url_for(AllEthnicities))
 
     def add_control_edit_category(self, cat_name):
         '''
@@ -369,14 +333,7 @@ Class for constructing Mason document for Foodpoint related resource
         Parameters:
         - cat_name: String, string to identify category
         '''
-        self.add_control(
-            "edit",
-            href=api.url_for(EachCategory, cat_name=cat_name),
-            title="Edit this category's information",
-            method="PUT",
-            encoding="json",
-            schema=self.category_schema()
-        )
+        self.add_control_template("edit", CONTROL_TEMPLATES["edit_category"], api.url_for(EachCategory, cat_name=cat_name))
 
     def add_control_edit_ethnicity(self, eth_name):
         '''
@@ -384,14 +341,225 @@ Class for constructing Mason document for Foodpoint related resource
         Parameters:
         - eth_name: String, string to identify ethincity
         '''
-        self.add_control(
-            "edit",
-            href=api.url_for(EachEthnicity, eth_name=eth_name),
-            title="Edit this ethnicity's information",
-            method="PUT",
-            encoding="json",
-            schema=self.ethnicity_schema()
-        )
+        self.add_control_template("edit", CONTROL_TEMPLATES["edit_ethnicity"], api.url_for(EachEthnicity, eth_name=eth_name))
+
+    def add_control_all_recipes(self):
+        '''
+        Control of listing recipes of all collections.
+        '''
+        self.add_control_template("fpoint:all-recipes", CONTROL_TEMPLATES["all_recipes"], api.url_for(AllRecipes))
+
+    def add_control_category_recipes(self, cat_name):
+        '''
+        Control of listing recipes of a category.
+        Parameters:
+        - cat_name: String, string to identify category
+        '''
+        self.add_control_template("fpoint:recipes", CONTROL_TEMPLATES["category_recipes"], api.url_for(CategoryRecipes, cat_name=cat_name))
+
+    def add_control_ethnicity_recipes(self, eth_name):
+        '''
+        Control of listing recipes of an ethnicity.
+        Parameters:
+        - eth_name: String, string to identify ethnicity
+        '''
+        self.add_control_template("fpoint:recipes", CONTROL_TEMPLATES["ethnicity_recipes"], api.url_for(EthnicityRecipes, eth_name=eth_name))
+
+    def add_control_search_recipes(self):
+        '''
+        Control of full-text search of recipes, the href is a URI template with the query parameters.
+        '''
+        self.add_control_template("fpoint:search-recipes", CONTROL_TEMPLATES["search_recipes"], api.url_for(RecipeSearch) + "{?q,limit}")
+
+    def add_control_recipes_by_ingredients(self):
+        '''
+        Control of finding recipes by their ingredients, the href is a URI template with the query parameters.
+        '''
+        self.add_control_template("fpoint:recipes-by-ingredients", CONTROL_TEMPLATES["recipes_by_ingredients"], api.url_for(RecipesByIngredients) + "{?ingredients,match,limit}")
+
+    def add_control_pagination(self, page, resource, **kwargs):
+        '''
+        Controls for moving to the previous and next page of a paginated listing.
+        Only added when such a page exists.
+        Parameters:
+        - page: Page, the page this document represents
+        - resource: Resource class of the listing
+        - kwargs: route variables and query parameters that the page links keep
+        '''
+        params = dict((key, value) for key, value in kwargs.items() if value is not None)
+        if page.prev_cursor is not None:
+            self.add_control(
+                "prev",
+                href=api.url_for(resource, before=page.prev_cursor, limit=page.limit, **params),
+                title="Previous page"
+            )
+        if page.next_cursor is not None:
+            self.add_control(
+                "next",
+                href=api.url_for(resource, after=page.next_cursor, limit=page.limit, **params),
+                title="Next page"
+            )
+
+
+"""
+Properties of the controls added by FoodpointBuilder, other than href. They don't depend
+on the request so they are built once at import, including the JSON schemas, and shared
+by all documents through add_control_template.
+"""
+CONTROL_TEMPLATES = {
+    "all_users": {
+        "title": "All users"
+    },
+    "all_recipes": {
+        "title": "All recipes, best rated first"
+    },
+    "category_recipes": {
+        "title": "Recipes of this category, best rated first"
+    },
+    "ethnicity_recipes": {
+        "title": "Recipes of this ethnicity, best rated first"
+    },
+    "search_recipes": {
+        "title": "Search recipes by title, description and ingredients",
+        "isHrefTemplate": True,
+        "schema": {
+            "type": "object",
+            "required": ["q"],
+            "properties": {
+                "q": {
+                    "description": "Words to search for, recipes with all of them are returned best match first",
+                    "type": "string"
+                },
+                "limit": {
+                    "description": "Maximum number of recipes per page",
+                    "type": "integer"
+                }
+            }
+        }
+    },
+    "collections_by": {
+        "title": "Collections by this user"
+    },
+    "add_user": {
+        "title": "Add a new user",
+        "method": "POST",
+        "encoding": "json",
+        "schema": FoodpointBuilder.user_schema()
+    },
+    "recipes_by_ingredients": {
+        "title": "Find recipes by their ingredients",
+        "isHrefTemplate": True,
+        "schema": {
+            "type": "object",
+            "required": ["ingredients"],
+            "properties": {
+                "ingredients": {
+                    "description": "Ingredients separated by commas",
+                    "type": "string"
+                },
+                "match": {
+                    "description": "all for recipes with every ingredient (default), any for recipes with at least one",
+                    "type": "string",
+                    "enum": ["all", "any"]
+                },
+                "limit": {
+                    "description": "Maximum number of recipes per page",
+                    "type": "integer"
+                }
+            }
+        }
+    },
+    "all_categories": {
+        "title": "All categories"
+    },
+    "all_ethnicities": {
+        "title": "All Ethnicities"
+    },
+    "category": {
+        "title": "Category of this recipe"
+    },
+    "ethnicity": {
+        "title": "Ethnicity of this recipe"
+    },
+    "edit_user": {
+        "title": "Edit this user's information",
+        "method": "PUT",
+        "encoding": "json",
+        "schema": FoodpointBuilder.user_schema()
+    },
+    "delete_user": {
+        "title": "Delete this user",
+        "method": "DELETE"
+    },
+    "add_collection": {
+        "title": "Add new collection for user",
+        "method": "POST",
+        "encoding": "json",
+        "schema": FoodpointBuilder.collection_schema()
+    },
+    "edit_collection": {
+        "title": "Edit this collection information",
+        "method": "PUT",
+        "encoding": "json",
+        "schema": FoodpointBuilder.collection_schema()
+    },
+    "edit_recipe": {
+        "title": "Edit this recipe information",
+        "method": "PUT",
+        "encoding": "json",
+        "schema": FoodpointBuilder.recipe_schema()
+    },
+    "delete_collection": {
+        "title": "Delete this collection",
+        "method": "DELETE"
+    },
+    "delete_recipe": {
+        "title": "Delete this recipe",
+        "method": "DELETE"
+    },
+    "add_recipe": {
+        "title": "Add new recipe to collection of user",
+        "method": "POST",
+        "encoding": "json",
+        "schema": FoodpointBuilder.recipe_schema()
+    },
+    "add_recipes": {
+        "title": "Add many new recipes to collection of user",
+        "method": "POST",
+        "encoding": "json",
+        "schema": FoodpointBuilder.recipe_batch_schema()
+    },
+    "link_recipes": {
+        "title": "Add existing recipes to collection of user",
+        "method": "POST",
+        "encoding": "json",
+        "schema": FoodpointBuilder.recipe_links_schema()
+    },
+    "add_category": {
+        "title": "Add a new Category",
+        "method": "POST",
+        "encoding": "json",
+        "schema": FoodpointBuilder.category_schema()
+    },
+    "add_ethnicity": {
+        "title": "Add a new Ethnicity",
+        "method": "POST",
+        "encoding": "json",
+        "schema": FoodpointBuilder.ethnicity_schema()
+    },
+    "edit_category": {
+        "title": "Edit this category's information",
+        "method": "PUT",
+        "encoding": "json",
+        "schema": FoodpointBuilder.category_schema()
+    },
+    "edit_ethnicity": {
+        "title": "Edit this ethnicity's information",
+        "method": "PUT",
+        "encoding": "json",
+        "schema": FoodpointBuilder.ethnicity_schema()
+    }
+}
 
 """
 Resource classes for this api
@@ -402,36 +570,79 @@ class Entry(Resource):
         body = FoodpointBuilder()
         body.add_namespace("fpoint", LINK_RELATIONS_URL)
         body.add_control_all_users()
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        body.add_control_all_recipes()
+        body.add_control_search_recipes()
+        body.add_control_recipes_by_ingredients()
+        return render_json(body)
 
 class AllUsers(Resource):
     """
     Resource class for representing list of all users
     """
+    @vary_on_authorization
     def get(self):
         """
-        Method used to get list of all users (returns a Mason document)
+        Method used to get list of all users (returns a Mason document). The list is
+        paginated by user id, the page is selected with query parameters limit and
+        after/before. Admins may request pages of up to MAX_STREAM_PAGE_SIZE users,
+        which are streamed. Returns 400 if the pagination parameters are invalid.
         """
-        users = User.query.all()
-        all_users = []
-        for user in users:
-            temp = FoodpointBuilder(
-                name=user.name,
-                userName=user.userName
-            )
-            temp.add_control("self", api.url_for(EachUser, user=user.userName))
-            temp.add_control("profile", USER_PROFILE)
-            all_users.append(temp)
-        #create the response body, with the previous list as a field called 'items'
-        body = FoodpointBuilder(
-            items = all_users
+        try:
+            limit, after, before = get_page_args(MAX_STREAM_PAGE_SIZE if is_admin() else MAX_PAGE_SIZE)
+            #plain rows of the columns shown, without loading User objects into the session
+            query = db.session.query(User.id, User.name, User.userName)
+            if limit > MAX_PAGE_SIZE:
+                page = PageStream(query, [User.id], lambda user: [user.id], limit, after, before)
+                items = (AllUsers.item(user.id, (user.name, user.userName)) for user in page)
+                return render_json_stream(FoodpointBuilder(), items, lambda: AllUsers.controls(page))
+            page = keyset_paginate(query, [User.id], lambda user: [user.id], limit, after, before)
+        except ValueError as e:
+            return create_error_response(400, "Invalid pagination parameters", str(e))
+        etag = compute_etag([(user.name, user.userName) for user in page.items], page.prev_cursor, page.next_cursor)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+        all_users = fragment_cache().render(
+            "user", [(user.id, (user.name, user.userName)) for user in page.items], AllUsers.item
         )
+        #create the response body, with the previous list as a field called 'items'
+        body = AllUsers.controls(page)
+        response = Response(body.encode_with_items(all_users), 200, mimetype=MASON)
+        response.set_etag(etag)
+        return response
+
+    @staticmethod
+    def controls(page):
+        """
+        Namespace and controls of a page of the list of users. Returns a FoodpointBuilder.
+        Parameters:
+        - page: Page or PageStream, the page of users
+        """
+        body = FoodpointBuilder()
         body.add_namespace("fpoint", LINK_RELATIONS_URL)
         body.add_control("self", api.url_for(AllUsers))
+        body.add_control_pagination(page, AllUsers)
         body.add_control_add_user()
         body.add_control_all_categories()
         body.add_control_all_ethnicities()
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return body
+
+    @staticmethod
+    def item(user_id, source):
+        """
+        Item of the list of users, see FragmentCache.render. Returns a FoodpointBuilder.
+        Parameters:
+        - user_id: Integer, id of user
+        - source: (name, userName) of user
+        """
+        name, userName = source
+        item = FoodpointBuilder(
+            name=name,
+            userName=userName
+        )
+        item.add_control("self", api.url_for(EachUser, user=userName))
+        item.add_control("profile", USER_PROFILE)
+        return item
 
     def post(self):
         """
@@ -446,7 +657,7 @@ class AllUsers(Resource):
             return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
 
         try:
-            validate(request.json, FoodpointBuilder.user_schema())
+            validate_json(request.json, FoodpointBuilder.user_schema)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -467,6 +678,7 @@ class EachUser(Resource):
     """
     Resource class for representing particular user
     """
+    @cached_response(lambda user: ["user:" + user])
     def get(self, user):
         """
         Return all information of user (returns a Mason document) if found otherwise returns 404
@@ -475,6 +687,10 @@ class EachUser(Resource):
         """
         target = User.query.filter_by(userName=user).first()
         if (target):
+            etag = compute_etag(target.name, target.userName)
+            not_modified = not_modified_response(etag)
+            if not_modified:
+                return not_modified
             body = FoodpointBuilder(
                 name = target.name,
                 userName = target.userName
@@ -486,7 +702,9 @@ class EachUser(Resource):
             body.add_control_collections_by(target.userName)
             body.add_control_edit_user(target.userName)
             body.add_control_delete_user(target.userName)
-            return Response(json.dumps(body), 200, mimetype=MASON)
+            response = render_json(body)
+            response.set_etag(etag)
+            return response
         else:
             return create_error_response(404, "User not found")
 
@@ -503,7 +721,7 @@ class EachUser(Resource):
             return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
 
         try:
-            validate(request.json, FoodpointBuilder.user_schema())
+            validate_json(request.json, FoodpointBuilder.user_schema)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -513,6 +731,7 @@ class EachUser(Resource):
             target.userName = request.json["userName"]
             try:
                 db.session.commit()
+                response_cache().invalidate("user:" + user, "collections:" + user)
                 return Response(status=204)
             except IntegrityError:
                 db.session.rollback()
@@ -530,6 +749,7 @@ class EachUser(Resource):
         if (target):
             db.session.delete(target)
             db.session.commit()
+            response_cache().invalidate("user:" + user, "collections:" + user)
             return Response(status=204)
         else:
             return create_error_response(404, "User not found")
@@ -540,36 +760,57 @@ class CollectionsByUser(Resource):
     '''
     Resource Class for recipe collections of user
     '''
+    @cached_response(lambda user: ["collections:" + user])
     def get(self, user):
         """
         Method used to get list of collection by user (returns a Mason document) if found otherwise returns 404
         Parameters:
         - user: String, name of user
         """
-        finduser = User.query.filter_by(userName=user).first()
-        if finduser is None:
+        user_id = db.session.query(User.id).filter(User.userName == user).scalar()
+        if user_id is None:
             return create_error_response(404, "User not found")
 
-        userCollection = Collection.query.filter_by(userId=finduser.id)
-        user_collection = []
-        for collection in userCollection:
-            temp = FoodpointBuilder(
-                name=collection.name,
-                author=user
-            )
-            temp.add_control("self", api.url_for(EachCollection, user=user, col_name=collection.name))
-            temp.add_control("profile", COLLECTION_PROFILE)
-            user_collection.append(temp)
-        #create the response body, with the previous list as a field called 'items'
-        body = FoodpointBuilder(
-            items=user_collection
+        userCollection = db.session.query(Collection.id, Collection.name, Collection.recipeCount).filter(
+            Collection.userId == user_id
+        ).all()
+        etag = compute_etag([(collection.name, collection.recipeCount) for collection in userCollection])
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+        user_collection = fragment_cache().render(
+            "collection",
+            [(collection.id, (collection.name, user, collection.recipeCount)) for collection in userCollection],
+            CollectionsByUser.item
         )
+        #create the response body, with the previous list as a field called 'items'
+        body = FoodpointBuilder()
         body.add_namespace("fpoint", LINK_RELATIONS_URL)
         #body.add_namespace("profile", COLLECTION_PROFILE)
         body.add_control("self", api.url_for(CollectionsByUser, user=user))
         body.add_control("author",api.url_for(EachUser, user=user))
         body.add_control_add_collection(user)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        response = Response(body.encode_with_items(user_collection), 200, mimetype=MASON)
+        response.set_etag(etag)
+        return response
+
+    @staticmethod
+    def item(collection_id, source):
+        """
+        Item of the list of collections of a user, see FragmentCache.render. Returns a FoodpointBuilder.
+        Parameters:
+        - collection_id: Integer, id of collection
+        - source: (name, userName of author, recipeCount) of collection
+        """
+        name, user, recipeCount = source
+        item = FoodpointBuilder(
+            name=name,
+            author=user,
+            recipeCount=recipeCount
+        )
+        item.add_control("self", api.url_for(EachCollection, user=user, col_name=name))
+        item.add_control("profile", COLLECTION_PROFILE)
+        return item
 
     def post(self, user):
         """
@@ -588,7 +829,7 @@ class CollectionsByUser(Resource):
             return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
 
         try:
-            validate(request.json, FoodpointBuilder.collection_schema())
+            validate_json(request.json, FoodpointBuilder.collection_schema)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -604,6 +845,7 @@ class CollectionsByUser(Resource):
         try:
             db.session.add(collection)
             db.session.commit()
+            response_cache().invalidate("collections:" + user)
             return Response("Success", 201, headers)
         except IntegrityError:
             db.session.rollback()
@@ -614,12 +856,28 @@ class EachCollection(Resource):
     '''
     Resource class for particluar collection
     '''
+    #sort options for recipes of a collection: (columns to order by, descending)
+    SORT_KEYS = {
+        "title": ([Recipe.title, Recipe.id], False),
+        "-title": ([Recipe.title, Recipe.id], True),
+        "rating": ([Recipe.rating, Recipe.id], False),
+        "-rating": ([Recipe.rating, Recipe.id], True),
+    }
+
+    @vary_on_authorization
     def get(self, user, col_name):
         """
-        Method used to get list of all recipes of given collection (returns a Mason document) if found otherwise returns 404
+        Method used to get list of all recipes of given collection (returns a Mason document) if found otherwise returns 404.
+        The list is paginated with limit and after/before, and can be narrowed and ordered with optional query parameters.
+        Returns 400 if any of the query parameters is invalid.
         Parameters:
         - user: String, name of user
         - name: String, name of collection
+        Query parameters:
+        - category: String, only recipes of this category
+        - ethnicity: String, only recipes of this ethnicity
+        - min_rating: Float, only recipes rated at least this
+        - sort: String, one of title, -title, rating, -rating (- for descending), by default recipes are ordered by id
         """
         finduser = User.query.filter_by(userName=user).first()
         if finduser is None:
@@ -627,33 +885,101 @@ class EachCollection(Resource):
         findCol = Collection.query.filter_by(userId=finduser.id, name=col_name).first()
         if findCol is None:
             return create_error_response(404, "Collection not found")
-        #query to be tested- get all recipes with collection name for user
-        #col_recipes = Recipe.query.filter(Collection.collection.any(name=col_name)).all()
-        col_recipes = findCol.recipes
-        recipe_collection = []
-        for collection in col_recipes:
-            temp = FoodpointBuilder(
-                title=collection.title
-            )
-            temp.add_control("self", api.url_for(EachRecipe, user=user, col_name=col_name, recipe_id=collection.id))
-            temp.add_control("profile", RECIPE_PROFILE)
-            recipe_collection.append(temp)
+
+        category = request.args.get("category")
+        ethnicity = request.args.get("ethnicity")
+        min_rating = request.args.get("min_rating")
+        sort = request.args.get("sort")
+        if sort is not None and sort not in self.SORT_KEYS:
+            return create_error_response(400, "Invalid sort", "sort must be one of {}".format(", ".join(sorted(self.SORT_KEYS))))
+        keys, descending = self.SORT_KEYS.get(sort, ([Recipe.id], False))
+
+        #filter and sort in the database on the join table instead of loading findCol.recipes
+        query = findCol.recipe_query
+        if category is not None:
+            query = query.join(Category, Category.id == Recipe.categoryId).filter(Category.name == category)
+        if ethnicity is not None:
+            query = query.join(Ethnicity, Ethnicity.id == Recipe.ethnicityId).filter(Ethnicity.name == ethnicity)
+        if min_rating is not None:
+            try:
+                query = query.filter(Recipe.rating >= float(min_rating))
+            except ValueError:
+                return create_error_response(400, "Invalid min_rating", "min_rating must be a number")
+        params = dict(category=category, ethnicity=ethnicity, min_rating=min_rating, sort=sort)
+        try:
+            limit, after, before = get_page_args(MAX_STREAM_PAGE_SIZE if is_admin() else MAX_PAGE_SIZE)
+            if limit > MAX_PAGE_SIZE:
+                query = query.with_entities(Recipe.id, Recipe.title, Recipe.rating)
+                page = PageStream(query, keys, lambda recipe: [getattr(recipe, key.key) for key in keys],
+                                  limit, after, before, descending)
+                head = FoodpointBuilder(name=col_name, author=user, description=findCol.description)
+                items = (EachCollection.item(None, (recipe.id, recipe.title, user, col_name)) for recipe in page)
+                return render_json_stream(head, items, lambda: EachCollection.controls(page, user, col_name, params))
+            page = keyset_paginate(query, keys, lambda recipe: [getattr(recipe, key.key) for key in keys],
+                                   limit, after, before, descending)
+        except ValueError as e:
+            return create_error_response(400, "Invalid pagination parameters", str(e))
+        etag = compute_etag(findCol.description, [(recipe.id, recipe.title) for recipe in page.items],
+                            page.prev_cursor, page.next_cursor)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+
+        #recipes can be in many collections, items are kept per collection since they link into it
+        recipe_collection = fragment_cache().render(
+            "collection-recipe",
+            [("{}/{}".format(findCol.id, recipe.id), (recipe.id, recipe.title, user, col_name)) for recipe in page.items],
+            EachCollection.item
+        )
         # create the response body, with the previous list as a field called 'items'
         body = FoodpointBuilder(
             name=col_name,
             author=user,
-            description=findCol.description,
-            items=recipe_collection
+            description=findCol.description
         )
+        body.update(EachCollection.controls(page, user, col_name, params))
+        response = Response(body.encode_with_items(recipe_collection), 200, mimetype=MASON)
+        response.set_etag(etag)
+        return response
+
+    @staticmethod
+    def controls(page, user, col_name, params):
+        """
+        Namespace and controls of a page of the recipes of a collection. Returns a FoodpointBuilder.
+        Parameters:
+        - page: Page or PageStream, the page of recipes
+        - user: String, name of user
+        - col_name: String, name of collection
+        - params: dict, query parameters that narrow and order the list, kept by the page links
+        """
+        body = FoodpointBuilder()
         body.add_namespace("fpoint", LINK_RELATIONS_URL)
         body.add_control("profile", COLLECTION_PROFILE)
         body.add_control("self", api.url_for(EachCollection, user=user, col_name=col_name))
-        body.add_control("profile", COLLECTION_PROFILE)
+        body.add_control_pagination(page, EachCollection, user=user, col_name=col_name, **params)
         body.add_control_collections_by(user)
         body.add_control_add_recipe(user, col_name)
+        body.add_control_add_recipes(user, col_name)
+        body.add_control_link_recipes(user, col_name)
         body.add_control_edit_collection(user, col_name)
         body.add_control_delete_collection(user, col_name)
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        return body
+
+    @staticmethod
+    def item(key, source):
+        """
+        Item of the list of recipes of a collection, see FragmentCache.render. Returns a FoodpointBuilder.
+        Parameters:
+        - key: String, id of collection and id of recipe
+        - source: (id, title, userName of author, name of collection) of recipe
+        """
+        recipe_id, title, user, col_name = source
+        item = FoodpointBuilder(
+            title=title
+        )
+        item.add_control("self", api.url_for(EachRecipe, user=user, col_name=col_name, recipe_id=recipe_id))
+        item.add_control("profile", RECIPE_PROFILE)
+        return item
 
     def post(self, user, col_name):
         """
@@ -678,14 +1004,14 @@ class EachCollection(Resource):
         if (request.json == None):
             return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
         try:
-            validate(request.json, FoodpointBuilder.recipe_schema())
+            validate_json(request.json, FoodpointBuilder.recipe_schema)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
-        findcategory = Category.query.filter_by(name=request.json["category"]).first()
-        findethnicity = Ethnicity.query.filter_by(name=request.json["ethnicity"]).first()
-        if findcategory is None:
+        category_id = lookup_cache().get_id("category", request.json["category"])
+        ethnicity_id = lookup_cache().get_id("ethnicity", request.json["ethnicity"])
+        if category_id is None:
             return create_error_response(409, "Category does not exist", "Category {} does not exist.".format(request.json["category"]))
-        if findethnicity is None:
+        if ethnicity_id is None:
             return create_error_response(409, "Ethnicity does not exist", "Ethnicity {} does not exist.".format(request.json["ethnicity"]))
 
         title = request.json["title"]
@@ -696,11 +1022,15 @@ class EachCollection(Resource):
             rating = request.json["rating"]
         except KeyError:
             pass
-        recipe = Recipe(title=title, description=description,ingredients=ingredients,rating=rating,category=findcategory,ethnicity=findethnicity)
-        findCol.recipes.append(recipe)
+        recipe = Recipe(title=title, description=description,ingredients=ingredients,rating=rating,categoryId=category_id,ethnicityId=ethnicity_id)
+        #link the recipe with a row of the join table, appending to findCol.recipes would load all of them
+        db.session.add(recipe)
+        db.session.flush()
+        db.session.execute(RecipeCollection.insert(), {"collectionId": findCol.id, "recipeId": recipe.id})
         headers = {}
 
         db.session.commit()
+        response_cache().invalidate("collections:" + user, "categories", "ethnicities")
         headers["location"] = api.url_for(EachRecipe, user=user, col_name=col_name, recipe_id=recipe.id)
         return Response("Success", 201, headers)
 
@@ -718,7 +1048,7 @@ class EachCollection(Resource):
         if (request.json == None):
             return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
         try:
-            validate(request.json, FoodpointBuilder.collection_schema())
+            validate_json(request.json, FoodpointBuilder.collection_schema)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         finduser = User.query.filter_by(userName=user).first()
@@ -734,6 +1064,7 @@ class EachCollection(Resource):
                 pass
             try:
                 db.session.commit()
+                response_cache().invalidate("collections:" + user)
                 return Response(status=204)
             except IntegrityError:
                 db.session.rollback()
@@ -755,6 +1086,7 @@ class EachCollection(Resource):
         if (target):
             db.session.delete(target)
             db.session.commit()
+            response_cache().invalidate("collections:" + user)
             return Response(status=204)
         else:
             return create_error_response(404, "Collection not found")
@@ -764,16 +1096,29 @@ class AllCategories(Resource):
     """
     Resource class for representing list of all categories
     """
+    @cached_response(lambda: ["categories"])
     def get(self):
         """
-        Method used to get list of all categories (returns a Mason document)
+        Method used to get list of all categories (returns a Mason document). The list
+        is paginated the same way as AllUsers.
         """
-        categories = Category.query.all()
+        try:
+            limit, after, before = get_page_args()
+            query = db.session.query(Category.id, Category.name, Category.description, Category.recipeCount)
+            page = keyset_paginate(query, [Category.id], lambda category: [category.id], limit, after, before)
+        except ValueError as e:
+            return create_error_response(400, "Invalid pagination parameters", str(e))
+        etag = compute_etag([(category.name, category.description, category.recipeCount) for category in page.items],
+                            page.prev_cursor, page.next_cursor)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
         all_categories = []
-        for category in categories:
+        for category in page.items:
             temp = FoodpointBuilder(
                 name=category.name,
-                description=category.description
+                description=category.description,
+                recipeCount=category.recipeCount
             )
             temp.add_control("self", api.url_for(EachCategory, cat_name=category.name))
             temp.add_control("profile", CATEGORY_PROFILE)
@@ -784,9 +1129,12 @@ class AllCategories(Resource):
         )
         body.add_namespace("fpoint", LINK_RELATIONS_URL)
         body.add_control("self", api.url_for(AllCategories))
+        body.add_control_pagination(page, AllCategories)
         body.add_control_add_category()
         body.add_control_all_users()
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        response = render_json(body)
+        response.set_etag(etag)
+        return response
 
     def post(self):
         """
@@ -801,7 +1149,7 @@ class AllCategories(Resource):
             return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
 
         try:
-            validate(request.json, FoodpointBuilder.category_schema())
+            validate_json(request.json, FoodpointBuilder.category_schema)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -814,7 +1162,9 @@ class AllCategories(Resource):
         category = Category(name=name, description=description)
         try:
             db.session.add(category)
+            lookup_cache().invalidate("category")
             db.session.commit()
+            response_cache().invalidate("categories")
             headers = {}
             headers["location"] = api.url_for(EachCategory, cat_name=name)
             return Response("Success", 201, headers)
@@ -835,6 +1185,10 @@ class EachCategory(Resource):
         """
         target = Category.query.filter_by(name=cat_name).first()
         if (target):
+            etag = compute_etag(target.name, target.description)
+            not_modified = not_modified_response(etag)
+            if not_modified:
+                return not_modified
             body = FoodpointBuilder(
                 name=target.name,
                 description=target.description
@@ -844,7 +1198,10 @@ class EachCategory(Resource):
             body.add_control("profile", CATEGORY_PROFILE)
             body.add_control_all_categories()
             body.add_control_edit_category(cat_name)
-            return Response(json.dumps(body), 200, mimetype=MASON)
+            body.add_control_category_recipes(cat_name)
+            response = render_json(body)
+            response.set_etag(etag)
+            return response
         else:
             return create_error_response(404, "Category not found")
 
@@ -862,7 +1219,7 @@ class EachCategory(Resource):
             return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
 
         try:
-            validate(request.json, FoodpointBuilder.category_schema())
+            validate_json(request.json, FoodpointBuilder.category_schema)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -874,7 +1231,9 @@ class EachCategory(Resource):
             except KeyError:
                 pass
             try:
+                lookup_cache().invalidate("category")
                 db.session.commit()
+                response_cache().invalidate("categories")
                 return Response(status=204)
             except IntegrityError:
                 db.session.rollback()
@@ -887,16 +1246,29 @@ class AllEthnicities(Resource):
     """
     Resource class for representing list of all ethnicities
     """
+    @cached_response(lambda: ["ethnicities"])
     def get(self):
         """
-        Method used to get list of all ethnicities (returns a Mason document)
+        Method used to get list of all ethnicities (returns a Mason document). The list
+        is paginated the same way as AllUsers.
         """
-        ethnicities = Ethnicity.query.all()
+        try:
+            limit, after, before = get_page_args()
+            query = db.session.query(Ethnicity.id, Ethnicity.name, Ethnicity.description, Ethnicity.recipeCount)
+            page = keyset_paginate(query, [Ethnicity.id], lambda ethnicity: [ethnicity.id], limit, after, before)
+        except ValueError as e:
+            return create_error_response(400, "Invalid pagination parameters", str(e))
+        etag = compute_etag([(ethnicity.name, ethnicity.description, ethnicity.recipeCount) for ethnicity in page.items],
+                            page.prev_cursor, page.next_cursor)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
         all_ethnicities = []
-        for ethnicity in ethnicities:
+        for ethnicity in page.items:
             temp = FoodpointBuilder(
                 name=ethnicity.name,
-                description=ethnicity.description
+                description=ethnicity.description,
+                recipeCount=ethnicity.recipeCount
             )
             temp.add_control("self", api.url_for(EachEthnicity, eth_name=ethnicity.name))
             temp.add_control("profile", ETHNICITY_PROFILE)
@@ -907,9 +1279,12 @@ class AllEthnicities(Resource):
         )
         body.add_namespace("fpoint", LINK_RELATIONS_URL)
         body.add_control("self", api.url_for(AllEthnicities))
+        body.add_control_pagination(page, AllEthnicities)
         body.add_control_all_users()
         body.add_control_add_ethnicity()
-        return Response(json.dumps(body), 200, mimetype=MASON)
+        response = render_json(body)
+        response.set_etag(etag)
+        return response
 
     def post(self):
         """
@@ -924,7 +1299,7 @@ class AllEthnicities(Resource):
             return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
 
         try:
-            validate(request.json, FoodpointBuilder.ethnicity_schema())
+            validate_json(request.json, FoodpointBuilder.ethnicity_schema)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -937,7 +1312,9 @@ class AllEthnicities(Resource):
         ethnicity = Ethnicity(name=name, description=description)
         try:
             db.session.add(ethnicity)
+            lookup_cache().invalidate("ethnicity")
             db.session.commit()
+            response_cache().invalidate("ethnicities")
             headers = {}
             headers["location"] = api.url_for(EachEthnicity, eth_name=name)
             return Response("Success", 201, headers)
@@ -958,6 +1335,10 @@ class EachEthnicity(Resource):
         """
         target = Ethnicity.query.filter_by(name=eth_name).first()
         if (target):
+            etag = compute_etag(target.name, target.description)
+            not_modified = not_modified_response(etag)
+            if not_modified:
+                return not_modified
             body = FoodpointBuilder(
                 name=target.name,
                 description=target.description
@@ -967,7 +1348,10 @@ class EachEthnicity(Resource):
             body.add_control("profile", ETHNICITY_PROFILE)
             body.add_control_all_ethnicities()
             body.add_control_edit_ethnicity(eth_name)
-            return Response(json.dumps(body), 200, mimetype=MASON)
+            body.add_control_ethnicity_recipes(eth_name)
+            response = render_json(body)
+            response.set_etag(etag)
+            return response
         else:
             return create_error_response(404, "Ethnicity not found")
 
@@ -985,7 +1369,7 @@ class EachEthnicity(Resource):
             return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
 
         try:
-            validate(request.json, FoodpointBuilder.ethnicity_schema())
+            validate_json(request.json, FoodpointBuilder.ethnicity_schema)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
 
@@ -997,7 +1381,9 @@ class EachEthnicity(Resource):
             except KeyError:
                 pass
             try:
+                lookup_cache().invalidate("ethnicity")
                 db.session.commit()
+                response_cache().invalidate("ethnicities")
                 return Response(status=204)
             except IntegrityError:
                 db.session.rollback()
@@ -1007,10 +1393,201 @@ class EachEthnicity(Resource):
 #api.add_resource(EachRecipe, "/users/<user>/collections/<col_name>/<recipe_id>/")
 
 
+class RecipeBatch(Resource):
+    '''
+    Resource class for adding many recipes to a collection at once
+    '''
+    def post(self, user, col_name):
+        """
+        Create new recipes for collection of user from an array of recipe documents. Each recipe is validated on its own,
+        the valid ones are created in a single transaction and the rest are skipped. Returns 201 if all recipes were
+        created and 207 otherwise, with a Mason document that has an item for each recipe of the request, in the same
+        order, holding its status and either the location of the new recipe or an error. Returns 415 if the request
+        didn't have JSON as the content type, 400 if it isn't an array of 1 to MAX_BATCH_SIZE items, 404 if user or
+        collection not found.
+        Parameters:
+        - user: String, name of user
+        - col_name: String, name of collection
+        """
+        finduser = User.query.filter_by(userName=user).first()
+        if finduser is None:
+            return create_error_response(404, "User not found")
+        findCol = Collection.query.filter_by(userId=finduser.id, name=col_name).first()
+        if findCol is None:
+            return create_error_response(404, "Collection not found")
+        if (request.json == None):
+            return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
+        documents = request.json
+        if not isinstance(documents, list) or not 1 <= len(documents) <= MAX_BATCH_SIZE:
+            return create_error_response(400, "Invalid JSON document", "Request must be an array of 1 to {} recipes".format(MAX_BATCH_SIZE))
+
+        items = [FoodpointBuilder() for document in documents]
+        valid = []
+        for item, document in zip(items, documents):
+            try:
+                validate_json(document, FoodpointBuilder.recipe_schema)
+                valid.append((item, document))
+            except ValidationError as e:
+                item["status"] = 400
+                item.add_error("Invalid JSON document", str(e))
+
+        #resolve the names of all the recipes at once, with at most one query per table for the names not cached
+        categories = lookup_cache().get_ids("category", [document["category"] for item, document in valid])
+        ethnicities = lookup_cache().get_ids("ethnicity", [document["ethnicity"] for item, document in valid])
+        created = []
+        for item, document in valid:
+            if document["category"] not in categories:
+                item["status"] = 409
+                item.add_error("Category does not exist", "Category {} does not exist.".format(document["category"]))
+            elif document["ethnicity"] not in ethnicities:
+                item["status"] = 409
+                item.add_error("Ethnicity does not exist", "Ethnicity {} does not exist.".format(document["ethnicity"]))
+            else:
+                recipe = Recipe(
+                    title=document["title"],
+                    description=document["description"],
+                    ingredients=document["ingredients"],
+                    rating=document.get("rating", 0.0),
+                    categoryId=categories[document["category"]],
+                    ethnicityId=ethnicities[document["ethnicity"]]
+                )
+                created.append((item, recipe))
+
+        if created:
+            db.session.add_all([recipe for item, recipe in created])
+            db.session.flush()
+            db.session.execute(RecipeCollection.insert(), [
+                {"collectionId": findCol.id, "recipeId": recipe.id} for item, recipe in created
+            ])
+            db.session.commit()
+            response_cache().invalidate("collections:" + user, "categories", "ethnicities")
+        for item, recipe in created:
+            location = api.url_for(EachRecipe, user=user, col_name=col_name, recipe_id=recipe.id)
+            item["status"] = 201
+            item["location"] = location
+            item.add_control("self", location)
+
+        body = FoodpointBuilder(items=items)
+        body.add_namespace("fpoint", LINK_RELATIONS_URL)
+        body.add_control("collection", api.url_for(EachCollection, user=user, col_name=col_name))
+        status = 201 if len(created) == len(items) else 207
+        return render_json(body, status)
+
+
+class RecipeLinks(Resource):
+    '''
+    Resource class for adding existing recipes to a collection
+    '''
+    def post(self, user, col_name):
+        """
+        Add existing recipes to collection of user by their ids, the recipes are shared with the collections they are
+        already in instead of being copied. Recipes that are already in the collection are ignored. Returns 204 if
+        successful, 415 if the request didn't have JSON as the content type, 400 if the JSON wasn't valid against the
+        schema, 404 if user or collection not found and 409 if some of the recipes don't exist.
+        Parameters:
+        - user: String, name of user
+        - col_name: String, name of collection
+        - recipes: Array of Integer, ids of recipes
+        """
+        finduser = User.query.filter_by(userName=user).first()
+        if finduser is None:
+            return create_error_response(404, "User not found")
+        findCol = Collection.query.filter_by(userId=finduser.id, name=col_name).first()
+        if findCol is None:
+            return create_error_response(404, "Collection not found")
+        if (request.json == None):
+            return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
+        try:
+            validate_json(request.json, FoodpointBuilder.recipe_links_schema)
+        except ValidationError as e:
+            return create_error_response(400, "Invalid JSON document", str(e))
+
+        ids = set(request.json["recipes"])
+        existing = set(recipe_id for recipe_id, in db.session.query(Recipe.id).filter(Recipe.id.in_(ids)))
+        if existing != ids:
+            missing = ", ".join(str(recipe_id) for recipe_id in sorted(ids - existing))
+            return create_error_response(409, "Recipe does not exist", "Recipes {} do not exist.".format(missing))
+        #one INSERT ... SELECT for all the recipes, OR IGNORE skips the ones already in the collection
+        select = db.session.query(literal(findCol.id), Recipe.id).filter(Recipe.id.in_(ids))
+        db.session.execute(
+            RecipeCollection.insert().prefix_with("OR IGNORE").from_select(["collectionId", "recipeId"], select.statement)
+        )
+        db.session.commit()
+        response_cache().invalidate("collections:" + user)
+        return Response(status=204)
+
+
 class EachRecipe(Resource):
     """
     Resource class for representing particular recipe
     """
+    @staticmethod
+    def find(user, col_name, recipe_id):
+        """
+        Looks up a recipe through the user and collection it belongs to, together with the names of its
+        category and ethnicity, in a single query. Returns None if the user doesn't exist, otherwise a row with
+        attributes userId, collectionId, Recipe, category and ethnicity. The collection and recipe are outer
+        joined so collectionId is None if the collection doesn't exist and Recipe is None if the recipe
+        doesn't exist or is not in the collection.
+        Parameters:
+        - user: String, name of user
+        - col_name: String, name of collection
+        - recipe_id: Integer, id of recipe
+        """
+        return db.session.query(
+            User.id.label("userId"), Collection.id.label("collectionId"), Recipe,
+            Category.name.label("category"), Ethnicity.name.label("ethnicity")
+        ).select_from(User).outerjoin(
+            Collection, and_(Collection.userId == User.id, Collection.name == col_name)
+        ).outerjoin(
+            RecipeCollection, and_(RecipeCollection.c.collectionId == Collection.id, RecipeCollection.c.recipeId == recipe_id)
+        ).outerjoin(
+            Recipe, Recipe.id == RecipeCollection.c.recipeId
+        ).outerjoin(
+            Category, Category.id == Recipe.categoryId
+        ).outerjoin(
+            Ethnicity, Ethnicity.id == Recipe.ethnicityId
+        ).filter(User.userName == user).first()
+
+    @staticmethod
+    def first_collections(ids):
+        """
+        Finds one collection of each recipe for linking to recipes found outside of a collection, the
+        one with the smallest id. Returns a dict of recipe id to (userName, collection name), recipes that
+        are in no collection are left out.
+        Parameters:
+        - ids: list of recipe ids
+        """
+        if not ids:
+            return {}
+        first = db.session.query(
+            RecipeCollection.c.recipeId, func.min(RecipeCollection.c.collectionId).label("collectionId")
+        ).filter(RecipeCollection.c.recipeId.in_(ids)).group_by(RecipeCollection.c.recipeId).subquery()
+        query = db.session.query(first.c.recipeId, User.userName, Collection.name).join(
+            Collection, Collection.id == first.c.collectionId
+        ).join(User, User.id == Collection.userId)
+        return dict((recipe_id, (userName, col_name)) for recipe_id, userName, col_name in query)
+
+    @staticmethod
+    def item(recipe_id, title, rating, owner):
+        """
+        Item of a list of recipes from any collection, linking to the recipe in the collection found by
+        first_collections. Returns a FoodpointBuilder.
+        Parameters:
+        - recipe_id: Integer, id of recipe
+        - title: String, title of recipe
+        - rating: Float, rating of recipe
+        - owner: (userName, collection name) from first_collections, None if the recipe is in no collection
+        """
+        item = FoodpointBuilder(
+            title=title,
+            rating=rating
+        )
+        if owner is not None:
+            item.add_control("self", api.url_for(EachRecipe, user=owner[0], col_name=owner[1], recipe_id=recipe_id))
+        item.add_control("profile", RECIPE_PROFILE)
+        return item
+
     def get(self, user, col_name, recipe_id):
         """
         Return all information of recipe (returns a Mason document) if found otherwise returns 404
@@ -1019,34 +1596,37 @@ class EachRecipe(Resource):
         - namae: String, name of collection
         - recipe_id: Integer, id of recipe
         """
-        finduser = User.query.filter_by(userName=user).first()
-        if finduser is None:
+        found = EachRecipe.find(user, col_name, recipe_id)
+        if found is None:
             return create_error_response(404, "User not found")
-        findCol = Collection.query.filter_by(userId=finduser.id, name=col_name).first()
-        if findCol is None:
+        if found.collectionId is None:
             return create_error_response(404, "Collection not found")
-        target = Recipe.query.filter_by(id=recipe_id).first()
-
-        if target in findCol.recipes:
-            findEthnicity = Ethnicity.query.filter_by(id=target.ethnicityId).first()
-            findCategory = Category.query.filter_by(id=target.categoryId).first()
+        target = found.Recipe
+        if target is not None:
+            etag = compute_etag(target.title, target.description, target.ingredients, target.rating,
+                                found.ethnicity, found.category)
+            not_modified = not_modified_response(etag)
+            if not_modified:
+                return not_modified
             body = FoodpointBuilder(
                 title=target.title,
                 description=target.description,
                 ingredients=target.ingredients,
                 rating=target.rating,
-                ethnicity=findEthnicity.name,
-                category=findCategory.name
+                ethnicity=found.ethnicity,
+                category=found.category
             )
             body.add_namespace("fpoint", LINK_RELATIONS_URL)
             body.add_control("self", api.url_for(EachRecipe, user=user, col_name=col_name, recipe_id=recipe_id))
             body.add_control("profile", RECIPE_PROFILE)
             body.add_control("collection", api.url_for(EachCollection, user=user,col_name=col_name))
-            body.add_control_ethnicity(target.ethnicity.name)
-            body.add_control_category(target.category.name)
+            body.add_control_ethnicity(found.ethnicity)
+            body.add_control_category(found.category)
             body.add_control_edit_recipe(user, col_name, recipe_id)
             body.add_control_delete_recipe(user, col_name, recipe_id)
-            return Response(json.dumps(body), 200, mimetype=MASON)
+            response = render_json(body)
+            response.set_etag(etag)
+            return response
         else :
             return create_error_response(404, "Recipe not found")
 
@@ -1068,7 +1648,7 @@ class EachRecipe(Resource):
         if (request.json == None):
             return create_error_response(415, "Unsupported media type", "Request content type must be JSON")
         try:
-            validate(request.json, FoodpointBuilder.recipe_schema())
+            validate_json(request.json, FoodpointBuilder.recipe_schema)
         except ValidationError as e:
             return create_error_response(400, "Invalid JSON document", str(e))
         finduser = User.query.filter_by(userName=user).first()
@@ -1078,16 +1658,15 @@ class EachRecipe(Resource):
         if findCol is None:
             return create_error_response(404, "Collection not found")
 
-        findcategory = Category.query.filter_by(name=request.json["category"]).first()
-        findethnicity = Ethnicity.query.filter_by(name=request.json["ethnicity"]).first()
-        if findcategory is None:
+        category_id = lookup_cache().get_id("category", request.json["category"])
+        if category_id is None:
             return create_error_response(409, "Category does not exist", "Category {} does not exist.".format(request.json["category"]))
-        findethnicity = Ethnicity.query.filter_by(name=request.json["ethnicity"]).first()
-        if findethnicity is None:
+        ethnicity_id = lookup_cache().get_id("ethnicity", request.json["ethnicity"])
+        if ethnicity_id is None:
             return create_error_response(409, "Ethnicity does not exist", "Ethnicity {} does not exist.".format(request.json["ethnicity"]))
 
-        target = Recipe.query.filter_by(id=recipe_id).first()
-        if (target in findCol.recipes):
+        if findCol.has_recipe(recipe_id):
+            target = Recipe.query.filter_by(id=recipe_id).first()
             try:
                 target.rating = request.json["rating"]
             except KeyError:
@@ -1095,9 +1674,10 @@ class EachRecipe(Resource):
             target.title = request.json["title"]
             target.description = request.json["description"]
             target.ingredients = request.json["ingredients"]
-            target.category =findcategory
-            target.ethnicity =findethnicity
+            target.categoryId = category_id
+            target.ethnicityId = ethnicity_id
             db.session.commit()
+            response_cache().invalidate("categories", "ethnicities")
             return Response(status=204)
         else:
             return create_error_response(404, "Recipe not found")
@@ -1105,6 +1685,8 @@ class EachRecipe(Resource):
     def delete(self, user, col_name, recipe_id):
         '''
         Method used For deleting recipe of collection of user, returns 204 if successful, 404 if the the user or collection or recipe didn't exist.
+        Recipes can be linked into many collections, the recipe is removed from this collection and only deleted when it is
+        not in any other collection.
         Parameters:
         - user: String, name of user
         - name: String, name of collection
@@ -1116,11 +1698,315 @@ class EachRecipe(Resource):
         findCol = Collection.query.filter_by(userId=finduser.id, name=col_name).first()
         if findCol is None:
             return create_error_response(404, "Collection not found")
-        target = Recipe.query.filter_by(id=recipe_id).first()
-
-        if (target in findCol.recipes):
-            db.session.delete(target)
+        if findCol.has_recipe(recipe_id):
+            db.session.execute(RecipeCollection.delete().where(and_(
+                RecipeCollection.c.collectionId == findCol.id, RecipeCollection.c.recipeId == recipe_id
+            )))
+            linked = db.session.query(RecipeCollection.c.collectionId).filter(RecipeCollection.c.recipeId == recipe_id).first()
+            if linked is None:
+                db.session.delete(Recipe.query.filter_by(id=recipe_id).first())
             db.session.commit()
+            response_cache().invalidate("collections:" + user, "categories", "ethnicities")
             return Response(status=204)
         else:
             return create_error_response(404, "Recipe not found")
+
+
+class RecipeListing(Resource):
+    """
+    Base class of resources listing recipes of all collections, best rated first. Subclasses narrow the
+    query and call listing from their get method.
+    """
+    #recipes are ordered by rating and id descending, the order of the (categoryId, rating) and
+    #(ethnicityId, rating) indexes, so a page is read from the index without sorting
+    KEYS = [Recipe.rating, Recipe.id]
+
+    def listing(self, query, fields, resource, up=None, **kwargs):
+        """
+        Returns the response of the page of recipes of query selected with the pagination parameters of the
+        request, or 304 or 400. The query must select columns id, title and rating of Recipe.
+        Parameters:
+        - query: Query, recipes to list without ordering
+        - fields: dict, fields of the document besides items
+        - resource: Resource class of the listing
+        - up: String, href of control "up", not added if None
+        - kwargs: route variables and query parameters of the listing
+        """
+        try:
+            limit, after, before = get_page_args()
+            page = keyset_paginate(query, self.KEYS, lambda row: [row.rating, row.id], limit, after, before, descending=True)
+        except ValueError as e:
+            return create_error_response(400, "Invalid pagination parameters", str(e))
+        owners = EachRecipe.first_collections([row.id for row in page.items])
+        etag = compute_etag(fields, [(row.id, row.title, row.rating, owners.get(row.id)) for row in page.items],
+                            page.prev_cursor, page.next_cursor)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+
+        body = FoodpointBuilder(
+            items=[EachRecipe.item(row.id, row.title, row.rating, owners.get(row.id)) for row in page.items],
+            **fields
+        )
+        params = dict((key, value) for key, value in kwargs.items() if value is not None)
+        body.add_namespace("fpoint", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(resource, **params))
+        if up is not None:
+            body.add_control("up", up)
+        body.add_control_pagination(page, resource, **params)
+        body.add_control_all_recipes()
+        body.add_control_search_recipes()
+        body.add_control_recipes_by_ingredients()
+        response = render_json(body)
+        response.set_etag(etag)
+        return response
+
+    @staticmethod
+    def query():
+        """
+        Query of the columns of recipes that listings show.
+        """
+        return db.session.query(Recipe.id, Recipe.title, Recipe.rating)
+
+class CategoryRecipes(RecipeListing):
+    """
+    Resource class for representing recipes of particular category
+    """
+    def get(self, cat_name):
+        """
+        Method used to get list of recipes of a category best rated first (returns a Mason document) if the
+        category is found, otherwise returns 404. The list is paginated with limit and after/before.
+        Parameters:
+        - cat_name: String, name of category
+        """
+        category_id = lookup_cache().get_id("category", cat_name)
+        if category_id is None:
+            return create_error_response(404, "Category not found")
+        return self.listing(
+            self.query().filter(Recipe.categoryId == category_id), {"category": cat_name},
+            CategoryRecipes, up=api.url_for(EachCategory, cat_name=cat_name), cat_name=cat_name
+        )
+
+class EthnicityRecipes(RecipeListing):
+    """
+    Resource class for representing recipes of particular ethnicity
+    """
+    def get(self, eth_name):
+        """
+        Method used to get list of recipes of an ethnicity best rated first (returns a Mason document) if the
+        ethnicity is found, otherwise returns 404. The list is paginated with limit and after/before.
+        Parameters:
+        - eth_name: String, name of ethnicity
+        """
+        ethnicity_id = lookup_cache().get_id("ethnicity", eth_name)
+        if ethnicity_id is None:
+            return create_error_response(404, "Ethnicity not found")
+        return self.listing(
+            self.query().filter(Recipe.ethnicityId == ethnicity_id), {"ethnicity": eth_name},
+            EthnicityRecipes, up=api.url_for(EachEthnicity, eth_name=eth_name), eth_name=eth_name
+        )
+
+class AllRecipes(RecipeListing):
+    """
+    Resource class for representing recipes of all collections, narrowed by facets
+    """
+    def get(self):
+        """
+        Method used to get list of recipes best rated first (returns a Mason document), optionally only the
+        ones of a category, an ethnicity or both, and rated at least min_rating. The list is paginated with
+        limit and after/before. Returns 400 if min_rating is not a number, and an empty list if the category
+        or ethnicity doesn't exist.
+        Query parameters:
+        - category: String, name of category
+        - ethnicity: String, name of ethnicity
+        - min_rating: Float, lowest rating of recipes
+        """
+        category = request.args.get("category")
+        ethnicity = request.args.get("ethnicity")
+        min_rating = request.args.get("min_rating")
+        #resolve names to ids first so that the recipes are found through the indexes on the ids
+        query = self.query()
+        if category is not None:
+            query = query.filter(Recipe.categoryId == lookup_cache().get_id("category", category))
+        if ethnicity is not None:
+            query = query.filter(Recipe.ethnicityId == lookup_cache().get_id("ethnicity", ethnicity))
+        if min_rating is not None:
+            try:
+                query = query.filter(Recipe.rating >= float(min_rating))
+            except ValueError:
+                return create_error_response(400, "Invalid min_rating", "min_rating must be a number")
+        fields = {"category": category, "ethnicity": ethnicity, "min_rating": min_rating}
+        return self.listing(query, fields, AllRecipes, category=category, ethnicity=ethnicity, min_rating=min_rating)
+
+class RecipeSearch(Resource):
+    """
+    Resource class for full-text search of recipes
+    """
+    #bm25 score of a match in the full-text index, lower is better
+    RANK = func.bm25(literal_column("recipe_fts"))
+
+    @staticmethod
+    def match_expression(q):
+        """
+        Turns the text of a search into an FTS5 query that matches recipes having every word of it, in
+        any column and order. Each word is quoted so that characters of the FTS5 query syntax in the text
+        are searched for like any other instead of being an error. Returns None if there are no words.
+        Parameters:
+        - q: String, text of the search
+        """
+        words = re.findall(r"\w+", q)
+        if not words:
+            return None
+        return " ".join('"{}"'.format(word) for word in words)
+
+    def get(self):
+        """
+        Method used to search recipes whose title, description or ingredients contain all the words of
+        query parameter q (returns a Mason document). Results are ordered by relevance (bm25) and
+        paginated with limit and after/before. Each item links to the recipe in one of the collections it
+        belongs to. Returns 400 if q has no words or the pagination parameters are invalid.
+        Query parameters:
+        - q: String, words to search for
+        """
+        q = request.args.get("q", "")
+        match = self.match_expression(q)
+        if match is None:
+            return create_error_response(400, "Invalid search", "q must contain at least one word")
+        query = db.session.query(Recipe.id, Recipe.title, Recipe.rating, self.RANK.label("rank")).join(
+            RecipeSearchIndex, RecipeSearchIndex.c.rowid == Recipe.id
+        ).filter(literal_column("recipe_fts").match(match))
+        try:
+            limit, after, before = get_page_args()
+            page = keyset_paginate(query, [self.RANK, Recipe.id], lambda row: [row.rank, row.id], limit, after, before)
+        except ValueError as e:
+            return create_error_response(400, "Invalid pagination parameters", str(e))
+
+        owners = EachRecipe.first_collections([row.id for row in page.items])
+        etag = compute_etag([(row.id, row.title, row.rating, owners.get(row.id)) for row in page.items],
+                            page.prev_cursor, page.next_cursor)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+
+        results = [EachRecipe.item(row.id, row.title, row.rating, owners.get(row.id)) for row in page.items]
+        body = FoodpointBuilder(
+            query=q,
+            items=results
+        )
+        body.add_namespace("fpoint", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(RecipeSearch, q=q))
+        body.add_control_pagination(page, RecipeSearch, q=q)
+        body.add_control_search_recipes()
+        body.add_control_all_users()
+        response = render_json(body)
+        response.set_etag(etag)
+        return response
+
+class RecipesByIngredients(Resource):
+    """
+    Resource class for finding recipes by their ingredients with the ingredient index
+    """
+    def get(self):
+        """
+        Method used to get recipes that have all (match=all, the default) or any (match=any) of the
+        ingredients in query parameter ingredients (returns a Mason document). Ingredients are normalized
+        like the ones of recipes, see ingredients.py. Recipes are ordered by id and paginated with limit and
+        after/before. Each item links to the recipe in one of the collections it belongs to. Returns 400 if
+        there are no ingredients to look for or the other parameters are invalid.
+        Query parameters:
+        - ingredients: String, ingredients separated by commas
+        - match: String, all or any
+        """
+        text = request.args.get("ingredients", "")
+        match = request.args.get("match", "all")
+        if match not in ("all", "any"):
+            return create_error_response(400, "Invalid match", "match must be all or any")
+        names = tokenize_ingredients(text)
+        if not names:
+            return create_error_response(400, "Invalid ingredients", "ingredients must contain at least one ingredient")
+        try:
+            limit, after, before = get_page_args()
+            after = decode_cursor(after, 1)[0] if after is not None else None
+            before = decode_cursor(before, 1)[0] if before is not None else None
+            if not all(isinstance(cursor, int) for cursor in (after, before) if cursor is not None):
+                raise ValueError("Malformed cursor")
+        except ValueError as e:
+            return create_error_response(400, "Invalid pagination parameters", str(e))
+
+        #merge the posting lists in the order of the page, descending (as negative ids) for the previous page
+        ids = [ingredient_id for (ingredient_id, ) in db.session.query(Ingredient.id).filter(Ingredient.name.in_(names))]
+        if match == "all" and len(ids) < len(names):
+            ids = []
+        postings = [posting_list(ingredient_id, after, before) for ingredient_id in ids]
+        merged = intersect(postings) if match == "all" else union(postings)
+        found = [abs(recipe_id) for recipe_id in itertools.islice(merged, limit + 1)]
+        more = len(found) > limit
+        found = found[:limit]
+        if before is not None:
+            found.reverse()
+        page = Page(found, limit)
+        has_prev = after is not None if before is None else more
+        has_next = more if before is None else True
+        if found and has_prev:
+            page.prev_cursor = encode_cursor([found[0]])
+        if found and has_next:
+            page.next_cursor = encode_cursor([found[-1]])
+
+        recipes = dict((row.id, row) for row in db.session.query(Recipe.id, Recipe.title, Recipe.rating).filter(Recipe.id.in_(found)))
+        owners = EachRecipe.first_collections(found)
+        etag = compute_etag([(recipes[recipe_id].title, recipes[recipe_id].rating, owners.get(recipe_id)) for recipe_id in found],
+                            page.prev_cursor, page.next_cursor)
+        not_modified = not_modified_response(etag)
+        if not_modified:
+            return not_modified
+
+        results = [
+            EachRecipe.item(recipe_id, recipes[recipe_id].title, recipes[recipe_id].rating, owners.get(recipe_id))
+            for recipe_id in found
+        ]
+        body = FoodpointBuilder(
+            ingredients=sorted(names),
+            match=match,
+            items=results
+        )
+        body.add_namespace("fpoint", LINK_RELATIONS_URL)
+        body.add_control("self", api.url_for(RecipesByIngredients, ingredients=text, match=match))
+        body.add_control_pagination(page, RecipesByIngredients, ingredients=text, match=match)
+        body.add_control_recipes_by_ingredients()
+        body.add_control_search_recipes()
+        response = render_json(body)
+        response.set_etag(etag)
+        return response
+
+class Export(Resource):
+    """
+    Resource class for exporting the whole database, for admins only
+    """
+    def get(self):
+        """
+        Streams every user, category, ethnicity, collection, recipe and mapping of recipes to collections
+        as JSON lines, in the format of flask export-data. Returns 403 if the request is not authorized as admin.
+        """
+        forbidden = check_admin()
+        if forbidden:
+            return forbidden
+        return Response(stream_with_context(export_lines()), 200, mimetype="application/x-ndjson")
+
+class CacheStats(Resource):
+    """
+    Resource class for the statistics of the caches, for admins only
+    """
+    def get(self):
+        """
+        Returns the hit, miss and invalidation counts and the number of entries of the caches of the
+        process that serves the request, as JSON. Returns 403 if the request is not authorized as admin.
+        """
+        forbidden = check_admin()
+        if forbidden:
+            return forbidden
+        body = {
+            "lookup": lookup_cache().stats(),
+            "response": response_cache().stats(),
+            "fragment": fragment_cache().stats()
+        }
+        return render_json(body, mimetype="application/json")
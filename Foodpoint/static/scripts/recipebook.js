@@ -56,6 +56,18 @@ function followLink(event, a, renderer) {
     getResource($(a).attr("href"), renderer);
 }
 
+function renderPagination(body, renderer) {
+    //Lists come a page at a time, the prev and next links lead to the pages around this one
+    let links = [];
+    [["prev", "Previous"], ["next", "Next"]].forEach(function ([rel, text]) {
+        let ctrl = body["@controls"][rel];
+        if (ctrl) {
+            links.push("<a href='" + ctrl.href + "' onClick='followLink(event, this, " + renderer.name + ")'>" + text + "</a>");
+        }
+    });
+    $("div.pagination").html(links.join(" "));
+}
+
 function renderForm(ctrl, submitFunction) {
     //let ctrl = body["@controls"]["fpoint:add-user"]
     let form = $("<form>");
@@ -215,6 +227,7 @@ function renderUserPage(body) {
     );
     $(".resulttable thead").empty();
     $(".resulttable tbody").empty();
+    $("div.pagination").empty();
 
     $(".contentbeforeform").html("<p>Edit your user data</p>");
 
@@ -243,6 +256,7 @@ function renderCollections(body) {
     );
     let tbody = $(".resulttable tbody");
     tbody.empty();
+    $("div.pagination").empty();
     if (body.items.length > 0) {
         body.items.forEach(function (item) {
             tbody.append(collectionRow(item));
@@ -281,6 +295,7 @@ function renderCollection(body) {
     } else {
         $(".contentdata").append("<p>This collection has no recipes yet, add one.</p>");
     }
+    renderPagination(body, renderCollection);
     //Keep URL in case need to refetch after editing collection
     CURRENT_URL = body["@controls"]["fpoint:collections-by"].href;
     let add_recipe_ctrl = body["@controls"]["add-recipe"];
@@ -312,6 +327,7 @@ function renderRecipe(body) {
     $(".contentdata").html("<p>Description: "+body.description+"</p>");
     $(".resulttable thead").empty();
     $(".resulttable tbody").empty();
+    $("div.pagination").empty();
     $(".contentbeforeform").empty();
 
     renderForm(body["@controls"]["edit"], submitRecipe);
@@ -352,6 +368,7 @@ function renderCategories(body) {
             tbody.append(categoryRow(item));
         });
     }
+    renderPagination(body, renderCategories);
     $(".contentbeforeform").html("<p>Create a new category with the form below</p>");
     renderForm(body["@controls"]["fpoint:add-category"], submitCategory);
 }
@@ -365,6 +382,7 @@ function renderCategory(body) {
     $(".contentdata").empty();
     $(".resulttable thead").empty();
     $(".resulttable tbody").empty();
+    $("div.pagination").empty();
     $(".contentbeforeform").empty();
 
     //Keep URL in case need to refetch after editing
@@ -394,6 +412,7 @@ function renderEthnicities(body) {
             tbody.append(ethnicityRow(item));
         });
     }
+    renderPagination(body, renderEthnicities);
     $(".contentbeforeform").html("<p>Create a new ethnicity with the form below</p>");
     renderForm(body["@controls"]["fpoint:add-ethnicity"], submitEthnicity);
 }
@@ -407,6 +426,7 @@ function renderEthnicity(body) {
     $(".contentdata").empty();
     $(".resulttable thead").empty();
     $(".resulttable tbody").empty();
+    $("div.pagination").empty();
     $(".contentbeforeform").empty();
 
     //Keep URL in case need to refetch after editing
@@ -508,6 +528,7 @@ function renderStartPage(body) {
     $(".contentbeforeform").empty();
     $(".resulttable thead").empty();
     $(".resulttable tbody").empty();
+    $("div.pagination").empty();
 
     //form for login
     let form = $("<form>");
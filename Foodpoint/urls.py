@@ -0,0 +1,122 @@
+"""
+Precompiled building of the URLs of the routes of the app. Building a URL with url_for looks up the rule
+of the endpoint in the URL map and runs its generic builder on every call, which is one of the main costs
+of the documents that link to each of their items. URLBuilder parses each rule once into its static
+parts, quoted in advance, and the converters of its variables, so building a URL only converts the
+values and joins the parts. The URLs are the same as those of url_for: variables are converted with the
+to_url of their converter, other values are added as the query string with the quoting of Werkzeug and
+values that are None are left out.
+"""
+
+import re
+from urllib.parse import quote, urlencode
+from werkzeug.datastructures import iter_multi_items
+from werkzeug.routing import BaseConverter, BuildError, parse_converter_args
+
+#a variable of a rule: <name>, <converter:name> or <converter(arguments):name>
+RULE_VARIABLE = re.compile(
+    r"<(?:(?P<converter>[a-zA-Z_][a-zA-Z0-9_]*)(?:\((?P<arguments>.*?)\))?:)?(?P<variable>[a-zA-Z_][a-zA-Z0-9_]*)>"
+)
+
+#characters Werkzeug leaves unquoted in static parts of paths and in query strings
+PATH_SAFE = "!$&'()*+,/:;=@"
+QUERY_SAFE = "!$'()*,/:;?@"
+
+#values made only of characters that quote leaves as they are, which is most names and every id
+UNQUOTED = re.compile(r"[A-Za-z0-9_.~!$&'()*+,/:;=@-]*")
+
+
+def quote_variable(value):
+    """
+    Returns a value quoted for a path as the to_url of the default converter does, without quoting
+    values that don't need it.
+    Parameters:
+    - value: value of a variable, converted with str
+    """
+    value = str(value)
+    if UNQUOTED.fullmatch(value):
+        return value
+    return quote(value, safe=PATH_SAFE)
+
+
+class URLBuilder(object):
+    """
+    Builder of the paths of the endpoints of a URL map. Endpoints whose URLs depend on more than their
+    rule (several rules, defaults, hosts or subdomains) are not compiled and are left to url_for.
+    Parameters:
+    - url_map: Map of the app, with all the routes registered
+    """
+
+    def __init__(self, url_map):
+        self.rules = {}
+        rules = {}
+        for rule in url_map.iter_rules():
+            rules.setdefault(rule.endpoint, []).append(rule)
+        for endpoint, endpoint_rules in rules.items():
+            rule = endpoint_rules[0]
+            if len(endpoint_rules) == 1 and not (rule.defaults or rule.subdomain or rule.host or rule.websocket):
+                self.rules[endpoint] = self._compile(url_map, rule)
+
+    @staticmethod
+    def _compile(url_map, rule):
+        """
+        Returns the parts of a rule, strings for static parts and (name, to_url of converter) for
+        variables, and the set of the names of the variables.
+        """
+        parts = []
+        position = 0
+        for match in RULE_VARIABLE.finditer(rule.rule):
+            if match.start() > position:
+                parts.append(quote(rule.rule[position:match.start()], safe=PATH_SAFE))
+            args, kwargs = parse_converter_args(match.group("arguments") or "")
+            converter = url_map.converters[match.group("converter") or "default"](url_map, *args, **kwargs)
+            if type(converter).to_url is BaseConverter.to_url:
+                parts.append((match.group("variable"), quote_variable))
+            else:
+                parts.append((match.group("variable"), converter.to_url))
+            position = match.end()
+        if position < len(rule.rule):
+            parts.append(quote(rule.rule[position:], safe=PATH_SAFE))
+        return parts, rule.arguments
+
+    def build(self, endpoint, values):
+        """
+        Returns the path of an endpoint without the root of the app, or None if the endpoint is not
+        compiled. Raises BuildError if a variable of the rule has no value.
+        Parameters:
+        - endpoint: String, endpoint of the rule, including the name of its blueprint
+        - values: dict, values of the variables of the rule and of the query string
+        """
+        compiled = self.rules.get(endpoint)
+        if compiled is None:
+            return None
+        parts, arguments = compiled
+        path = []
+        try:
+            for part in parts:
+                if part.__class__ is str:
+                    path.append(part)
+                else:
+                    value = values[part[0]]
+                    if value is None:
+                        raise KeyError(part[0])
+                    path.append(part[1](value))
+        except KeyError:
+            raise BuildError(endpoint, values, None)
+        path = "".join(path)
+        if len(values) > len(arguments):
+            query = [
+                item for item in iter_multi_items(
+                    dict((key, value) for key, value in values.items() if key not in arguments and value is not None)
+                ) if item[1] is not None
+            ]
+            if query:
+                path += "?" + urlencode(query, safe=QUERY_SAFE)
+        return path
+
+
+def init_app(app):
+    """
+    Compiles the routes of an app, call it once all of them are registered.
+    """
+    app.extensions["url_builder"] = URLBuilder(app.url_map)
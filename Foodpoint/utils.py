@@ -1,6 +1,17 @@
-from flask import Response, request
+from flask import Response, request, current_app, stream_with_context
+from jsonschema import validators
+from sqlalchemy import and_, or_, false, tuple_
+import base64
+import functools
+import hashlib
+import hmac
 import json
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 """----Constants----"""
 MASON = "application/vnd.mason+json"
 APIARY_URL = "https://foodpoint.docs.apiary.io/#reference/"
@@ -11,6 +22,15 @@ ETHNICITY_PROFILE = "/profiles/ethnicity/"
 COLLECTION_PROFILE = "/profiles/collection/"
 RECIPE_PROFILE = "/profiles/collection/"
 LINK_RELATIONS_URL = "/foodpoint/link-relations/"
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 100
+MAX_BATCH_SIZE = 1000
+#largest page admins may request, pages larger than MAX_PAGE_SIZE are streamed
+MAX_STREAM_PAGE_SIZE = 100000
+#number of rows of streamed pages read from the database and sent at a time
+STREAM_CHUNK_SIZE = 500
+#number of values bound to one IN clause, below the limits of SQLite
+IN_CHUNK_SIZE = 500
 
 """----MasonBuilder----"""
 class MasonBuilder(dict):
@@ -78,6 +98,167 @@ class MasonBuilder(dict):
         self["@controls"][ctrl_name] = kwargs
         self["@controls"][ctrl_name]["href"] = href
 
+    def add_control_template(self, ctrl_name, template, href):
+        """
+        Adds a control built from a precomputed template, see add_control. The
+        template is shared between documents so it is copied before the href
+        is filled in and must not be modified by the caller.
+
+        : param str ctrl_name: name of the control (including namespace if any)
+        : param dict template: properties of the control other than href
+        : param str href: target URI for the control
+        """
+
+        if "@controls" not in self:
+            self["@controls"] = {}
+
+        control = dict(template)
+        control["href"] = href
+        self["@controls"][ctrl_name] = control
+
+    def encode_with_items(self, items):
+        """
+        Encodes the object as JSON bytes with an items property whose elements
+        are already encoded, for example by FragmentCache, so they are spliced
+        into the document instead of being encoded again. items is the last
+        property of the result and must not be set on the object. The encoder
+        may pretty print or add whitespace around the document.
+
+        : param list items: the elements of items, each encoded as JSON bytes
+        """
+
+        members = _object_members(encode_json(self))
+        separator = b"," if members else b""
+        return b"{" + members + separator + b'"items":[' + b",".join(items) + b"]}"
+
+
+"""----JSON encoding----"""
+def encode_json_stdlib(document):
+    """
+    Encodes a document as compact JSON bytes with the json module of the
+    standard library.
+
+    : param document: JSON serializable value
+    """
+
+    return json.dumps(document, separators=(",", ":")).encode("utf-8")
+
+
+def encode_json_orjson(document):
+    """
+    Encodes a document as compact JSON bytes with orjson, several times faster
+    than the standard library. Non-ASCII characters are written as UTF-8
+    instead of escapes.
+
+    : param document: JSON serializable value
+    """
+
+    return orjson.dumps(document)
+
+
+#encoders that config JSON_ENCODER can name, orjson only if it is installed
+JSON_ENCODERS = {"json": encode_json_stdlib}
+if orjson is not None:
+    JSON_ENCODERS["orjson"] = encode_json_orjson
+
+
+def get_json_encoder(encoder):
+    """
+    Returns the encoder of config JSON_ENCODER: "auto" for orjson if it is
+    installed and the standard library otherwise, the name of one of
+    JSON_ENCODERS, or a function of a document that returns bytes, compact or
+    not.
+
+    : param encoder: the value of JSON_ENCODER
+    """
+
+    if callable(encoder):
+        return encoder
+    if encoder == "auto":
+        return JSON_ENCODERS.get("orjson", encode_json_stdlib)
+    if encoder not in JSON_ENCODERS:
+        raise ValueError("Unknown JSON_ENCODER {}, must be auto, one of {} or a callable".format(
+            encoder, ", ".join(sorted(JSON_ENCODERS))
+        ))
+    return JSON_ENCODERS[encoder]
+
+
+def _object_members(encoded):
+    """
+    Returns the members of a JSON object encoded by a JSON encoder without
+    the braces around them and the whitespace that some encoders add, so that
+    more members can be joined to them. Raises ValueError if the encoder
+    didn't return an object.
+
+    : param bytes encoded: JSON object
+    """
+
+    encoded = encoded.strip()
+    if encoded[:1] != b"{" or encoded[-1:] != b"}":
+        raise ValueError("JSON encoder didn't return an object: {!r}".format(encoded[:40]))
+    return encoded[1:-1].strip()
+
+
+def encode_json(document):
+    """
+    Encodes a document as JSON bytes with the encoder of the current app.
+
+    : param document: JSON serializable value
+    """
+
+    return current_app.extensions["json_encoder"](document)
+
+
+def render_json(document, status_code=200, mimetype=MASON):
+    """
+    Returns a response with a document encoded by the encoder of the current
+    app. All JSON responses of the API are made with this function.
+
+    : param document: JSON serializable value, usually a MasonBuilder
+    : param int status_code: status of the response
+    : param str mimetype: mimetype of the response
+    """
+
+    return Response(encode_json(document), status_code, mimetype=mimetype)
+
+
+def render_json_stream(head, items, tail, mimetype=MASON, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Returns a response that encodes a document while it is sent, with chunked
+    transfer encoding, so that only chunk_size items are in memory at a time.
+    The document has the properties of head, then items, then the properties
+    of tail, which is called once all items are sent and can use what was
+    learned from them, such as the cursors of a PageStream.
+
+    : param dict head: properties before items
+    : param items: iterable of the elements of items, read while sending
+    : param function tail: returns the dict of the properties after items
+    : param str mimetype: mimetype of the response
+    : param int chunk_size: number of items sent at a time
+    """
+
+    encode = current_app.extensions["json_encoder"]
+
+    def generate():
+        #items are appended to one buffer as they are encoded, so a chunk takes the size of its JSON
+        members = _object_members(encode(head))
+        chunk = bytearray(b"{" + members)
+        chunk += b',"items":[' if members else b'"items":['
+        count = 0
+        for item in items:
+            if count:
+                chunk += b","
+            chunk += encode(item)
+            count += 1
+            if count % chunk_size == 0:
+                yield bytes(chunk)
+                chunk = bytearray()
+        end = _object_members(encode(tail()))
+        chunk += b"]," + end + b"}" if end else b"]}"
+        yield bytes(chunk)
+
+    return Response(stream_with_context(generate()), 200, mimetype=mimetype)
+
 
 """----Convenience functions----
  This function is adapted from Exercise work.
@@ -87,4 +268,348 @@ def create_error_response(status_code, title, message=None):
     body = MasonBuilder(resource_url=resource_url)
     body.add_error(title, message)
     body.add_control("profile", href=ERROR_PROFILE)
-    return Response(json.dumps(body), status_code, mimetype=MASON)
+    return render_json(body, status_code)
+
+
+def check_admin():
+    """
+    Returns an error response if the current request is not authorized as admin, otherwise None. Admin
+    requests carry the ADMIN_TOKEN of the app config in the Authorization header as a bearer token.
+    """
+    if not current_app.config.get("ADMIN_TOKEN"):
+        return create_error_response(403, "Forbidden", "Admin resources are disabled")
+    if not is_admin():
+        return create_error_response(403, "Forbidden", "Admin token is missing or invalid")
+    return None
+
+
+def is_admin():
+    """
+    Returns True if the current request is authorized as admin, see check_admin.
+    """
+    token = current_app.config.get("ADMIN_TOKEN")
+    if not token:
+        return False
+    given = request.headers.get("Authorization", "")
+    return hmac.compare_digest(given.encode("utf-8"), ("Bearer " + token).encode("utf-8"))
+
+
+def vary_on_authorization(method):
+    """
+    Decorator of the get method of a resource whose responses depend on is_admin, for example admins
+    getting large pages streamed without an ETag. Adds Authorization to the Vary header of every response
+    so that caches don't serve the response of one to the other.
+    """
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        response = method(*args, **kwargs)
+        response.vary.add("Authorization")
+        return response
+    return wrapper
+
+
+def chunks(values, size=IN_CHUNK_SIZE):
+    """
+    Generator of consecutive slices of a list of at most size values, by default as many as can be
+    bound to one IN clause.
+    """
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+"""----Validation----"""
+_validators = {}
+
+def get_validator(schema_factory):
+    """
+    Returns a validator for the JSON schema built by schema_factory. The schema
+    is built, checked and compiled into a validator only on the first call, the
+    validator is then reused for the lifetime of the process.
+
+    : param function schema_factory: function that returns the schema, for example FoodpointBuilder.user_schema
+    """
+    validator = _validators.get(schema_factory)
+    if validator is None:
+        schema = schema_factory()
+        cls = validators.validator_for(schema)
+        cls.check_schema(schema)
+        validator = _validators[schema_factory] = cls(schema)
+    return validator
+
+
+def validate_json(document, schema_factory):
+    """
+    Validates document against the schema built by schema_factory using the
+    cached validator. Raises jsonschema ValidationError if the document is invalid.
+
+    : param document: the parsed JSON document to validate
+    : param function schema_factory: function that returns the schema
+    """
+    get_validator(schema_factory).validate(document)
+
+
+"""----Conditional requests----"""
+def compute_etag(*parts):
+    """
+    Computes a strong ETag for the representation of the current request from
+    the data it is built from. The document is a function of that data and the
+    request URL, so this is cheaper than hashing the document and can be done
+    before building it.
+
+    : param parts: JSON serializable values the representation depends on
+    """
+    raw = json.dumps([request.full_path, parts], separators=(",", ":"), default=str)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+
+def not_modified_response(etag):
+    """
+    Returns a 304 response if the If-None-Match header of the current request
+    matches the given ETag, otherwise None. The comparison is weak as
+    If-None-Match requires, so tags weakened by proxies on the way still match.
+
+    : param str etag: the current ETag of the requested resource
+    """
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+        response.set_etag(etag)
+        return response
+    return None
+
+
+"""----Pagination----"""
+class Page(object):
+    """
+    One page of a keyset paginated listing. Holds the rows of the page and the
+    cursors that lead to the neighbouring pages (None if there is no such page).
+    """
+
+    def __init__(self, items, limit, prev_cursor=None, next_cursor=None):
+        self.items = items
+        self.limit = limit
+        self.prev_cursor = prev_cursor
+        self.next_cursor = next_cursor
+
+
+def encode_cursor(values):
+    """
+    Encodes the sort key values of a row into an opaque, URL safe cursor string.
+
+    : param list values: values of the sort keys of the row
+    """
+    raw = json.dumps(values, separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor, length):
+    """
+    Decodes a cursor created by encode_cursor. Raises ValueError if the cursor
+    is malformed or doesn't contain the expected number of key values.
+
+    : param str cursor: cursor string from the query string
+    : param int length: number of sort keys the cursor must contain
+    """
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        values = json.loads(raw.decode("utf-8"))
+    except (TypeError, ValueError):
+        raise ValueError("Malformed cursor")
+    if not isinstance(values, list) or len(values) != length:
+        raise ValueError("Malformed cursor")
+    return values
+
+
+def get_page_args(max_size=MAX_PAGE_SIZE):
+    """
+    Reads the pagination parameters limit, after and before from the query
+    string of the current request. Raises ValueError if they are invalid.
+    Returns a tuple (limit, after, before) where cursors may be None.
+
+    : param int max_size: largest page size the server is willing to return
+    """
+    limit = request.args.get("limit", DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise ValueError("limit must be an integer")
+    if limit < 1:
+        raise ValueError("limit must be positive")
+    after = request.args.get("after")
+    before = request.args.get("before")
+    if after is not None and before is not None:
+        raise ValueError("after and before can't be used together")
+    return min(limit, max_size), after, before
+
+
+def _row(keys, values):
+    """
+    Returns the expressions of keys and values compared as a whole, a row value
+    if there are several keys.
+    """
+    if len(keys) == 1:
+        return keys[0], values[0]
+    return tuple_(*keys), tuple(values)
+
+
+def _keyset_branches(keys, values, greater):
+    """
+    Builds the lexicographic comparison (keys) > (values), or < if greater is
+    False, in the order SQLite sorts rows, where NULL is the smallest value.
+    Returns a list of conditions whose rows follow one another in the order of
+    the keys, the rows after the cursor are the ones of the first condition,
+    then of the second and so on. Each condition is a row value comparison
+    or a comparison with NULL that SQLite turns into a range of the index on
+    the keys, which an OR of them would prevent. Only the first key may be
+    NULL.
+    """
+    first, rest = keys[0], keys[1:]
+    nullable = getattr(first, "nullable", True)
+    if values[0] is None:
+        if not rest:
+            return [first.isnot(None)] if greater else []
+        key, value = _row(rest, values[1:])
+        null = and_(first.is_(None), key > value if greater else key < value)
+        return [null, first.isnot(None)] if greater else [null]
+    key, value = _row(keys, values)
+    if greater:
+        return [key > value]
+    return [key < value, first.is_(None)] if nullable else [key < value]
+
+
+def _keyset_condition(keys, values, greater):
+    """
+    Returns the conditions of _keyset_branches as one, for bounding rows that
+    are found through another condition.
+    """
+    branches = _keyset_branches(keys, values, greater)
+    if not branches:
+        return false()
+    return or_(*branches)
+
+
+def keyset_paginate(query, keys, cursor_of, limit, after=None, before=None, descending=False):
+    """
+    Returns one Page of query ordered by keys using keyset (cursor)
+    pagination. Unlike OFFSET, the cost of fetching a page doesn't grow with
+    its position because the database seeks straight to the cursor through
+    the index on the keys. The last key must be unique (usually the primary
+    key) so that the order is total. Raises ValueError for malformed cursors.
+
+    : param Query query: query to paginate, without ordering
+    : param list keys: columns to order by, the last one must be unique
+    : param function cursor_of: returns the list of key values of a row
+    : param int limit: maximum number of rows on the page
+    : param str after: cursor of the row that precedes the wanted page
+    : param str before: cursor of the row that follows the wanted page
+    : param bool descending: order by the keys in descending order
+    """
+    forward = before is None
+    cursor = after if forward else before
+    ascending = forward != descending
+    branches = [None]
+    if cursor is not None:
+        branches = _keyset_branches(keys, decode_cursor(cursor, len(keys)), ascending)
+    if ascending:
+        order = [key.asc() for key in keys]
+    else:
+        order = [key.desc() for key in keys]
+    rows = []
+    for condition in branches:
+        branch = query if condition is None else query.filter(condition)
+        rows += branch.order_by(*order).limit(limit + 1 - len(rows)).all()
+        if len(rows) > limit:
+            break
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if not forward:
+        rows.reverse()
+    has_prev = more if not forward else after is not None
+    has_next = more if forward else True
+    page = Page(rows, limit)
+    if rows and has_prev:
+        page.prev_cursor = encode_cursor(cursor_of(rows[0]))
+    if rows and has_next:
+        page.next_cursor = encode_cursor(cursor_of(rows[-1]))
+    return page
+
+
+class PageStream(object):
+    """
+    One page of a keyset paginated listing that is read from the database while
+    it is iterated, a chunk of rows at a time, for pages too large to hold in
+    memory. It has the rows and cursors of the Page that keyset_paginate
+    returns for the same arguments, the cursors are set once the rows have
+    been iterated. Pages before a cursor are found by reading the row that
+    precedes the page, then streaming the page in order from it, after is
+    ignored then as it is by keyset_paginate. Raises ValueError for malformed
+    cursors.
+
+    : param Query query: query to paginate, without ordering
+    : param list keys: columns to order by, the last one must be unique
+    : param function cursor_of: returns the list of key values of a row
+    : param int limit: maximum number of rows on the page
+    : param str after: cursor of the row that precedes the wanted page
+    : param str before: cursor of the row that follows the wanted page
+    : param bool descending: order by the keys in descending order
+    : param int chunk_size: number of rows fetched at a time
+    """
+
+    def __init__(self, query, keys, cursor_of, limit, after=None, before=None, descending=False,
+                 chunk_size=STREAM_CHUNK_SIZE):
+        self.limit = limit
+        self.prev_cursor = None
+        self.next_cursor = None
+        self.cursor_of = cursor_of
+        self.chunk_size = chunk_size
+        self.has_prev = after is not None
+        self.has_next = before is not None
+        self.order = [key.desc() if descending else key.asc() for key in keys]
+        self.branches = [None]
+        if after is not None:
+            self.branches = _keyset_branches(keys, decode_cursor(after, len(keys)), not descending)
+        if before is not None:
+            values = decode_cursor(before, len(keys))
+            reverse = [key.asc() if descending else key.desc() for key in keys]
+            preceding = None
+            skip = limit
+            for condition in _keyset_branches(keys, values, descending):
+                branch = query.filter(condition).order_by(*reverse)
+                preceding = branch.offset(skip).limit(1).first()
+                if preceding is not None:
+                    break
+                skip -= branch.count()
+            query = query.filter(_keyset_condition(keys, values, descending))
+            self.has_prev = preceding is not None
+            self.branches = [None]
+            if preceding is not None:
+                self.branches = _keyset_branches(keys, cursor_of(preceding), not descending)
+        self.query = query
+        self.size = limit if before is not None else limit + 1
+
+    def _rows(self):
+        """
+        Yields the rows of the page and the row that follows it, if any, in order.
+        """
+        size = self.size
+        for condition in self.branches:
+            query = self.query if condition is None else self.query.filter(condition)
+            for row in query.order_by(*self.order).limit(size).yield_per(self.chunk_size):
+                size -= 1
+                yield row
+            if size == 0:
+                return
+
+    def __iter__(self):
+        count = 0
+        last = None
+        for row in self._rows():
+            if count == self.limit:
+                self.has_next = True
+                break
+            if count == 0 and self.has_prev:
+                self.prev_cursor = encode_cursor(self.cursor_of(row))
+            last = row
+            count += 1
+            yield row
+        if last is not None and self.has_next:
+            self.next_cursor = encode_cursor(self.cursor_of(last))
@@ -0,0 +1,277 @@
+"""
+Micro-benchmarks for hot paths of the Foodpoint API. These are not tests, run
+them manually from the directory above the Foodpoint folder, for example
+`python benchmark.py validation`. Run without arguments to list benchmarks.
+Numbers given after the name are passed to the benchmark, for example
+`python benchmark.py search 100000` for a smaller database.
+"""
+import json
+import os
+import random
+import sys
+import tempfile
+import timeit
+import tracemalloc
+
+from jsonschema import validate
+
+from Foodpoint import create_app, db
+from Foodpoint.api import api #must be imported before resources
+from Foodpoint.database import User, Recipe, Collection, Category, Ethnicity
+from Foodpoint.resources import FoodpointBuilder, EachCollection, EachCategory, EachEthnicity, EachRecipe
+from Foodpoint.utils import MasonBuilder, encode_json, validate_json, JSON_ENCODERS
+from sqlalchemy import case, or_
+
+
+def _report(name, number, seconds):
+    print("{:<40} {:>10.2f} us/call".format(name, seconds / number * 1e6))
+
+
+def _create_app(users=100, recipes=100, config=None):
+    """
+    Creates an app on a temporary database with the given number of users, and
+    a collection of the first user holding the given number of recipes.
+    Returns the app and the path of the database file, remove it when done.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    os.close(db_fd)
+    app = create_app(dict({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname}, **(config or {})))
+    with app.app_context():
+        db.create_all()
+        category = Category(name="Seafood")
+        ethnicity = Ethnicity(name="European")
+        db.session.add_all([category, ethnicity])
+        for i in range(users):
+            db.session.add(User(name="User Name{}".format(i), userName="user-{}".format(i)))
+        db.session.flush()
+        collection = Collection(name="bench", userId=User.query.filter_by(userName="user-0").first().id)
+        for i in range(recipes):
+            collection.recipes.append(Recipe(title="recipe-{}".format(i), description="description",
+                                             ingredients="salmon, dill", rating=i % 5,
+                                             category=category, ethnicity=ethnicity))
+        db.session.add(collection)
+        db.session.commit()
+    return app, db_fname
+
+
+def _bench_get(client, url, number):
+    seconds = timeit.timeit(lambda: client.get(url), number=number)
+    _report("GET " + url, number, seconds)
+
+
+def bench_documents(number=500):
+    """
+    Time of building and returning the Mason documents of the most used
+    resources, a single recipe and a full page of users, and of encoding the
+    controls of a recipe the way they were before CONTROL_TEMPLATES, built
+    with their schemas on every call and encoded with json.dumps, compared to
+    copying the templates and encoding with the encoder of the app.
+    """
+    app, db_fname = _create_app()
+    client = app.test_client()
+    _bench_get(client, "/api/users/user-0/collections/bench/1/", number)
+    _bench_get(client, "/api/users/?limit=100", number)
+    os.unlink(db_fname)
+
+    def recipe_controls_per_call():
+        body = MasonBuilder()
+        body.add_control("fpoint:ethnicity", href=api.url_for(EachEthnicity, eth_name="European"),
+                         title="Ethnicity of this recipe")
+        body.add_control("fpoint:category", href=api.url_for(EachCategory, cat_name="Seafood"),
+                         title="Category of this recipe")
+        body.add_control("edit", href=api.url_for(EachRecipe, user="user-0", col_name="bench", recipe_id=1),
+                         title="Edit this recipe information", method="PUT", encoding="json",
+                         schema=FoodpointBuilder.recipe_schema())
+        body.add_control("fpoint:delete", href=api.url_for(EachRecipe, user="user-0", col_name="bench", recipe_id=1),
+                         title="Delete this recipe", method="DELETE")
+        body.add_control("fpoint:add-recipe", href=api.url_for(EachCollection, user="user-0", col_name="bench"),
+                         title="Add new recipe to collection of user", method="POST", encoding="json",
+                         schema=FoodpointBuilder.recipe_schema())
+        return json.dumps(body)
+
+    def recipe_controls():
+        body = FoodpointBuilder()
+        body.add_control_ethnicity("European")
+        body.add_control_category("Seafood")
+        body.add_control_edit_recipe("user-0", "bench", 1)
+        body.add_control_delete_recipe("user-0", "bench", 1)
+        body.add_control_add_recipe("user-0", "bench")
+        return encode_json(body)
+
+    with app.test_request_context():
+        assert json.loads(recipe_controls_per_call()) == json.loads(recipe_controls())
+        seconds = timeit.timeit(recipe_controls_per_call, number=number * 10)
+        _report("controls of EachRecipe.get per call", number * 10, seconds)
+        seconds = timeit.timeit(recipe_controls, number=number * 10)
+        _report("controls of EachRecipe.get templates", number * 10, seconds)
+
+
+def bench_response_cache(number=2000):
+    """
+    Time of the cached GET endpoints with the response cache disabled, and
+    enabled with each backend, where every request after the first is a hit.
+    """
+    cache_fd, cache_fname = tempfile.mkstemp()
+    os.close(cache_fd)
+    configs = (
+        {"RESPONSE_CACHE_TTL": 0},
+        {"CACHE_BACKEND": "memory"},
+        {"CACHE_BACKEND": "sqlite", "CACHE_PATH": cache_fname},
+    )
+    for config in configs:
+        app, db_fname = _create_app(config=config)
+        client = app.test_client()
+        print(", ".join("{}={}".format(key, value) for key, value in config.items()))
+        for url in ("/api/categories/", "/api/users/user-0/", "/api/users/user-0/collections/"):
+            _bench_get(client, url, number)
+        os.unlink(db_fname)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(cache_fname + suffix):
+            os.unlink(cache_fname + suffix)
+
+
+def bench_fragment_cache(number=500):
+    """
+    Time of full pages of the lists that are assembled from cached items,
+    with the fragment cache disabled and enabled.
+    """
+    for ttl in (0, 3600):
+        app, db_fname = _create_app(config={"FRAGMENT_CACHE_TTL": ttl})
+        client = app.test_client()
+        print("FRAGMENT_CACHE_TTL={}".format(ttl))
+        for url in ("/api/users/?limit=100", "/api/users/user-0/collections/bench/?limit=100"):
+            _bench_get(client, url, number)
+        os.unlink(db_fname)
+
+
+def bench_json(items=10000, number=20):
+    """
+    Time of encoding a large list document with each JSON encoder, and of
+    full pages of users served with each of them.
+    """
+    app, db_fname = _create_app()
+    with app.test_request_context():
+        document = FoodpointBuilder(items=[
+            EachCollection.item("1/{}".format(i), (i, "Recipe title {}".format(i), "user-0", "bench"))
+            for i in range(items)
+        ])
+        document.add_control_add_recipe("user-0", "bench")
+    os.unlink(db_fname)
+    for name, encoder in sorted(JSON_ENCODERS.items()):
+        seconds = timeit.timeit(lambda: encoder(document), number=number)
+        _report("{} list of {} items".format(name, items), number, seconds)
+    for name in sorted(JSON_ENCODERS):
+        app, db_fname = _create_app(config={"JSON_ENCODER": name, "FRAGMENT_CACHE_TTL": 0})
+        print("JSON_ENCODER={}".format(name))
+        _bench_get(app.test_client(), "/api/users/?limit=100", number * 10)
+        os.unlink(db_fname)
+
+
+def bench_rows(rows=100000, number=5):
+    """
+    Rows per second and peak memory of reading the columns of users shown by
+    AllUsers as ORM objects, the way the lists used to, and as plain rows of
+    the columns, the way they do now.
+    """
+    app, db_fname = _create_app(users=1, recipes=0)
+    with app.app_context():
+        db.session.execute(User.__table__.insert(), [
+            {"name": "User Name{}".format(i), "userName": "user-{}".format(i)} for i in range(1, rows)
+        ])
+        db.session.commit()
+        paths = (
+            ("ORM objects", lambda: [(user.id, user.name, user.userName) for user in User.query.order_by(User.id)]),
+            ("column rows", lambda: [(row.id, row.name, row.userName) for row in
+                                     db.session.query(User.id, User.name, User.userName).order_by(User.id)]),
+        )
+        for name, read in paths:
+            seconds = timeit.timeit(lambda: (read(), db.session.expunge_all()), number=number)
+            tracemalloc.start()
+            read()
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            db.session.expunge_all()
+            print("{:<40} {:>10.0f} rows/s {:>10.1f} MiB peak".format(
+                "{} of {} users".format(name, rows), rows * number / seconds, peak / 2 ** 20
+            ))
+    os.unlink(db_fname)
+    app, db_fname = _create_app()
+    client = app.test_client()
+    for url in ("/api/users/?limit=100", "/api/categories/", "/api/users/user-0/collections/"):
+        _bench_get(client, url, number * 100)
+    os.unlink(db_fname)
+
+
+def bench_validation(number=20000):
+    """
+    Cost of validating one recipe document, as done by POST and PUT, when the
+    schema is built and checked on every call compared to the cached validator.
+    """
+    document = {
+        "title": "Salmon Steak",
+        "description": "Fillet of salmon grilled with dill sauce",
+        "ingredients": "Salmon fillet, yogurt, cream, dill",
+        "rating": 4.5,
+        "ethnicity": "European",
+        "category": "Seafood"
+    }
+    seconds = timeit.timeit(lambda: validate(document, FoodpointBuilder.recipe_schema()), number=number)
+    _report("jsonschema.validate per request", number, seconds)
+    seconds = timeit.timeit(lambda: validate_json(document, FoodpointBuilder.recipe_schema), number=number)
+    _report("cached validator", number, seconds)
+
+
+def bench_search(recipes=1000000, number=20):
+    """
+    Time of a search of recipes by words with the full-text index compared
+    to scanning the recipe table with LIKE. The search ranks every match by
+    bm25 before taking a page, so the LIKE query ranks every match too, by
+    the number of fields containing each word, and sorts them all. Recipes get
+    random text from a small vocabulary, and are inserted without the ORM to
+    build the database in reasonable time, the index is filled by its triggers.
+    """
+    words = ["salmon", "tuna", "beef", "chicken", "tofu", "rice", "noodle", "dill", "garlic", "lemon",
+             "butter", "cream", "spicy", "grilled", "baked", "fried", "steamed", "soup", "salad", "curry"]
+    words += ["word{}".format(i) for i in range(2000)]
+    rng = random.Random(1)
+    text = lambda count: " ".join(rng.choice(words) for _ in range(count))
+    app, db_fname = _create_app(users=1, recipes=0)
+    with app.app_context():
+        table = Recipe.__table__
+        for start in range(0, recipes, 10000):
+            db.session.execute(table.insert(), [{
+                "title": text(3), "description": text(20), "ingredients": text(8),
+                "categoryId": 1, "ethnicityId": 1
+            } for _ in range(start, min(start + 10000, recipes))])
+            db.session.commit()
+        columns = (Recipe.title, Recipe.description, Recipe.ingredients)
+        patterns = ("%salmon%", "%dill%")
+        score = sum(case((column.like(pattern), 1), else_=0) for column in columns for pattern in patterns)
+        like = db.session.query(Recipe.id).filter(
+            *[or_(*[column.like(pattern) for column in columns]) for pattern in patterns]
+        )
+        print("{} of {} recipes match salmon and dill".format(like.count(), recipes))
+        seconds = timeit.timeit(like.order_by(score.desc(), Recipe.id).limit(50).all, number=number)
+        _report("LIKE scan of {} recipes".format(recipes), number, seconds)
+    client = app.test_client()
+    _bench_get(client, "/api/recipes/search/?q=salmon+dill&limit=50", number)
+    seconds = timeit.timeit(lambda: client.get("/api/recipes/search/?q=word7+word8&limit=50"), number=number)
+    _report("GET search of rare words", number, seconds)
+    os.unlink(db_fname)
+
+
+BENCHMARKS = {
+    "documents": bench_documents,
+    "validation": bench_validation,
+    "response-cache": bench_response_cache,
+    "fragment-cache": bench_fragment_cache,
+    "json": bench_json,
+    "rows": bench_rows,
+    "search": bench_search,
+}
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2 or sys.argv[1] not in BENCHMARKS:
+        print("usage: python benchmark.py [{}]".format("|".join(sorted(BENCHMARKS))))
+        sys.exit(1)
+    BENCHMARKS[sys.argv[1]](*[int(arg) for arg in sys.argv[2:]])
@@ -7,9 +7,13 @@ setup(
     include_package_data=False,
     zip_safe=False,
     install_requires=[
-        "flask",
+        "flask>=2.2",
         "flask-restful",
-        "flask-sqlalchemy",
-        "SQLAlchemy",
-    ]
+        "flask-sqlalchemy>=3.1",
+        "jsonschema",
+        "SQLAlchemy>=2.0",
+    ],
+    extras_require={
+        "fast": ["orjson"],
+    }
 )
@@ -0,0 +1,100 @@
+import os
+import pytest
+import tempfile
+
+from Foodpoint.cache import ResponseCache
+from Foodpoint.cache_backends import CacheBackend, MemoryBackend, SQLiteBackend
+
+#All Python modules that either begin with test_ or end with _test are automatically detected by pytest.
+
+@pytest.fixture
+def cache_path():
+    """
+    This function gives the path of a new SQLite cache file and removes it and its WAL files afterwards.
+    """
+    cache_fd, cache_fname = tempfile.mkstemp()
+
+    yield cache_fname
+
+    os.close(cache_fd)
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(cache_fname + suffix):
+            os.unlink(cache_fname + suffix)
+
+
+def test_cache_backends(cache_path):
+    """
+    Tests the size bound, time to live and tag invalidation of each cache backend.
+    """
+    shared = SQLiteBackend(cache_path, 2)
+    shared.PRUNE_INTERVAL = 1
+    for backend in (MemoryBackend(2), shared):
+        backend.set("a", b"a", 60, backend.tag_versions(["x"]))
+        versions = backend.tag_versions(["y"])
+        backend.set("b", b"b", 60, versions)
+        assert backend.get("a") == b"a"
+        backend.set("c", b"c", 60, backend.tag_versions(["x", "y"]))
+        assert backend.stats()["entries"] == 2
+        backend.invalidate(["x"])
+        assert backend.get("a") is None and backend.get("c") is None
+        #stored after the invalidation, but with the versions read before it
+        backend.set("c", b"c", 60, dict(versions, x=0))
+        assert backend.get("c") is None
+        backend.set("c", b"c", 60, backend.tag_versions(["x", "y"]))
+        assert backend.get("c") == b"c"
+        backend.set("d", b"d", 0, {})
+        assert backend.get("d") is None
+        backend.set_many({"e": b"e", "f": b"f"}, 60)
+        assert backend.get_many(["f", "c", "e", "d"]) == [b"f", None, b"e", None]
+
+
+def test_incomplete_backend():
+    """
+    Tests that a backend missing a method of the interface can't be created.
+    """
+    class NoStats(CacheBackend):
+        def get(self, key):
+            return None
+        def tag_versions(self, tags):
+            return {}
+        def set(self, key, value, ttl, versions):
+            pass
+        def invalidate(self, tags):
+            pass
+
+    with pytest.raises(TypeError):
+        NoStats()
+    with pytest.raises(TypeError):
+        CacheBackend()
+
+
+def test_response_cache_disabled():
+    """
+    Tests that a response cache with a time to live of 0 stores nothing.
+    """
+    disabled = ResponseCache(MemoryBackend(2), 0)
+    disabled.set("/a", b"a", None, "application/json", disabled.versions([]))
+    assert disabled.get("/a") is None
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="requires fork")
+def test_sqlite_backend_fork(cache_path):
+    """
+    Tests that a forked process opens a connection of its own instead of using the one of its parent.
+    """
+    backend = SQLiteBackend(cache_path, 10)
+    assert getattr(backend.local, "connection", None) is None
+    backend.set("a", b"a", 60, {})
+    parent = backend.local.connection
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            if backend.get("a") == b"a" and backend.local.connection is not parent and backend.inherited == [parent]:
+                backend.set("b", b"b", 60, {})
+                status = 0
+        finally:
+            os._exit(status)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert backend.local.connection is parent
+    assert backend.get_many(["a", "b"]) == [b"a", b"b"]
@@ -1,9 +1,16 @@
 import os
 import pytest
 import tempfile
+import json
 
 from Foodpoint import create_app, db
-from Foodpoint.database import User, Recipe, Collection, Category, Ethnicity
+from Foodpoint.database import User, Recipe, Collection, Category, Ethnicity, RecipeCollection, Ingredient, RecipeIngredient
+from Foodpoint.database import upgrade_db_command, recount_command
+from Foodpoint.import_data import Importer, import_data_command
+from Foodpoint.export_data import export_data_command
+from Foodpoint.ingredients import tokenize_ingredients, intersect, union, index_ingredients_command
+from Foodpoint.utils import _keyset_branches
+from sqlalchemy import text
 from sqlalchemy.exc import IntegrityError, StatementError
 
 #All Python modules that either begin with test_ or end with _test are automatically detected by pytest.
@@ -357,3 +364,367 @@ def test_constraint_collection_name(app):
         with pytest.raises(IntegrityError):
             db.session.commit()
         db.session.rollback()
+
+
+def test_collection_recipe_queries(app):
+    """
+    Tests membership check and query of recipes of a collection, and that they
+    don't load the recipes relationship.
+    """
+    with app.app_context():
+        collection = _get_collection()
+        collection.user = _get_user()
+        for choice in (1, 2):
+            recipe = _get_recipe(choice)
+            recipe.category = _get_category(choice)
+            recipe.ethnicity = _get_ethnicity(choice)
+            collection.recipes.append(recipe)
+        other = _get_recipe()
+        other.category = recipe.category
+        other.ethnicity = recipe.ethnicity
+        db.session.add(collection)
+        db.session.add(other)
+        db.session.commit()
+        collection_id = collection.id
+        ids = [recipe.id for recipe in Recipe.query.order_by(Recipe.id)]
+        db.session.expunge_all()
+
+        collection = Collection.query.filter_by(id=collection_id).first()
+        assert collection.has_recipe(ids[0])
+        assert collection.has_recipe(ids[1])
+        assert not collection.has_recipe(ids[2])
+        assert collection.recipe_query.count() == 2
+        assert collection.recipe_query.filter(Recipe.title == "Chicken Masala").count() == 1
+        assert "recipes" not in collection.__dict__
+
+
+def _query_plan(query):
+    """
+    Returns the details of EXPLAIN QUERY PLAN for an ORM query.
+    """
+    sql = str(query.statement.compile(db.engine, compile_kwargs={"literal_binds": True}))
+    return [row[-1] for row in db.session.execute(text("EXPLAIN QUERY PLAN " + sql))]
+
+
+def test_hot_query_plans(app):
+    """
+    Tests that the frequent lookups by foreign key search an index instead of scanning the table.
+    """
+    with app.app_context():
+        queries = [
+            Collection.query.filter_by(userId=1),
+            Collection.query.filter_by(userId=1, name="collection-1"),
+            Recipe.query.filter_by(categoryId=1),
+            Recipe.query.filter_by(ethnicityId=1),
+            db.session.query(RecipeCollection.c.collectionId).filter(RecipeCollection.c.recipeId == 1),
+            User.query.filter_by(userName="itzkirn"),
+        ]
+        for query in queries:
+            for detail in _query_plan(query):
+                assert detail.startswith("SEARCH") and "INDEX" in detail, detail
+        #recipes of a category or ethnicity come out of the index in the order of the listing
+        for column in (Recipe.categoryId, Recipe.ethnicityId):
+            query = Recipe.query.filter(column == 1).order_by(Recipe.rating.desc(), Recipe.id.desc())
+            assert _query_plan(query) == ["SEARCH recipe USING INDEX ix_recipe_{}_rating ({}=?)".format(column.key, column.key)]
+        #pages after a cursor seek to it in the index, recipes without rating last
+        plans = [
+            _query_plan(Recipe.query.filter(Recipe.categoryId == 1, condition).order_by(Recipe.rating.desc(), Recipe.id.desc()))
+            for condition in _keyset_branches([Recipe.rating, Recipe.id], [4.0, 10], False)
+        ]
+        assert plans == [
+            ["SEARCH recipe USING INDEX ix_recipe_categoryId_rating (categoryId=? AND rating<?)"],
+            ["SEARCH recipe USING INDEX ix_recipe_categoryId_rating (categoryId=? AND rating=?)"],
+        ]
+        condition, = _keyset_branches([Recipe.rating, Recipe.id], [None, 10], False)
+        query = Recipe.query.filter(Recipe.categoryId == 1, condition).order_by(Recipe.rating.desc(), Recipe.id.desc())
+        assert _query_plan(query) == ["SEARCH recipe USING INDEX ix_recipe_categoryId_rating (categoryId=? AND rating=? AND rowid<?)"]
+        #recipes of all categories, also narrowed by rating, come out of the index on the rating without sorting
+        order = (Recipe.rating.desc(), Recipe.id.desc())
+        assert _query_plan(Recipe.query.order_by(*order)) == ["SCAN recipe USING INDEX ix_recipe_rating_id"]
+        condition = _keyset_branches([Recipe.rating, Recipe.id], [4.0, 10], False)[0]
+        query = Recipe.query.filter(Recipe.rating >= 2.0, condition).order_by(*order)
+        assert _query_plan(query) == ["SEARCH recipe USING INDEX ix_recipe_rating_id (rating>? AND rating<?)"]
+
+
+def test_upgrade_db_command(app):
+    """
+    Tests that upgrade-db creates indexes missing from an existing database and drops obsolete ones.
+    """
+    with app.app_context():
+        db.session.execute(text("DROP INDEX ix_collection_userId"))
+        db.session.execute(text('CREATE INDEX "ix_recipe_categoryId" ON recipe ("categoryId")'))
+        db.session.commit()
+        assert "SCAN" in _query_plan(Collection.query.filter_by(userId=1))[0]
+    result = app.test_cli_runner().invoke(upgrade_db_command)
+    assert "Created index ix_collection_userId" in result.output
+    assert "Dropped index ix_recipe_categoryId on recipe" in result.output
+    with app.app_context():
+        assert "ix_collection_userId" in _query_plan(Collection.query.filter_by(userId=1))[0]
+
+
+def test_search_index(app):
+    """
+    Tests that the full-text index follows recipes written through the ORM and without it, and that
+    upgrade-db adds it to a database that doesn't have it yet.
+    """
+    search = lambda q: [row[0] for row in db.session.execute(
+        text("SELECT rowid FROM recipe_fts WHERE recipe_fts MATCH :q ORDER BY rowid"), {"q": q}
+    )]
+    with app.app_context():
+        recipe = _get_recipe()
+        recipe.category = _get_category()
+        recipe.ethnicity = _get_ethnicity()
+        db.session.add(recipe)
+        db.session.commit()
+        assert search("cabonara") == [1]
+        db.session.execute(Recipe.__table__.insert(), [{
+            "title": "Imported", "description": "Raw salmon", "ingredients": "salmon",
+            "categoryId": 1, "ethnicityId": 1
+        }])
+        db.session.commit()
+        assert search("salmon") == [2]
+        recipe = Recipe.query.filter_by(title="Imported").first()
+        recipe.ingredients = "tuna"
+        db.session.commit()
+        assert search("tuna") == [2]
+        assert search("salmon") == [2]
+        recipe.description = "Raw tuna"
+        db.session.commit()
+        assert search("salmon") == []
+        db.session.delete(recipe)
+        db.session.commit()
+        assert search("tuna") == []
+
+        db.session.execute(text("DROP TABLE recipe_fts"))
+        for trigger in ("insert", "update", "delete"):
+            db.session.execute(text("DROP TRIGGER recipe_fts_" + trigger))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(upgrade_db_command)
+    assert "recipe_fts" in result.output
+    with app.app_context():
+        assert len(search(Recipe.query.first().title)) == 1
+
+
+def test_ingredient_index(app):
+    """
+    Tests tokenizing of ingredients, merging of posting lists and that the ingredient index follows
+    recipes written through the ORM.
+    """
+    assert tokenize_ingredients("2 Tomatoes, fresh basil leaves; 1 cup of cherries") == {"tomato", "basil", "leave", "cherry"}
+    assert tokenize_ingredients("Couscous, hummus, 3 eggs") == {"couscous", "hummus", "egg"}
+    assert tokenize_ingredients(None) == set()
+    assert list(intersect([[1, 3, 5, 7], [2, 3, 7, 8], [3, 4, 7]])) == [3, 7]
+    assert list(intersect([[1, 2], []])) == []
+    assert list(union([[1, 3, 5], [2, 3, 6], []])) == [1, 2, 3, 5, 6]
+
+    postings = lambda: dict(
+        (name, sorted(recipe_id for (recipe_id, ) in db.session.query(RecipeIngredient.c.recipeId).join(
+            Ingredient, Ingredient.id == RecipeIngredient.c.ingredientId
+        ).filter(Ingredient.name == name)))
+        for (name, ) in db.session.query(Ingredient.name)
+    )
+    with app.app_context():
+        first = _get_recipe()
+        second = _get_recipe(2)
+        category = _get_category()
+        ethnicity = _get_ethnicity()
+        for recipe in (first, second):
+            recipe.category = category
+            recipe.ethnicity = ethnicity
+            db.session.add(recipe)
+        db.session.commit()
+        index = postings()
+        assert index["egg"] == [first.id]
+        assert index["tomato"] == [second.id]
+        first.ingredients = "spaghetti, tomatoes"
+        db.session.commit()
+        index = postings()
+        assert index["tomato"] == [first.id, second.id]
+        assert index["egg"] == []
+        db.session.delete(second)
+        db.session.commit()
+        assert postings()["tomato"] == [first.id]
+
+        #the backfill command rebuilds lost entries and removes unused ingredients
+        db.session.execute(RecipeIngredient.delete())
+        db.session.commit()
+    result = app.test_cli_runner().invoke(index_ingredients_command)
+    assert "Indexed ingredients of 1 recipes" in result.output
+    with app.app_context():
+        assert postings() == {"spaghetti": [1], "tomato": [1]}
+
+
+def test_recipe_counts(app):
+    """
+    Tests that recount and upgrade-db compute the recipe counts, and that the counts follow recipes
+    imported without the ORM.
+    """
+    with app.app_context():
+        collection = _get_collection()
+        collection.user = _get_user()
+        category = _get_category()
+        ethnicity = _get_ethnicity()
+        for choice in (1, 2):
+            recipe = _get_recipe(choice)
+            recipe.category = category
+            recipe.ethnicity = ethnicity
+            collection.recipes.append(recipe)
+        db.session.add(collection)
+        db.session.commit()
+        assert (collection.recipeCount, category.recipeCount, ethnicity.recipeCount) == (2, 2, 2)
+        db.session.execute(Recipe.__table__.insert(), [{
+            "title": "Imported", "description": "Raw", "ingredients": "salmon",
+            "categoryId": category.id, "ethnicityId": ethnicity.id
+        }])
+        db.session.execute(text('UPDATE category SET "recipeCount" = 0'))
+        db.session.commit()
+        assert (category.recipeCount, ethnicity.recipeCount) == (0, 3)
+    result = app.test_cli_runner().invoke(recount_command)
+    assert "Recounted recipes of 1 categories" in result.output
+    with app.app_context():
+        assert Category.query.first().recipeCount == 3
+
+        db.session.execute(text('ALTER TABLE collection DROP COLUMN "recipeCount"'))
+        db.session.commit()
+    result = app.test_cli_runner().invoke(upgrade_db_command)
+    assert "Added column recipeCount to collection" in result.output
+    with app.app_context():
+        assert Collection.query.first().recipeCount == 2
+
+
+def test_sqlite_connection_settings(app):
+    """
+    Tests that each connection gets the configured SQLite settings, and that a setting can be changed
+    or left to the SQLite default through the app config.
+    """
+    with app.app_context():
+        pragma = lambda name: db.session.execute(text("PRAGMA " + name)).scalar()
+        assert pragma("foreign_keys") == 1
+        assert pragma("journal_mode") == "wal"
+        assert pragma("synchronous") == 1 #NORMAL
+        assert pragma("busy_timeout") == 5000
+        assert pragma("temp_store") == 2 #MEMORY
+
+    db_fd, db_fname = tempfile.mkstemp()
+    other = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "SQLITE_JOURNAL_MODE": None,
+        "SQLITE_SYNCHRONOUS": "FULL"
+    })
+    with other.app_context():
+        assert db.session.execute(text("PRAGMA journal_mode")).scalar() == "delete"
+        assert db.session.execute(text("PRAGMA synchronous")).scalar() == 2
+        assert db.session.execute(text("PRAGMA foreign_keys")).scalar() == 1
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_import_data_command(app):
+    """
+    Tests importing a JSON lines file where some records fail, and a CSV file.
+    """
+    records = [
+        {"type": "user", "name": "kirn", "userName": "itzkirn"},
+        {"type": "category", "name": "Pasta"},
+        {"type": "ethnicity", "name": "Italian"},
+        {"type": "collection", "id": 7, "name": "collection-1", "user": "itzkirn"},
+        {"type": "recipe", "id": 3, "title": "Spaghetti Cabonara", "description": "Classic",
+         "ingredients": "spaghetti, egg", "rating": 4.5, "category": "Pasta", "ethnicity": "Italian"},
+        {"type": "recipe-collection", "recipe": 3, "collection": 7},
+        {"type": "recipe", "title": "Lasagne", "description": "Layers", "ingredients": "pasta, sauce",
+         "category": "Pasta", "ethnicity": "Italian", "user": "itzkirn", "collection": "collection-1"},
+        {"type": "user", "name": "kirn again", "userName": "itzkirn"},
+        {"type": "recipe", "title": "Curry", "description": "Hot", "ingredients": "chicken",
+         "category": "Curry", "ethnicity": "Italian"},
+    ]
+    db_fd, path = tempfile.mkstemp(suffix=".jsonl")
+    with os.fdopen(db_fd, "w") as stream:
+        for record in records:
+            stream.write(json.dumps(record) + "\n")
+        stream.write("not json\n")
+    result = app.test_cli_runner().invoke(import_data_command, [path, "--batch-size", "3"])
+    os.unlink(path)
+    assert "line 8: User itzkirn already exists" in result.output
+    assert "line 9: Category Curry does not exist" in result.output
+    assert "line 10: Invalid JSON" in result.output
+    assert "Imported 8 rows" in result.output
+    with app.app_context():
+        assert User.query.count() == 1
+        collection = Collection.query.first()
+        assert collection.recipe_query.count() == 2
+        assert Recipe.query.filter_by(title="Spaghetti Cabonara").first().rating == 4.5
+        #imported recipes are in the ingredient index
+        assert sorted(name for (name, ) in db.session.query(Ingredient.name)) == ["egg", "pasta", "sauce", "spaghetti"]
+        assert db.session.query(RecipeIngredient).count() == 4
+
+    db_fd, path = tempfile.mkstemp(suffix=".csv")
+    with os.fdopen(db_fd, "w") as stream:
+        stream.write("name,userName\njohn,johndoe\njane,janedoe\n")
+    result = app.test_cli_runner().invoke(import_data_command, [path, "--kind", "user"])
+    os.unlink(path)
+    assert "Imported 2 rows" in result.output
+    with app.app_context():
+        assert User.query.count() == 3
+
+
+def test_import_with_concurrent_writes(app):
+    """
+    Tests that rows written by someone else while records are being collected don't collide with the
+    imported rows, and that records referring to a row that failed to import fail too.
+    """
+    with app.app_context():
+        importer = Importer(100)
+        importer.add({"type": "user", "name": "kirn", "userName": "itzkirn"}, 1)
+        importer.add({"type": "collection", "name": "collection-1", "user": "itzkirn"}, 2)
+        importer.add({"type": "user", "name": "taken", "userName": "taken"}, 3)
+        importer.add({"type": "collection", "name": "collection-2", "user": "taken"}, 4)
+        #written through the API after the importer read the existing rows
+        db.session.add(User(name="other", userName="taken"))
+        db.session.add(User(name="another", userName="another"))
+        db.session.commit()
+        failures = importer.flush()
+        assert [line for line, error in failures] == [3, 4]
+        assert importer.imported == 2
+        user = User.query.filter_by(userName="itzkirn").first()
+        assert user.id == importer.users["itzkirn"].value == 3
+        assert Collection.query.one().user == user
+
+        importer.add({"type": "collection", "name": "collection-3", "user": "taken"}, 5)
+        assert importer.flush() == [(5, "Refers to a row that was not imported")]
+        assert Collection.query.count() == 1
+
+
+def test_export_import_round_trip(app):
+    """
+    Tests that the output of export-data can be imported into an empty database with import-data.
+    """
+    with app.app_context():
+        user = _get_user()
+        collection = _get_collection()
+        collection.user = user
+        for choice in (1, 2):
+            recipe = _get_recipe(choice)
+            recipe.category = _get_category(choice)
+            recipe.ethnicity = _get_ethnicity(choice)
+            collection.recipes.append(recipe)
+        db.session.add(collection)
+        db.session.commit()
+    db_fd, path = tempfile.mkstemp(suffix=".jsonl")
+    os.close(db_fd)
+    result = app.test_cli_runner().invoke(export_data_command, [path])
+    assert "Exported 10 records" in result.output
+
+    db_fd, db_fname = tempfile.mkstemp()
+    other = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname})
+    with other.app_context():
+        db.create_all()
+    result = other.test_cli_runner().invoke(import_data_command, [path])
+    assert "Imported 10 rows" in result.output
+    with other.app_context():
+        collection = Collection.query.first()
+        assert collection.user.userName == "itzkirn"
+        assert sorted(recipe.title for recipe in collection.recipes) == ["Chicken Masala", "Spaghetti Cabonara"]
+        assert Recipe.query.filter_by(title="Chicken Masala").first().category.name == "Curry"
+    os.unlink(path)
+    os.close(db_fd)
+    os.unlink(db_fname)
@@ -2,11 +2,13 @@ import os
 import pytest
 import tempfile
 import json
+import tracemalloc
 
 from Foodpoint import create_app, db
-from Foodpoint.database import User, Recipe, Collection, Category, Ethnicity
+from Foodpoint.database import User, Recipe, Collection, Category, Ethnicity, RecipeCollection
 from sqlalchemy.exc import IntegrityError, StatementError
 from jsonschema import validate
+from sqlalchemy import event, text
 
 #All Python modules that either begin with test_ or end with _test are automatically detected by pytest.
 
@@ -197,6 +199,41 @@ def _get_ethnicity_json(number=1):
     """
     return {"name": "Test-Ethnicity-{}".format(number)}
 
+def _loaded_objects(client, url):
+    """
+    Returns the users, categories, ethnicities and collections loaded as objects while getting a list
+    """
+    loaded = []
+    def record_load(target, context):
+        loaded.append(target)
+    models = (User, Category, Ethnicity, Collection)
+    for model in models:
+        event.listen(model, "load", record_load)
+    try:
+        resp = client.get(url)
+    finally:
+        for model in models:
+            event.remove(model, "load", record_load)
+    assert resp.status_code == 200
+    assert json.loads(resp.data)["items"]
+    return loaded
+
+def _stream_peak(client, url, headers):
+    """Returns the items of a streamed response and the peak memory allocated while reading it"""
+    #the body is kept in a file so that only the memory of the server is measured
+    with tempfile.TemporaryFile() as body:
+        tracemalloc.start()
+        try:
+            resp = client.get(url, headers=headers)
+            assert "Content-Length" not in resp.headers
+            for chunk in resp.response:
+                body.write(chunk)
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        body.seek(0)
+        return json.loads(body.read()), peak
+
 class TestAllUsers(object):
     RESOURCE_URL = "/api/users/"
 
@@ -238,6 +275,112 @@ class TestAllUsers(object):
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
 
+    def test_get_pagination(self, client):
+        """Tests for AllUsers GET method with limit, after and before"""
+        resp = client.get(self.RESOURCE_URL + "?limit=2")
+        assert resp.status_code == 200
+        first = json.loads(resp.data)
+        assert [item["userName"] for item in first["items"]] == ["user-1", "user-2"]
+        assert "prev" not in first["@controls"]
+        resp = client.get(first["@controls"]["next"]["href"])
+        assert resp.status_code == 200
+        second = json.loads(resp.data)
+        assert [item["userName"] for item in second["items"]] == ["user-3"]
+        assert "next" not in second["@controls"]
+        resp = client.get(second["@controls"]["prev"]["href"])
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["items"] == first["items"]
+
+        #test invalid limit and cursor
+        resp = client.get(self.RESOURCE_URL + "?limit=zero")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?limit=0")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?after=not-a-cursor")
+        assert resp.status_code == 400
+
+    def test_get_conditional(self, client):
+        """Tests for AllUsers GET method with If-None-Match"""
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": "W/" + etag})
+        assert resp.status_code == 304
+        #admins get other representations at the same URL
+        assert "Authorization" in resp.headers["Vary"]
+        assert "Authorization" in client.get(self.RESOURCE_URL).headers["Vary"]
+        assert "Authorization" in client.get(self.RESOURCE_URL + "?limit=1000").headers["Vary"]
+
+    def test_get_without_objects(self, client):
+        """Tests that the list of users reads rows without loading objects"""
+        assert _loaded_objects(client, self.RESOURCE_URL) == []
+
+    def test_get_fragment_cache(self, client):
+        """Tests that users are served from the fragment cache and rebuilt when they change"""
+        stats = client.application.extensions["fragment_cache"].stats
+        users = json.loads(client.get(self.RESOURCE_URL).data)
+        assert stats() == {"hits": 0, "misses": 3}
+        assert json.loads(client.get(self.RESOURCE_URL).data) == users
+        assert stats() == {"hits": 3, "misses": 3}
+        client.put("/api/users/user-1/", json={"name": "renamed", "userName": "user-1"})
+        renamed = json.loads(client.get(self.RESOURCE_URL).data)
+        assert [item["name"] for item in renamed["items"]] == ["renamed"] + [item["name"] for item in users["items"][1:]]
+        assert renamed["@controls"] == users["@controls"]
+        assert stats() == {"hits": 5, "misses": 4}
+
+        client.application.extensions["fragment_cache"].ttl = 0
+        assert client.get(self.RESOURCE_URL).data == client.get(self.RESOURCE_URL).data
+        assert stats()["misses"] == 4
+
+    def test_get_streamed(self, client):
+        """Tests that admins get large pages streamed with the same items and cursors as regular pages"""
+        client.application.config["ADMIN_TOKEN"] = "secret"
+        headers = {"Authorization": "Bearer secret"}
+        with client.application.app_context():
+            db.session.execute(User.__table__.insert(), [
+                {"name": "Streamed {}".format(i), "userName": "streamed-{:05}".format(i)} for i in range(1200)
+            ])
+            db.session.commit()
+            names = [name for (name, ) in db.session.query(User.userName).order_by(User.id)]
+
+        #regular clients are limited to MAX_PAGE_SIZE
+        resp = client.get(self.RESOURCE_URL + "?limit=1000")
+        assert "Content-Length" in resp.headers
+        assert len(json.loads(resp.data)["items"]) == 100
+
+        first, peak = _stream_peak(client, self.RESOURCE_URL + "?limit=1000", headers)
+        assert [item["userName"] for item in first["items"]] == names[:1000]
+        assert "prev" not in first["@controls"]
+        assert first["@controls"]["fpoint:add-user"]["method"] == "POST"
+        second, peak = _stream_peak(client, first["@controls"]["next"]["href"], headers)
+        assert [item["userName"] for item in second["items"]] == names[1000:]
+        assert "next" not in second["@controls"]
+        #pages before a cursor are streamed in order too
+        previous, peak = _stream_peak(client, second["@controls"]["prev"]["href"], headers)
+        assert previous["items"] == first["items"]
+        assert previous["@controls"]["next"] == first["@controls"]["next"]
+        assert "prev" not in previous["@controls"]
+        before = second["@controls"]["prev"]["href"].split("before=")[1].split("&")[0]
+        middle, peak = _stream_peak(client, self.RESOURCE_URL + "?limit=500&before=" + before, headers)
+        assert [item["userName"] for item in middle["items"]] == names[500:1000]
+        assert "prev" in middle["@controls"]
+
+    def test_get_streamed_memory(self, client):
+        """Tests that the memory used by a streamed page depends on the chunk size and not on the page size"""
+        client.application.config["ADMIN_TOKEN"] = "secret"
+        headers = {"Authorization": "Bearer secret"}
+        with client.application.app_context():
+            db.session.execute(User.__table__.insert(), [
+                {"name": "Streamed {}".format(i), "userName": "streamed-{:05}".format(i)} for i in range(20000)
+            ])
+            db.session.commit()
+        _stream_peak(client, self.RESOURCE_URL + "?limit=1000", headers)
+        small, small_peak = _stream_peak(client, self.RESOURCE_URL + "?limit=2000", headers)
+        large, large_peak = _stream_peak(client, self.RESOURCE_URL + "?limit=20000", headers)
+        assert len(small["items"]) == 2000 and len(large["items"]) == 20000
+        #ten times the items must not take noticeably more memory
+        assert large_peak < small_peak * 1.25
+
 class TestUser(object):
     RESOURCE_URL = "/api/users/user-1/"
     INVALID_URL = "/api/users/non-exist/"
@@ -264,6 +407,26 @@ class TestUser(object):
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_conditional(self, client):
+        """Tests for User GET method with If-None-Match"""
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        assert resp.headers["ETag"] == etag
+        assert resp.data == b""
+        #If-None-Match compares weakly, proxies may weaken the ETags they pass on
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": "W/" + etag})
+        assert resp.status_code == 304
+
+        #representation changes after PUT so the old ETag doesn't match anymore
+        valid = _get_user_json()
+        valid["userName"] = "user-1"
+        client.put(self.RESOURCE_URL, json=valid)
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        assert resp.headers["ETag"] != etag
+
     def test_put(self, client):
         """Tests for User PUT method"""
         valid = _get_user_json()
@@ -309,6 +472,19 @@ class TestUser(object):
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_get_control_templates(self, client):
+        """Tests that documents get their own copy of the shared control templates"""
+        from Foodpoint.resources import FoodpointBuilder, CONTROL_TEMPLATES
+        with client.application.test_request_context():
+            first = FoodpointBuilder()
+            first.add_control_edit_user("user-1")
+            second = FoodpointBuilder()
+            second.add_control_edit_user("user-2")
+        assert first["@controls"]["edit"]["href"].endswith("/user-1/")
+        assert second["@controls"]["edit"]["href"].endswith("/user-2/")
+        assert "href" not in CONTROL_TEMPLATES["edit_user"]
+        assert first["@controls"]["edit"]["schema"] == FoodpointBuilder.user_schema()
+
 class TestCollectionsByUser(object):
 
     RESOURCE_URL = "/api/users/user-1/collections/"
@@ -321,6 +497,7 @@ class TestCollectionsByUser(object):
         body = json.loads(resp.data)
         #in _populate_db we added two collections for each user
         assert len(body["items"]) == 2
+        assert [item["recipeCount"] for item in body["items"]] == [2, 2]
         _check_namespace(client, body)
         _check_control_post_method("fpoint:add-collection", client, _get_collection_json(), body)
         for item in body["items"]:
@@ -359,6 +536,110 @@ class TestCollectionsByUser(object):
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
 
+    def test_get_without_objects(self, client):
+        """Tests that the list of collections reads rows without loading objects"""
+        assert _loaded_objects(client, self.RESOURCE_URL) == []
+        assert client.get(self.INVALID_URL).status_code == 404
+
+    def test_get_recipe_counts(self, client):
+        """Tests that the recipe counts of lists follow every way of adding, moving and removing recipes"""
+        collection_url = self.RESOURCE_URL + "Collection1-of-User1/"
+        counts = lambda url: [item["recipeCount"] for item in json.loads(client.get(url).data)["items"]]
+        client.post(collection_url, json=_get_recipe_json(1))
+        client.post(collection_url + "batch/", json=[_get_recipe_json(2), _get_recipe_json(3)])
+        #recipes 3 and 4 are in Collection2-of-User1, 3 is linked twice
+        client.post(collection_url + "links/", json={"recipes": [3, 4]})
+        client.post(collection_url + "links/", json={"recipes": [3]})
+        assert counts(self.RESOURCE_URL) == [7, 2]
+        assert counts("/api/categories/") == [7, 4, 4]
+
+        moved = _get_recipe_json()
+        moved["category"] = "category2"
+        client.put(collection_url + "1/", json=moved)
+        assert counts("/api/categories/") == [6, 5, 4]
+        client.delete(collection_url + "2/")
+        client.delete(collection_url + "3/")
+        assert counts(self.RESOURCE_URL) == [5, 2]
+        assert counts("/api/categories/") == [5, 5, 4]
+        assert counts("/api/ethnicities/") == [6, 4, 4]
+        client.delete(self.RESOURCE_URL + "Collection2-of-User1/")
+        assert counts(self.RESOURCE_URL) == [5]
+
+    def test_get_cached(self, client, monkeypatch):
+        """Tests that cached GET responses are served without the database or JSON encoding until a write evicts them"""
+        first = client.get(self.RESOURCE_URL)
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        encoded = []
+        encoder = client.application.extensions["json_encoder"]
+        def record_encoding(obj):
+            encoded.append(obj)
+            return encoder(obj)
+        with client.application.app_context():
+            event.listen(db.engine, "before_cursor_execute", count)
+            monkeypatch.setitem(client.application.extensions, "json_encoder", record_encoding)
+            try:
+                second = client.get(self.RESOURCE_URL)
+                not_modified = client.get(self.RESOURCE_URL, headers={"If-None-Match": first.headers["ETag"]})
+            finally:
+                monkeypatch.undo()
+                event.remove(db.engine, "before_cursor_execute", count)
+        assert statements == []
+        assert encoded == []
+        assert second.data == first.data
+        assert second.headers["ETag"] == first.headers["ETag"]
+        assert not_modified.status_code == 304
+
+        #renaming a collection evicts the list of collections of its user
+        valid = _get_collection_json()
+        resp = client.put(self.RESOURCE_URL + "Collection1-of-User1/", json=valid)
+        assert resp.status_code == 204
+        names = [item["name"] for item in json.loads(client.get(self.RESOURCE_URL).data)["items"]]
+        assert valid["name"] in names
+        stats = client.application.extensions["response_cache"].stats()
+        assert stats["hits"] == 2
+        assert stats["invalidations"] == 1
+        assert stats["backend"]["backend"] == "memory"
+
+        #the same path under another root has links of its own
+        mounted = client.get(self.RESOURCE_URL, base_url="http://localhost/mounted/")
+        assert json.loads(mounted.data)["@controls"]["self"]["href"] == "/mounted" + self.RESOURCE_URL
+        assert json.loads(client.get(self.RESOURCE_URL).data)["@controls"]["self"]["href"] == self.RESOURCE_URL
+
+    def test_get_shared_cache(self, client):
+        """Tests that two processes with a shared cache backend see each other's entries and invalidations"""
+        cache_fd, cache_fname = tempfile.mkstemp()
+        config = {
+            "SQLALCHEMY_DATABASE_URI": client.application.config["SQLALCHEMY_DATABASE_URI"],
+            "TESTING": True,
+            "CACHE_BACKEND": "sqlite",
+            "CACHE_PATH": cache_fname
+        }
+        first = create_app(config).test_client()
+        second = create_app(config).test_client()
+        try:
+            first.get(self.RESOURCE_URL)
+            second.get(self.RESOURCE_URL)
+            assert second.application.extensions["response_cache"].stats()["hits"] == 1
+            #a write through one process evicts the response of both
+            valid = _get_collection_json()
+            assert first.put(self.RESOURCE_URL + "Collection1-of-User1/", json=valid).status_code == 204
+            names = [item["name"] for item in json.loads(second.get(self.RESOURCE_URL).data)["items"]]
+            assert valid["name"] in names
+            assert second.application.extensions["response_cache"].stats()["hits"] == 1
+
+            #ids of categories read by one process are found by the other
+            collection_url = self.RESOURCE_URL + "Collection2-of-User1/"
+            assert first.post(collection_url, json=_get_recipe_json(1)).status_code == 201
+            assert second.post(collection_url, json=_get_recipe_json(2)).status_code == 201
+            stats = second.application.extensions["lookup_cache"].stats()
+            assert stats["category"]["hits"] == 1 and stats["category"]["misses"] == 0
+        finally:
+            os.close(cache_fd)
+            for suffix in ("", "-wal", "-shm"):
+                if os.path.exists(cache_fname + suffix):
+                    os.unlink(cache_fname + suffix)
 
 class TestCollection(object):
 
@@ -379,6 +660,7 @@ class TestCollection(object):
         _check_profile_get_method("profile", client, body)
         _check_control_get_method("fpoint:collections-by", client, body)
         _check_control_post_method("fpoint:add-recipe", client, _get_recipe_json(), body)
+        _check_control_post_method("fpoint:add-recipes", client, [_get_recipe_json(2), _get_recipe_json(3)], body)
         for item in body["items"]:
             assert "title" in item
             _check_control_get_method("self", client, item)
@@ -396,6 +678,47 @@ class TestCollection(object):
         resp = client.get(self.INVALID_URL_NOUSER)
         assert resp.status_code == 404
 
+    def test_get_query(self, client):
+        """Tests for Collection GET method with filters, sorting and pagination"""
+        for number, rating in ((1, 4.0), (2, 2.5), (3, 4.5)):
+            valid = _get_recipe_json(number)
+            valid["rating"] = rating
+            valid["category"] = "category2"
+            resp = client.post(self.RESOURCE_URL, json=valid)
+            assert resp.status_code == 201
+
+        resp = client.get(self.RESOURCE_URL + "?category=category2&sort=-rating")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["Extra-Recipe-3", "Extra-Recipe-1", "Extra-Recipe-2"]
+
+        resp = client.get(self.RESOURCE_URL + "?min_rating=4&sort=title")
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["Extra-Recipe-1", "Extra-Recipe-3"]
+
+        #walk through all pages, unrated recipes come last when sorting by descending rating
+        resp = client.get(self.RESOURCE_URL + "?sort=-rating&limit=2")
+        body = json.loads(resp.data)
+        titles = [item["title"] for item in body["items"]]
+        while "next" in body["@controls"]:
+            body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+            titles.extend(item["title"] for item in body["items"])
+        assert titles == ["Extra-Recipe-3", "Extra-Recipe-1", "Extra-Recipe-2",
+                          "test-col1-recipe2", "test-col1-recipe1"]
+        resp = client.get(body["@controls"]["prev"]["href"])
+        body = json.loads(resp.data)
+        assert [item["title"] for item in body["items"]] == ["Extra-Recipe-2", "test-col1-recipe2"]
+
+        resp = client.get(self.RESOURCE_URL + "?ethnicity=ethnicity2")
+        body = json.loads(resp.data)
+        assert body["items"] == []
+
+        #test invalid parameters
+        resp = client.get(self.RESOURCE_URL + "?sort=author")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?min_rating=high")
+        assert resp.status_code == 400
+
     def test_post(self, client):
         """Tests for Collection POST method"""
         valid = _get_recipe_json()
@@ -445,6 +768,25 @@ class TestCollection(object):
         assert body["title"] == "Extra-Recipe-2"
         assert body["rating"] == 5.0
 
+    def test_post_loaded_recipes(self, client):
+        """Tests that adding a recipe doesn't load the recipes already in the collection"""
+        for i in range(3, 203):
+            client.post(self.RESOURCE_URL, json=_get_recipe_json(i))
+        loaded = []
+        def count(target, context):
+            loaded.append(target)
+        event.listen(Recipe, "load", count)
+        try:
+            resp = client.post(self.RESOURCE_URL, json=_get_recipe_json(203))
+        finally:
+            event.remove(Recipe, "load", count)
+        assert resp.status_code == 201
+        assert loaded == []
+        with client.application.app_context():
+            collection = Collection.query.filter_by(name="Collection1-of-User1").first()
+            assert collection.recipe_query.count() == 203
+            assert collection.has_recipe(int(resp.headers["Location"].rstrip("/").split("/")[-1]))
+
     def test_put(self, client):
         """Tests for Collection PUT method"""
         valid = _get_collection_json()
@@ -499,6 +841,155 @@ class TestCollection(object):
         resp = client.delete(self.INVALID_URL_NOUSER)
         assert resp.status_code == 404
 
+    def test_get_fragment_cache(self, client):
+        """Tests that recipes are served from the fragment cache and rebuilt when they change"""
+        import Foodpoint.resources
+        stats = client.application.extensions["fragment_cache"].stats
+        first = client.get(self.RESOURCE_URL)
+        assert stats() == {"hits": 0, "misses": 2}
+        built = []
+        url_for = Foodpoint.resources.api.url_for
+        def record_url_for(resource, **values):
+            built.append(resource)
+            return url_for(resource, **values)
+        Foodpoint.resources.api.url_for = record_url_for
+        try:
+            second = client.get(self.RESOURCE_URL)
+        finally:
+            Foodpoint.resources.api.url_for = url_for
+        assert second.data == first.data
+        assert Foodpoint.resources.EachRecipe not in built
+        assert stats() == {"hits": 2, "misses": 2}
+
+        #only the changed item is built again
+        client.put(self.RESOURCE_URL + "1/", json=_get_recipe_json())
+        items = json.loads(client.get(self.RESOURCE_URL).data)["items"]
+        assert items[0]["title"] == _get_recipe_json()["title"]
+        assert stats() == {"hits": 3, "misses": 3}
+
+    def test_get_json_encoders(self, client):
+        """Tests that every JSON encoder, also one that isn't compact, gives the same documents"""
+        from Foodpoint.utils import JSON_ENCODERS
+        config = {"SQLALCHEMY_DATABASE_URI": client.application.config["SQLALCHEMY_DATABASE_URI"], "TESTING": True}
+        pretty = lambda document: json.dumps(document, indent=2).encode("utf-8") + b"\n"
+        for encoder in list(JSON_ENCODERS) + [pretty]:
+            other = create_app(dict(config, JSON_ENCODER=encoder)).test_client()
+            for url in (self.RESOURCE_URL, self.RESOURCE_URL + "1/", self.INVALID_URL):
+                expected = client.get(url)
+                resp = other.get(url)
+                assert resp.status_code == expected.status_code
+                assert resp.mimetype == expected.mimetype
+                assert json.loads(resp.data) == json.loads(expected.data)
+
+    def test_get_streamed(self, client):
+        """Tests that admins get large pages of recipes streamed with their filters and order"""
+        client.application.config["ADMIN_TOKEN"] = "secret"
+        headers = {"Authorization": "Bearer secret"}
+        with client.application.app_context():
+            collection = Collection.query.filter_by(name="Collection1-of-User1").first()
+            recipe = Recipe.query.first()
+            db.session.execute(Recipe.__table__.insert(), [
+                {"title": "Streamed {:04}".format(i), "description": "", "ingredients": "", "rating": i % 5,
+                 "categoryId": recipe.categoryId, "ethnicityId": recipe.ethnicityId} for i in range(300)
+            ])
+            ids = [recipe_id for (recipe_id, ) in db.session.query(Recipe.id).filter(Recipe.title.like("Streamed%"))]
+            db.session.execute(RecipeCollection.insert(), [{"recipeId": i, "collectionId": collection.id} for i in ids])
+            db.session.commit()
+            expected = [title for (title, ) in collection.recipe_query.with_entities(Recipe.title).order_by(
+                Recipe.title.desc(), Recipe.id.desc())]
+        first, peak = _stream_peak(client, self.RESOURCE_URL + "?sort=-title&limit=200", headers)
+        second, peak = _stream_peak(client, first["@controls"]["next"]["href"], headers)
+        assert "Authorization" in client.get(self.RESOURCE_URL + "?limit=200", headers=headers).headers["Vary"]
+        assert "Authorization" in client.get(self.RESOURCE_URL).headers["Vary"]
+        assert first["name"] == "Collection1-of-User1"
+        assert [item["title"] for item in first["items"] + second["items"]] == expected
+        assert "sort=-title" in second["@controls"]["prev"]["href"]
+        assert second["items"][0]["@controls"]["self"]["href"].startswith(self.RESOURCE_URL)
+
+class TestRecipeBatch(object):
+
+    RESOURCE_URL = "/api/users/user-1/collections/Collection1-of-User1/batch/"
+    INVALID_URL = "/api/users/user-1/collections/Not-Exist-Collection/batch/"
+    COLLECTION_URL = "/api/users/user-1/collections/Collection1-of-User1/"
+
+    def test_post(self, client):
+        """Tests for RecipeBatch POST method"""
+        documents = [_get_recipe_json(number) for number in range(1, 4)]
+        resp = client.post(self.RESOURCE_URL, json=documents)
+        assert resp.status_code == 201
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [201, 201, 201]
+        for item, document in zip(body["items"], documents):
+            resp = client.get(item["location"])
+            assert json.loads(resp.data)["title"] == document["title"]
+        body = json.loads(client.get(self.COLLECTION_URL).data)
+        assert len(body["items"]) == 5
+
+        #test partial success, only the valid recipes are created
+        invalid = _get_recipe_json(5)
+        invalid.pop("title")
+        unknown = _get_recipe_json(6)
+        unknown["category"] = "Not-Exist-Category"
+        resp = client.post(self.RESOURCE_URL, json=[_get_recipe_json(4), invalid, unknown])
+        assert resp.status_code == 207
+        body = json.loads(resp.data)
+        assert [item["status"] for item in body["items"]] == [201, 400, 409]
+        assert "@error" in body["items"][1]
+        body = json.loads(client.get(self.COLLECTION_URL).data)
+        assert len(body["items"]) == 6
+
+        #test wrong content type, not an array, empty array and not existing collection
+        resp = client.post(self.RESOURCE_URL, data=json.dumps(documents))
+        assert resp.status_code == 415
+        resp = client.post(self.RESOURCE_URL, json=documents[0])
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, json=[])
+        assert resp.status_code == 400
+        resp = client.post(self.INVALID_URL, json=documents)
+        assert resp.status_code == 404
+
+class TestRecipeLinks(object):
+
+    RESOURCE_URL = "/api/users/user-1/collections/Collection1-of-User1/links/"
+    INVALID_URL = "/api/users/user-1/collections/Not-Exist-Collection/links/"
+    COLLECTION_URL = "/api/users/user-1/collections/Collection1-of-User1/"
+    OTHER_COLLECTION_URL = "/api/users/user-1/collections/Collection2-of-User1/"
+
+    def test_post(self, client):
+        """Tests for RecipeLinks POST method"""
+        body = json.loads(client.get(self.COLLECTION_URL).data)
+        assert body["@controls"]["fpoint:link-recipes"]["href"] == self.RESOURCE_URL
+        #recipes 3 and 4 are in the other collection of the user, 1 is already in this one
+        valid = {"recipes": [3, 4, 1]}
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 204
+        resp = client.post(self.RESOURCE_URL, json=valid)
+        assert resp.status_code == 204
+        body = json.loads(client.get(self.COLLECTION_URL).data)
+        assert len(body["items"]) == 4
+        resp = client.get(self.COLLECTION_URL + "3/")
+        assert resp.status_code == 200
+
+        #removing a shared recipe from one collection keeps it in the other
+        resp = client.delete(self.COLLECTION_URL + "3/")
+        assert resp.status_code == 204
+        resp = client.get(self.OTHER_COLLECTION_URL + "3/")
+        assert resp.status_code == 200
+        resp = client.delete(self.OTHER_COLLECTION_URL + "3/")
+        assert resp.status_code == 204
+        resp = client.post(self.RESOURCE_URL, json={"recipes": [3]})
+        assert resp.status_code == 409
+
+        #test not existing recipe, invalid document, wrong content type and not existing collection
+        resp = client.post(self.RESOURCE_URL, json={"recipes": [4, 100]})
+        assert resp.status_code == 409
+        resp = client.post(self.RESOURCE_URL, json={"recipes": ["4"]})
+        assert resp.status_code == 400
+        resp = client.post(self.RESOURCE_URL, data=json.dumps(valid))
+        assert resp.status_code == 415
+        resp = client.post(self.INVALID_URL, json=valid)
+        assert resp.status_code == 404
+
 class TestRecipe(object):
 
     RESOURCE_URL = "/api/users/user-1/collections/Collection1-of-User1/1/"
@@ -531,6 +1022,24 @@ class TestRecipe(object):
         resp = client.get(self.INVALID_URL_NOCOL)
         assert resp.status_code == 404
 
+    def test_get_query_count(self, client):
+        """Tests that Recipe GET runs a single SQL statement, also when the recipe is not found"""
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", count)
+        try:
+            for url, status in ((self.RESOURCE_URL, 200), (self.INVALID_URL, 404),
+                                (self.INVALID_URL_NOUSER, 404), (self.INVALID_URL_NOCOL, 404)):
+                del statements[:]
+                resp = client.get(url)
+                assert resp.status_code == status
+                assert len(statements) == 1
+        finally:
+            event.remove(engine, "before_cursor_execute", count)
+
     def test_put(self, client):
         """Tests for Recipe PUT method"""
         #test valid
@@ -593,6 +1102,47 @@ class TestRecipe(object):
         resp = client.delete(self.INVALID_URL_NOCOL)
         assert resp.status_code == 404
 
+    def test_put_lookup_cache(self, client):
+        """Tests that category and ethnicity names are resolved from the cache and that renames invalidate it"""
+        collection_url = "/api/users/user-1/collections/Collection1-of-User1/"
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        client.put(self.RESOURCE_URL, json=_get_recipe_json())
+        with client.application.app_context():
+            event.listen(db.engine, "before_cursor_execute", count)
+            try:
+                resp = client.put(self.RESOURCE_URL, json=_get_recipe_json())
+            finally:
+                event.remove(db.engine, "before_cursor_execute", count)
+        assert resp.status_code == 204
+        assert not any("FROM category" in statement or "FROM ethnicity" in statement for statement in statements)
+
+        #rename through the API, the old name is no longer found
+        client.put("/api/categories/category1/", json=_get_category_json())
+        resp = client.post(collection_url, json=_get_recipe_json())
+        assert resp.status_code == 409
+        renamed = _get_recipe_json()
+        renamed["category"] = _get_category_json()["name"]
+        resp = client.post(collection_url, json=renamed)
+        assert resp.status_code == 201
+
+        #rename by another process, noticed through the generation once the cache checks it again
+        client.application.extensions["lookup_cache"].max_age = 0
+        other = _get_recipe_json(2)
+        other["category"] = "category2"
+        client.post(collection_url, json=other)
+        with client.application.app_context():
+            db.session.execute(text("UPDATE category SET name = 'renamed' WHERE name = 'category2'"))
+            db.session.commit()
+        resp = client.post(collection_url, json=other)
+        assert resp.status_code == 201 #stale entry until the generation changes
+        with client.application.app_context():
+            db.session.execute(text("UPDATE cache_generation SET generation = generation + 1 WHERE name = 'category'"))
+            db.session.commit()
+        resp = client.post(collection_url, json=other)
+        assert resp.status_code == 409
+
 class TestAllCategories(object):
 
     RESOURCE_URL = "/api/categories/"
@@ -604,6 +1154,7 @@ class TestAllCategories(object):
         body = json.loads(resp.data)
         assert len(body["items"]) == 3 #3 categories are added
         _check_namespace(client, body)
+        assert [item["recipeCount"] for item in body["items"]] == [4, 4, 4]
         _check_control_get_method("fpoint:all-users", client, body)
         _check_control_post_method("fpoint:add-category", client, _get_category_json(), body)
         for item in body["items"]:
@@ -612,6 +1163,19 @@ class TestAllCategories(object):
             assert "name" in item
             assert "description" in item
 
+    def test_get_conditional(self, client):
+        """Tests for AllCategories GET method with If-None-Match"""
+        resp = client.get(self.RESOURCE_URL)
+        etag = resp.headers["ETag"]
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 304
+        #another page has a different ETag
+        resp = client.get(self.RESOURCE_URL + "?limit=1", headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+        client.post(self.RESOURCE_URL, json=_get_category_json())
+        resp = client.get(self.RESOURCE_URL, headers={"If-None-Match": etag})
+        assert resp.status_code == 200
+
     def test_post(self, client):
         """Tests for AllCategories POST method"""
         #test valid
@@ -638,6 +1202,22 @@ class TestAllCategories(object):
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
 
+    def test_get_pagination(self, client):
+        """Tests for AllCategories GET method with limit and after"""
+        resp = client.get(self.RESOURCE_URL + "?limit=1")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        names = [item["name"] for item in body["items"]]
+        while "next" in body["@controls"]:
+            resp = client.get(body["@controls"]["next"]["href"])
+            body = json.loads(resp.data)
+            names.extend(item["name"] for item in body["items"])
+        assert names == ["category1", "category2", "category3"]
+
+    def test_get_without_objects(self, client):
+        """Tests that the list of categories reads rows without loading objects"""
+        assert _loaded_objects(client, self.RESOURCE_URL) == []
+
 class TestCategory(object):
 
     RESOURCE_URL = "/api/categories/category1/"
@@ -707,6 +1287,7 @@ class TestAllEthnicities(object):
         body = json.loads(resp.data)
         assert len(body["items"]) == 3 #3 categories are added
         _check_namespace(client, body)
+        assert [item["recipeCount"] for item in body["items"]] == [4, 4, 4]
         _check_control_get_method("fpoint:all-users", client, body)
         _check_control_post_method("fpoint:add-ethnicity", client, _get_ethnicity_json(), body)
         for item in body["items"]:
@@ -741,6 +1322,10 @@ class TestAllEthnicities(object):
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 400
 
+    def test_get_without_objects(self, client):
+        """Tests that the list of ethnicities reads rows without loading objects"""
+        assert _loaded_objects(client, self.RESOURCE_URL) == []
+
 class TestEthnicity(object):
 
     RESOURCE_URL = "/api/ethnicities/ethnicity1/"
@@ -798,3 +1383,269 @@ class TestEthnicity(object):
         assert resp.status_code == 200
         body = json.loads(resp.data)
         assert body["name"] == valid["name"]
+
+class TestRecipeSearch(object):
+
+    RESOURCE_URL = "/api/recipes/search/"
+    COLLECTION_URL = "/api/users/user-1/collections/Collection1-of-User1/"
+
+    def test_get(self, client):
+        """Tests for RecipeSearch GET method"""
+        resp = client.get(self.RESOURCE_URL + "?q=col2 recipe1")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        #one recipe per user matches both words, see _populate_db
+        assert [item["title"] for item in body["items"]] == ["test-col2-recipe1"] * 3
+        for item in body["items"]:
+            assert client.get(item["@controls"]["self"]["href"]).status_code == 200
+        assert "fpoint:search-recipes" in json.loads(client.get("/api/").data)["@controls"]
+
+        #test pagination over ranked results
+        resp = client.get(self.RESOURCE_URL + "?q=description&limit=5")
+        body = json.loads(resp.data)
+        seen = [item["@controls"]["self"]["href"] for item in body["items"]]
+        while "next" in body["@controls"]:
+            body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+            seen.extend(item["@controls"]["self"]["href"] for item in body["items"])
+        assert len(seen) == len(set(seen)) == 12
+
+        #the best match comes first
+        recipe = _get_recipe_json()
+        recipe["title"] = "Salmon"
+        recipe["description"] = "Salmon with salmon sauce"
+        client.post(self.COLLECTION_URL, json=recipe)
+        recipe["title"] = "Steak"
+        recipe["description"] = "Steak with salmon sauce"
+        client.post(self.COLLECTION_URL, json=recipe)
+        body = json.loads(client.get(self.RESOURCE_URL + "?q=salmon").data)
+        assert [item["title"] for item in body["items"]] == ["Salmon", "Steak"]
+
+        #test invalid and empty searches
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?q=*-()")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + '?q=salmon" OR "steak')
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["items"] == []
+        resp = client.get(self.RESOURCE_URL + "?q=salmon&after=bad")
+        assert resp.status_code == 400
+
+    def test_index_sync(self, client):
+        """Tests that edited and deleted recipes are found by their new text only"""
+        search = lambda q: json.loads(client.get(self.RESOURCE_URL + "?q=" + q).data)["items"]
+        recipe = _get_recipe_json()
+        recipe["ingredients"] = "Salmon, dill"
+        resp = client.put(self.COLLECTION_URL + "1/", json=recipe)
+        assert resp.status_code == 204
+        assert [item["title"] for item in search("dill")] == [recipe["title"]]
+        assert len(search("col1 recipe1")) == 2
+        client.delete(self.COLLECTION_URL + "1/")
+        assert search("dill") == []
+
+class TestRecipesByIngredients(object):
+
+    RESOURCE_URL = "/api/recipes/ingredients/"
+    COLLECTION_URL = "/api/users/user-1/collections/Collection1-of-User1/"
+
+    def _add_recipes(self, client):
+        for number, ingredients in enumerate(["Salmon fillet, dill", "salmon, lemons", "Dill, potatoes", "Tuna"]):
+            recipe = _get_recipe_json(number)
+            recipe["ingredients"] = ingredients
+            resp = client.post(self.COLLECTION_URL, json=recipe)
+            assert resp.status_code == 201
+
+    def test_get(self, client):
+        """Tests for RecipesByIngredients GET method"""
+        self._add_recipes(client)
+        titles = lambda url: [item["title"] for item in json.loads(client.get(url).data)["items"]]
+        resp = client.get(self.RESOURCE_URL + "?ingredients=salmon,dill")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        assert [item["title"] for item in body["items"]] == ["Extra-Recipe-0"]
+        assert client.get(body["items"][0]["@controls"]["self"]["href"]).status_code == 200
+        assert body["ingredients"] == ["dill", "salmon"]
+        assert titles(self.RESOURCE_URL + "?ingredients=Salmon,Dill&match=any") == [
+            "Extra-Recipe-0", "Extra-Recipe-1", "Extra-Recipe-2"
+        ]
+        assert titles(self.RESOURCE_URL + "?ingredients=lemon,potato&match=any") == ["Extra-Recipe-1", "Extra-Recipe-2"]
+        assert titles(self.RESOURCE_URL + "?ingredients=salmon,caviar") == []
+        assert titles(self.RESOURCE_URL + "?ingredients=caviar&match=any") == []
+        assert "fpoint:recipes-by-ingredients" in json.loads(client.get("/api/").data)["@controls"]
+
+        #test pagination both ways
+        resp = client.get(self.RESOURCE_URL + "?ingredients=ingredient&limit=5")
+        body = json.loads(resp.data)
+        assert "prev" not in body["@controls"]
+        pages = [[item["@controls"]["self"]["href"] for item in body["items"]]]
+        while "next" in body["@controls"]:
+            body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+            pages.append([item["@controls"]["self"]["href"] for item in body["items"]])
+        assert [len(page) for page in pages] == [5, 5, 2]
+        body = json.loads(client.get(body["@controls"]["prev"]["href"]).data)
+        assert [item["@controls"]["self"]["href"] for item in body["items"]] == pages[1]
+
+        #test invalid queries
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?ingredients=a, of, 100 g")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?ingredients=salmon&match=some")
+        assert resp.status_code == 400
+        resp = client.get(self.RESOURCE_URL + "?ingredients=salmon&after=bad")
+        assert resp.status_code == 400
+
+class TestCategoryRecipes(object):
+
+    RESOURCE_URL = "/api/categories/category1/recipes/"
+    INVALID_URL = "/api/categories/non-category-x/recipes/"
+
+    def test_get(self, client):
+        """Tests for CategoryRecipes GET method"""
+        for rating in (2.5, 4.0, 3.0):
+            recipe = _get_recipe_json(rating)
+            recipe["rating"] = rating
+            client.post("/api/users/user-2/collections/Collection1-of-User2/", json=recipe)
+        resp = client.get(self.RESOURCE_URL + "?limit=2")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        assert body["category"] == "category1"
+        assert [item["rating"] for item in body["items"]] == [4.0, 3.0]
+        assert client.get(body["@controls"]["up"]["href"]).status_code == 200
+        assert client.get(body["items"][0]["@controls"]["self"]["href"]).status_code == 200
+        #recipes without rating come last, see _populate_db for the recipes of category1
+        ratings = [item["rating"] for item in body["items"]]
+        while "next" in body["@controls"]:
+            body = json.loads(client.get(body["@controls"]["next"]["href"]).data)
+            ratings.extend(item["rating"] for item in body["items"])
+        assert ratings == [4.0, 3.0, 2.5, None, None, None, None]
+        body = json.loads(client.get(body["@controls"]["prev"]["href"]).data)
+        assert [item["rating"] for item in body["items"]] == [None, None]
+
+        link = json.loads(client.get("/api/categories/category1/").data)["@controls"]["fpoint:recipes"]
+        assert link["href"] == self.RESOURCE_URL
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+        resp = client.get(self.RESOURCE_URL + "?after=bad")
+        assert resp.status_code == 400
+
+class TestEthnicityRecipes(object):
+
+    RESOURCE_URL = "/api/ethnicities/ethnicity2/recipes/"
+    INVALID_URL = "/api/ethnicities/non-ethnicity-x/recipes/"
+
+    def test_get(self, client):
+        """Tests for EthnicityRecipes GET method"""
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body["items"]) == 4
+        assert all("/user-2/" in item["@controls"]["self"]["href"] for item in body["items"])
+        link = json.loads(client.get("/api/ethnicities/ethnicity2/").data)["@controls"]["fpoint:recipes"]
+        assert link["href"] == self.RESOURCE_URL
+        resp = client.get(self.INVALID_URL)
+        assert resp.status_code == 404
+
+class TestAllRecipes(object):
+
+    RESOURCE_URL = "/api/recipes/"
+
+    def test_get(self, client):
+        """Tests for AllRecipes GET method"""
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        _check_namespace(client, body)
+        assert len(body["items"]) == 12
+        recipe = _get_recipe_json()
+        recipe["rating"] = 4.5
+        recipe["ethnicity"] = "ethnicity2"
+        client.post("/api/users/user-1/collections/Collection1-of-User1/", json=recipe)
+
+        titles = lambda url: [item["title"] for item in json.loads(client.get(url).data)["items"]]
+        assert titles(self.RESOURCE_URL + "?category=category1&ethnicity=ethnicity2") == ["Extra-Recipe-1"]
+        assert len(titles(self.RESOURCE_URL + "?ethnicity=ethnicity2")) == 5
+        assert titles(self.RESOURCE_URL + "?min_rating=4") == ["Extra-Recipe-1"]
+        assert titles(self.RESOURCE_URL + "?category=non-category-x") == []
+        body = json.loads(client.get(self.RESOURCE_URL + "?category=category1&limit=2").data)
+        assert "category=category1" in body["@controls"]["next"]["href"]
+        assert "fpoint:all-recipes" in json.loads(client.get("/api/").data)["@controls"]
+        resp = client.get(self.RESOURCE_URL + "?min_rating=high")
+        assert resp.status_code == 400
+
+    def test_get_pagination(self, client):
+        """Tests paging through rated recipes and then the ones without rating, forward and backward"""
+        for i, rating in enumerate([3.5, 4.5, 3.5]):
+            recipe = _get_recipe_json(i + 1)
+            recipe["rating"] = rating
+            client.post("/api/users/user-1/collections/Collection1-of-User1/", json=recipe)
+        everything = json.loads(client.get(self.RESOURCE_URL + "?limit=100").data)["items"]
+        assert [item["rating"] for item in everything[:4]] == [4.5, 3.5, 3.5, None]
+        pages = []
+        url = self.RESOURCE_URL + "?limit=2"
+        while url:
+            body = json.loads(client.get(url).data)
+            pages.append(body["items"])
+            url = body["@controls"].get("next", {}).get("href")
+        assert [item for page in pages for item in page] == everything
+        backward = body["items"]
+        url = body["@controls"]["prev"]["href"]
+        while url:
+            body = json.loads(client.get(url).data)
+            backward = body["items"] + backward
+            url = body["@controls"].get("prev", {}).get("href")
+        assert backward == everything
+
+class TestCacheStats(object):
+
+    RESOURCE_URL = "/api/admin/cache/"
+    COLLECTION_URL = "/api/users/user-1/collections/Collection1-of-User1/"
+
+    def test_get(self, client):
+        """Tests for CacheStats GET method and the statistics of the lookup cache"""
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 403
+        client.application.config["ADMIN_TOKEN"] = "secret"
+        headers = {"Authorization": "Bearer secret"}
+        client.post(self.COLLECTION_URL, json=_get_recipe_json(1))
+        client.post(self.COLLECTION_URL, json=_get_recipe_json(2))
+        resp = client.get(self.RESOURCE_URL, headers=headers)
+        assert resp.status_code == 200
+        stats = json.loads(resp.data)["lookup"]
+        assert stats["category"] == {"hits": 1, "misses": 1, "invalidations": 0, "entries": 1}
+        assert stats["ethnicity"]["hits"] == 1
+
+        client.put("/api/categories/category2/", json=_get_category_json())
+        stats = json.loads(client.get(self.RESOURCE_URL, headers=headers).data)["lookup"]
+        assert stats["category"]["invalidations"] == 1
+        assert stats["category"]["entries"] == 0
+
+class TestExport(object):
+
+    RESOURCE_URL = "/api/export/"
+
+    def test_get(self, client):
+        """Tests for Export GET method"""
+        #admin resources are disabled without a token in config
+        resp = client.get(self.RESOURCE_URL, headers={"Authorization": "Bearer secret"})
+        assert resp.status_code == 403
+        client.application.config["ADMIN_TOKEN"] = "secret"
+        resp = client.get(self.RESOURCE_URL, headers={"Authorization": "Bearer wrong"})
+        assert resp.status_code == 403
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 403
+
+        resp = client.get(self.RESOURCE_URL, headers={"Authorization": "Bearer secret"})
+        assert resp.status_code == 200
+        assert resp.mimetype == "application/x-ndjson"
+        records = [json.loads(line) for line in resp.data.decode("utf-8").splitlines()]
+        kinds = [record["type"] for record in records]
+        #see _populate_db for the numbers
+        assert kinds.count("user") == 3
+        assert kinds.count("collection") == 6
+        assert kinds.count("recipe") == 12
+        assert kinds.count("recipe-collection") == 12
+        assert kinds.index("user") < kinds.index("collection") < kinds.index("recipe") < kinds.index("recipe-collection")
@@ -0,0 +1,108 @@
+import os
+import pytest
+import tempfile
+import json
+
+from flask import url_for
+from jsonschema import ValidationError
+from werkzeug.routing import BuildError
+from Foodpoint import create_app
+from Foodpoint.utils import JSON_ENCODERS, get_json_encoder, encode_json_stdlib, get_validator, validate_json
+from Foodpoint.utils import MasonBuilder, render_json_stream
+
+#All Python modules that either begin with test_ or end with _test are automatically detected by pytest.
+
+@pytest.fixture
+def app():
+    """
+    This function setup a new app for testing using test configuration, without creating the database.
+    """
+    db_fd, db_fname = tempfile.mkstemp()
+    config = {
+        "SQLALCHEMY_DATABASE_URI" : "sqlite:///" + db_fname,
+        "TESTING" : True
+    }
+
+    yield create_app(config)
+
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+
+def test_validator_cache(app):
+    """
+    Tests that the schema of each write endpoint is compiled only once.
+    """
+    from Foodpoint.resources import FoodpointBuilder
+    validator = get_validator(FoodpointBuilder.recipe_schema)
+    assert get_validator(FoodpointBuilder.recipe_schema) is validator
+    assert get_validator(FoodpointBuilder.user_schema) is not validator
+    recipe = {"title": "title", "description": "description", "ingredients": "ingredients",
+              "ethnicity": "ethnicity1", "category": "category1"}
+    validate_json(recipe, FoodpointBuilder.recipe_schema)
+    with pytest.raises(ValidationError):
+        validate_json({"title": "no other fields"}, FoodpointBuilder.recipe_schema)
+
+
+def test_json_encoders():
+    """
+    Tests that every JSON encoder gives the same documents and that the encoder is chosen by name.
+    """
+    document = {"name": "Crème brûlée ☃ \"quoted\"\n", "rating": 4.5, "items": [1, None, True], "empty": {}}
+    for encoder in JSON_ENCODERS.values():
+        assert isinstance(encoder(document), bytes)
+        assert json.loads(encoder(document)) == document
+    assert get_json_encoder("auto") is JSON_ENCODERS.get("orjson", encode_json_stdlib)
+    assert get_json_encoder("json") is encode_json_stdlib
+    with pytest.raises(ValueError):
+        get_json_encoder("unknown")
+
+
+def test_non_compact_encoders(app):
+    """
+    Tests that documents with encoded items are valid JSON with encoders that pretty print or end with a newline.
+    """
+    encoders = [
+        lambda document: json.dumps(document, indent=2).encode("utf-8"),
+        lambda document: encode_json_stdlib(document) + b"\n",
+    ]
+    for encoder in encoders:
+        app.extensions["json_encoder"] = encoder
+        with app.test_request_context("/"):
+            items = [encoder({"a": 1}), encoder(2)]
+            body = MasonBuilder(name="list")
+            assert json.loads(body.encode_with_items(items)) == {"name": "list", "items": [{"a": 1}, 2]}
+            assert json.loads(MasonBuilder().encode_with_items(items)) == {"items": [{"a": 1}, 2]}
+            for tail in ({"@controls": {"next": {"href": "/next/"}}}, {}):
+                resp = render_json_stream(body, iter([{"a": 1}, 2]), lambda: tail, chunk_size=1)
+                document = json.loads(b"".join(resp.response))
+                assert document == dict(tail, name="list", items=[{"a": 1}, 2])
+    app.extensions["json_encoder"] = lambda document: b"[]"
+    with app.test_request_context("/"):
+        with pytest.raises(ValueError):
+            MasonBuilder().encode_with_items([])
+
+
+def test_url_builder(app):
+    """
+    Tests that the URLs of the precompiled URL builder are the same as those of url_for.
+    """
+    from Foodpoint.api import api
+    names = ["user-1", "a b", "ä/ö", "?#%&=+", "~.-_!$'()*,;:@", 5]
+    queries = [{}, {"limit": 10, "after": None}, {"q": "salmon dill?", "before": "AbC_-=", "match": ["all", "any"]}]
+    resources = dict((rule.endpoint, app.view_functions[rule.endpoint].view_class) for rule in app.url_map.iter_rules()
+                     if rule.endpoint.startswith("api."))
+    assert set(resources) <= set(app.extensions["url_builder"].rules)
+    for base_url in ("http://localhost/", "http://localhost/mounted/app d/"):
+        with app.test_request_context("/", base_url=base_url):
+            for rule in app.url_map.iter_rules():
+                if rule.endpoint not in resources:
+                    continue
+                for name in names:
+                    for query in queries:
+                        values = dict(query, **dict((argument, name) for argument in rule.arguments))
+                        assert api.url_for(resources[rule.endpoint], **values) == url_for(rule.endpoint, **values)
+            with pytest.raises(BuildError):
+                api.url_for(resources["api.eachuser"])
+            with pytest.raises(BuildError):
+                api.url_for(resources["api.eachuser"], user=None)